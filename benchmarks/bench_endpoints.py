@@ -0,0 +1,342 @@
+"""
+Measure every webserver endpoint over a generated race, through the Flask test client and
+through a real WSGI server, and compare the results with a stored baseline.
+
+For each endpoint the p50, p95 and p99 latency and the throughput are reported per client,
+and the peak memory allocated while handling one request (tracemalloc, test client only).
+Results are compared with benchmarks/baseline.json for the same race size: a p95 or peak
+memory more than --tolerance times its baseline, and more than SLACK above it, is reported
+as a regression and the run exits with status 1. Save a new baseline with --save-baseline.
+
+The response cache is off unless --cache is given, so reads measure the db and serializers.
+POST /riders and POST /trackers are left out, they do not persist yet.
+
+Run with: python -m benchmarks.bench_endpoints --size small
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from werkzeug.serving import make_server
+
+from benchmarks import dataset
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base
+from tracker.models import Checkpoints
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+CLIENTS = ('test_client', 'wsgi')
+# smallest increase counted as a regression, timings of a few ms vary by more than the tolerance
+SLACK = {'p95_ms': 10.0, 'peak_kb': 64.0}
+
+
+class Scenario(object):
+    """
+    One endpoint to measure.
+
+    :param name: name reported, e.g. 'GET /riders/<id>'.
+    :param method: http method.
+    :param request: function of a running count returning (path, json body or None); writes use the
+        count to make each request unique, reads to spread over the race's rows.
+    :param weight: share of --requests made, heavy endpoints such as exports use less than 1.
+    """
+
+    def __init__(self, name, method, request, weight=1.0):
+        self.name = name
+        self.method = method
+        self.request = request
+        self.weight = weight
+        self.counter = itertools.count()
+
+    def next_request(self):
+        return self.request(next(self.counter))
+
+
+def scenarios(race):
+    """Return the Scenarios for a race generated with dataset.generate."""
+    riders = race.riders
+    trackers = race.trackers
+    spare_tracker = riders + 1
+    fix_time = dataset.RACE_START + timedelta(days=10)
+
+    def rider(n):
+        return n * 7919 % riders + 1
+
+    def tracker(n):
+        return n * 7919 % trackers + 1
+
+    def positions(n):
+        # 100 fixes of assigned trackers, a minute after the previous request's
+        return '/positions', [
+            {
+                'esn': '3%06d' % ((n * 100 + i) % riders + 1),
+                'latitude': 45.0,
+                'longitude': 8.0,
+                'time': (fix_time + timedelta(minutes=n, seconds=i)).isoformat(),
+            }
+            for i in range(100)
+        ]
+
+    def import_riders(n):
+        return '/riders/import', [
+            {'firstName': 'Bench', 'lastName': 'Rider%d' % i, 'capNumber': 'B%d-%d' % (n, i), 'category': 'male'}
+            for i in range(50)
+        ]
+
+    def assignment(n):
+        # assign the spare tracker, then remove it again
+        action = 'addTrackerAssignment' if n % 2 == 0 else 'removeTrackerAssignment'
+        return '/riders/1/trackers/%d/%s' % (spare_tracker, action), {}
+
+    def arrival(n):
+        return '/riders/%d/%d/arrival' % (n % riders + 1, BENCH_CHECKPOINT + n // riders), {
+            'time': (fix_time + timedelta(seconds=n)).isoformat()
+        }
+
+    return [
+        Scenario('GET /riders', 'GET', lambda n: ('/riders?limit=25&start=%d' % rider(n), None)),
+        Scenario('GET /riders sorted', 'GET', lambda n: ('/riders?limit=25&sort=lastName', None)),
+        Scenario('GET /riders streamed', 'GET', lambda n: ('/riders?limit=500&stream=1', None), 0.2),
+        Scenario('GET /riders/<id>', 'GET', lambda n: ('/riders/%d' % rider(n), None)),
+        Scenario('GET /riders/<id> lean', 'GET', lambda n: ('/riders/%d?exclude=events,notes' % rider(n), None)),
+        Scenario('GET /riders/<id>/events', 'GET', lambda n: ('/riders/%d/events' % rider(n), None)),
+        Scenario('GET /riders/search', 'GET', lambda n: ('/riders/search?q=%s' % 'abcdefghjklmprstw'[n % 17], None)),
+        Scenario('GET /trackers', 'GET', lambda n: ('/trackers?limit=25&start=%d' % tracker(n), None)),
+        Scenario('GET /trackers by esn', 'GET', lambda n: ('/trackers?esn=3%06d' % tracker(n), None)),
+        Scenario('GET /trackers/<id>', 'GET', lambda n: ('/trackers/%d' % tracker(n), None)),
+        Scenario('GET /trackers/<id>/events', 'GET', lambda n: ('/trackers/%d/events' % tracker(n), None)),
+        Scenario('GET /positions/latest', 'GET', lambda n: ('/positions/latest', None), 0.2),
+        Scenario('GET /positions/latest by rider', 'GET', lambda n: ('/positions/latest?rider=%d' % rider(n), None)),
+        Scenario('GET /races', 'GET', lambda n: ('/races', None)),
+        Scenario('GET /races/<id>', 'GET', lambda n: ('/races/%d?limit=25' % (n % race.checkpoints + 1), None)),
+        Scenario('GET /export/riders', 'GET', lambda n: ('/export/riders', None), 0.05),
+        Scenario('GET /export/rider_events csv', 'GET', lambda n: ('/export/rider_events?format=csv', None), 0.05),
+        Scenario('GET /cache/stats', 'GET', lambda n: ('/cache/stats', None)),
+        Scenario('POST /positions', 'POST', positions, 0.5),
+        Scenario('POST /riders/import', 'POST', import_riders, 0.2),
+        Scenario('POST tracker assignment', 'POST', assignment),
+        Scenario('PATCH /riders/<id>', 'PATCH', lambda n: ('/riders/%d' % rider(n), {'capNumber': 'P%d' % n})),
+        Scenario('PATCH /trackers/<id>', 'PATCH', lambda n: (
+            '/trackers/%d' % tracker(n), {'workingStatus': ('working', 'broken')[n % 2]}
+        )),
+        Scenario('POST /races/<id>', 'POST', lambda n: ('/races/%d' % (BENCH_CHECKPOINT * 10 + n), {
+            'name': 'Bench %d' % n
+        })),
+        Scenario('POST arrival', 'POST', arrival),
+    ]
+
+
+# checkpoints benchmarked arrivals are recorded at, after the race's own
+BENCH_CHECKPOINT = 1000
+
+
+def percentile(timings, share):
+    """Return the nearest rank percentile of sorted timings."""
+    return timings[min(len(timings) - 1, max(0, int(round(share * len(timings))) - 1))]
+
+
+def summarise(timings, elapsed):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'rps': round(len(timings) / elapsed, 1),
+    }
+
+
+def _check(scenario, status, path):
+    if status >= 400:
+        raise RuntimeError('{} {} returned {}'.format(scenario.method, path, status))
+
+
+def run_test_client(scenarios_, requests, warmup):
+    """Time each scenario through the Flask test client, then measure its peak memory."""
+    client = webserver.app.test_client()
+
+    def call(scenario):
+        path, body = scenario.next_request()
+        started = time.perf_counter()
+        response = client.open(path, method=scenario.method, json=body)
+        response.get_data()
+        took = time.perf_counter() - started
+        response.close()
+        _check(scenario, response.status_code, path)
+        return took
+
+    results = {}
+    for scenario in scenarios_:
+        count = max(1, int(requests * scenario.weight))
+        for _ in range(warmup):
+            call(scenario)
+        started = time.perf_counter()
+        timings = [call(scenario) * 1000 for _ in range(count)]
+        results[scenario.name] = summarise(timings, time.perf_counter() - started)
+        # a separate pass, tracing allocations slows requests down
+        tracemalloc.start()
+        peak = 0
+        for _ in range(min(count, 5)):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            call(scenario)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+        results[scenario.name]['peak_kb'] = round(peak / 1024, 1)
+    return results
+
+
+def run_wsgi(scenarios_, requests, warmup):
+    """
+    Time each scenario over http against a werkzeug WSGI server.
+
+    The server handles requests in this thread, which generated the race: the in-memory sqlite
+    db is only visible to the thread that created it. Requests are made from a client thread.
+    """
+    # the request log would be most of the output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, webserver.app)
+    port = server.server_port
+    results = {}
+    errors = []
+
+    def call(scenario):
+        path, body = scenario.next_request()
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        started = time.perf_counter()
+        connection.request(scenario.method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        took = time.perf_counter() - started
+        connection.close()
+        _check(scenario, response.status, path)
+        return took
+
+    def client():
+        try:
+            for scenario in scenarios_:
+                count = max(1, int(requests * scenario.weight))
+                for _ in range(warmup):
+                    call(scenario)
+                started = time.perf_counter()
+                timings = [call(scenario) * 1000 for _ in range(count)]
+                results[scenario.name] = summarise(timings, time.perf_counter() - started)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            server.shutdown()
+
+    thread = threading.Thread(target=client, name='bench-client')
+    thread.start()
+    server.serve_forever()
+    thread.join()
+    server.server_close()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the regressions of results against baseline, as readable strings.
+
+    A p95 latency or a peak memory more than tolerance times its baseline value, and more than
+    its SLACK above it, is a regression.
+    """
+    regressions = []
+    for client, endpoints in results.items():
+        for name, result in endpoints.items():
+            before = baseline.get(client, {}).get(name)
+            if before is None:
+                continue
+            for key, slack in SLACK.items():
+                if key in result and before.get(key) and result[key] > max(before[key] * tolerance,
+                                                                           before[key] + slack):
+                    regressions.append('{} {} {}: {} against baseline {}'.format(
+                        client, name, key, result[key], before[key]))
+    return regressions
+
+
+def report(results):
+    for client, endpoints in results.items():
+        print(client)
+        print('  {:<34} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'peak kb'))
+        for name, result in endpoints.items():
+            print('  {:<34} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9}'.format(
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['rps'], result.get('peak_kb', '')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint over a generated race.')
+    parser.add_argument('--size', choices=sorted(dataset.SIZES), default='small')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and client')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--clients', nargs='+', choices=CLIENTS, default=list(CLIENTS))
+    parser.add_argument('--cache', action='store_true', help='serve reads through the response cache')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='allowed ratio to the baseline')
+    args = parser.parse_args(argv)
+
+    race = dataset.Race.preset(args.size)
+    Base.metadata.create_all(db.engine)
+    webserver.app.config['POSITION_BACKGROUND_FLUSH'] = False
+    webserver.response_cache.enabled = args.cache
+    started = time.perf_counter()
+    with db.session_scope(commit=True) as session:
+        written = dataset.generate(session, race)
+        arrivals = 2 * (args.requests + args.warmup) * len(args.clients)
+        db.bulk_insert(session, Checkpoints, [
+            {'id': BENCH_CHECKPOINT + n, 'name': 'Bench arrivals %d' % n, 'arrivals': 0}
+            for n in range(arrivals // race.riders + 1)
+        ])
+    print('{} rows of a {} race generated in {:.2f}s'.format(
+        sum(written.values()), args.size, time.perf_counter() - started))
+    webserver.esn_index.clear()
+
+    scenarios_ = scenarios(race)
+    results = {}
+    if 'test_client' in args.clients:
+        results['test_client'] = run_test_client(scenarios_, args.requests, args.warmup)
+    if 'wsgi' in args.clients:
+        results['wsgi'] = run_wsgi(scenarios_, args.requests, args.warmup)
+    webserver.position_writer.flush()
+    report(results)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save_baseline:
+        baselines[args.size] = dict(results, race=race.counts(), saved=datetime.utcnow().isoformat())
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to {}'.format(args.baseline))
+        return 0
+    if args.size not in baselines:
+        print('no {} baseline in {} to compare with'.format(args.size, args.baseline))
+        return 0
+    regressions = compare(results, baselines[args.size], args.tolerance)
+    for regression in regressions:
+        print('regression: ' + regression)
+    if not regressions:
+        print('no regressions against the {} baseline'.format(args.size))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""
+Measure exporting rider_events as NDJSON and CSV.
+
+Run with: python -m benchmarks.bench_export
+"""
+import time
+from datetime import datetime, timedelta
+
+from tracker import db_interactions as db
+from tracker import export
+from tracker.db_interactions import Base
+from tracker.models import RiderEvents, Riders
+
+RIDERS = 1000
+EVENTS = 10 ** 6
+INSERT_BATCH = 10000
+
+
+def main():
+    Base.metadata.create_all(db.engine)
+    start_time = datetime(2019, 7, 27, 22)
+    with db.session_scope(commit=True) as session:
+        db.bulk_insert(session, Riders, [{'id': i, 'first_name': 'Rider'} for i in range(1, RIDERS + 1)])
+        for first in range(0, EVENTS, INSERT_BATCH):
+            db.bulk_insert(session, RiderEvents, [{
+                'id': i + 1,
+                'rider': i % RIDERS + 1,
+                'event_type': 'payment_in',
+                'datetime': start_time + timedelta(seconds=i),
+                'balance_change': 10.0,
+            } for i in range(first, first + INSERT_BATCH)])
+    for format_ in sorted(export.FORMATS):
+        started = time.perf_counter()
+        size = 0
+        with db.session_scope() as session:
+            for chunk in export.export(session, 'rider_events', format_):
+                size += len(chunk)
+            session.close()
+        elapsed = time.perf_counter() - started
+        print('{}: {} rows, {:.1f}MB in {:.2f}s: {:.0f} rows/s'.format(
+            format_, EVENTS, size / 1e6, elapsed, EVENTS / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Measure sustained position ingest through POST /positions, flushing the buffer as it fills.
+
+Run with: python -m benchmarks.bench_ingest
+"""
+import time
+from datetime import datetime, timedelta
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base
+from tracker.models import TrackerLocations, Trackers
+
+TRACKERS = 1000
+REQUESTS = 20
+FIXES_PER_REQUEST = 500
+
+
+def main():
+    Base.metadata.create_all(db.engine)
+    webserver.app.config['POSITION_BACKGROUND_FLUSH'] = False
+    with db.session_scope(commit=True) as session:
+        db.bulk_insert(session, Trackers, [
+            {'id': i, 'esn_number': 'ESN%d' % i} for i in range(1, TRACKERS + 1)
+        ])
+    client = webserver.app.test_client()
+    start_time = datetime(2019, 7, 27, 22)
+    fixes = 0
+    started = time.perf_counter()
+    for n in range(REQUESTS):
+        payload = []
+        for i in range(FIXES_PER_REQUEST):
+            fix = n * FIXES_PER_REQUEST + i
+            payload.append({
+                'esn': 'ESN%d' % (fix % TRACKERS + 1),
+                'latitude': 48.0,
+                'longitude': 2.0,
+                'time': (start_time + timedelta(minutes=fix // TRACKERS)).isoformat(),
+            })
+        result = client.post('/positions', json=payload)
+        fixes += result.json['accepted']
+    webserver.position_writer.flush()
+    elapsed = time.perf_counter() - started
+    with db.session_scope() as session:
+        stored = session.query(TrackerLocations).count()
+    print('{} fixes accepted, {} stored in {:.2f}s: {:.0f} rows/s'.format(
+        fixes, stored, elapsed, stored / elapsed))
+    print('writer stats: {}'.format(webserver.position_writer.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Measure rider search latency over a 5,000 rider field, through GET /riders/search.
+
+Run with: python -m benchmarks.bench_search
+"""
+import random
+import statistics
+import string
+import time
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base
+from tracker.models import Riders
+
+RIDERS = 5000
+SEARCHES = 500
+
+
+def _name(rng):
+    return rng.choice(string.ascii_uppercase) + ''.join(rng.choice(string.ascii_lowercase) for _ in range(6))
+
+
+def main():
+    rng = random.Random(1)
+    Base.metadata.create_all(db.engine)
+    webserver.response_cache.enabled = False
+    riders = []
+    for i in range(1, RIDERS + 1):
+        first_name, last_name = _name(rng), _name(rng)
+        riders.append({
+            'id': i,
+            'first_name': first_name,
+            'last_name': last_name,
+            'cap_number': str(i),
+            'email': '%s.%s@example.com' % (first_name.lower(), last_name.lower()),
+        })
+    with db.session_scope(commit=True) as session:
+        db.bulk_insert(session, Riders, riders)
+    client = webserver.app.test_client()
+    queries = [rng.choice(riders)['last_name'][:rng.randint(2, 5)] for _ in range(SEARCHES // 2)]
+    queries += [str(rng.randint(1, RIDERS)) for _ in range(SEARCHES // 2)]
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        result = client.get('/riders/search?q=%s&limit=25' % query)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert result.status_code == 200
+    timings.sort()
+    print('{} searches over {} riders: p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms'.format(
+        len(timings), RIDERS, statistics.median(timings), timings[int(len(timings) * 0.95)], timings[-1]))
+
+
+if __name__ == '__main__':
+    main()
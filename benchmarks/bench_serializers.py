@@ -0,0 +1,68 @@
+"""
+Compare the marshmallow and compiled serializer engines.
+
+Run with: python -m benchmarks.bench_serializers
+"""
+import timeit
+from datetime import datetime
+
+from tracker import compiled_serializers as cs
+from tracker import serializers as sl
+from tracker.factory import RiderFactory, TrackerFactory
+from tracker.models import RiderAssignment, RiderEvents, RiderNotes
+
+SIZES = (25, 250, 2500)
+
+
+def build_riders(n):
+    riders = []
+    for _ in range(n):
+        rider = RiderFactory()
+        tracker = TrackerFactory()
+        tracker.rider = rider
+        rider.trackers_assigned = [RiderAssignment(tracker=tracker)]
+        rider.notes = [RiderNotes(datetime=datetime(2019, 7, 27, 22), notes='Deposit paid')]
+        rider.events = [
+            RiderEvents(
+                datetime=datetime(2019, 7, 27, 22),
+                event_type='payment_out',
+                balance_change=-150,
+                notes=rider.notes
+            )
+        ]
+        riders.append(rider)
+    return riders
+
+
+def bench(schema, data, repeat=5):
+    """Return the best time in seconds for each engine to render data with schema."""
+    assert cs.dumps(schema, data, 'marshmallow') == cs.dumps(schema, data, 'compiled')
+    return {
+        engine: min(timeit.repeat(lambda: cs.dumps(schema, data, engine), number=1, repeat=repeat))
+        for engine in cs.ENGINES
+    }
+
+
+def main():
+    print('{:<28}{:>6}{:>15}{:>15}{:>9}'.format('schema', 'rows', 'marshmallow ms', 'compiled ms', 'speedup'))
+    for n in SIZES:
+        riders = build_riders(n)
+        trackers = [rider.trackers_assigned[0].tracker for rider in riders]
+        cases = (
+            ('RiderSerializer', sl.many_riders, riders),
+            ('TrackerSerializer', sl.many_trackers, trackers),
+            ('RiderChangeTrackerState', sl.RiderChangeTrackerState(many=True), riders),
+        )
+        for name, schema, data in cases:
+            result = bench(schema, data)
+            print('{:<28}{:>6}{:>15.2f}{:>15.2f}{:>8.1f}x'.format(
+                name,
+                n,
+                result['marshmallow'] * 1000,
+                result['compiled'] * 1000,
+                result['marshmallow'] / result['compiled'],
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Measure concurrent reads and writes on a sqlite file, with sqlite's defaults and with the pragmas
+of db.SQLITE_PRAGMAS.
+
+Reader threads fetch riders and trackers while writer threads assign and remove trackers, all
+through the Flask test client, for --seconds on a race generated for each profile. Reported per
+profile: reads and writes per second, their p50 and p95 latency, failed requests and writes
+retried because the db was busy. With the rollback journal each write blocks the readers; in WAL
+mode they read the last commit while it runs.
+
+Run with: python -m benchmarks.bench_sqlite --size small
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+from tempfile import mkdtemp
+
+from benchmarks import dataset
+from benchmarks.bench_endpoints import percentile
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base
+
+# env of each profile, given to db.make_engine
+PROFILES = (
+    ('defaults', {'SQLITE_PROFILE': '0'}),
+    ('production', {'SQLITE_PROFILE': '1'}),
+)
+
+
+def reader(client, race, index, stop, results):
+    timings, failed = [], 0
+    n = index
+    while not stop.is_set():
+        n += 1
+        if n % 2:
+            path = '/riders/%d' % (n * 7919 % race.riders + 1)
+        else:
+            path = '/trackers/%d' % (n * 7919 % race.trackers + 1)
+        started = time.perf_counter()
+        status = client.get(path).status_code
+        timings.append(time.perf_counter() - started)
+        failed += status >= 500
+    results.append(('reads', timings, failed))
+
+
+def writer(client, race, index, stop, results):
+    # each writer assigns a spare tracker of its own to a rider of its own, then removes it again
+    rider = index + 1
+    tracker = race.riders + 1 + index
+    timings, failed = [], 0
+    n = 0
+    while not stop.is_set():
+        action = 'addTrackerAssignment' if n % 2 == 0 else 'removeTrackerAssignment'
+        n += 1
+        started = time.perf_counter()
+        status = client.post('/riders/%d/trackers/%d/%s' % (rider, tracker, action)).status_code
+        timings.append(time.perf_counter() - started)
+        failed += status >= 500
+    results.append(('writes', timings, failed))
+
+
+def run(race, environ, readers, writers, seconds):
+    """Return the results of one profile on a newly generated race in a temporary sqlite file."""
+    temp_ = mkdtemp()
+    engine_ = db.make_engine('sqlite:///' + os.path.join(temp_, 'bench.db'), environ)
+    Base.metadata.create_all(engine_)
+    with db.session_scope(commit=True, engine=engine_) as session:
+        dataset.generate(session, race)
+    app_engine, db.engine = db.engine, engine_
+    webserver.esn_index.clear()
+    retries = db.busy_stats['retries']
+    stop = threading.Event()
+    results = []
+    threads = [
+        threading.Thread(target=reader, args=(webserver.app.test_client(), race, i, stop, results))
+        for i in range(readers)
+    ] + [
+        threading.Thread(target=writer, args=(webserver.app.test_client(), race, i, stop, results))
+        for i in range(writers)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        db.engine = app_engine
+        webserver.esn_index.clear()
+        engine_.dispose()
+        shutil.rmtree(temp_)
+    summary = {'busy_retries': db.busy_stats['retries'] - retries}
+    for kind in ('reads', 'writes'):
+        timings = sorted(timing for kind_, kind_timings, _ in results if kind_ == kind for timing in kind_timings)
+        summary[kind] = {
+            'count': len(timings),
+            'per_s': round(len(timings) / seconds, 1),
+            'p50_ms': round(percentile(timings, 0.50) * 1000, 3) if timings else None,
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 3) if timings else None,
+            'failed': sum(failed for kind_, _, failed in results if kind_ == kind),
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark concurrent reads and writes on sqlite profiles.')
+    parser.add_argument('--size', choices=sorted(dataset.SIZES), default='small')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args(argv)
+    race = dataset.Race.preset(args.size)
+    if args.writers > race.trackers - race.riders:
+        parser.error('at most %d writers, one per spare tracker' % (race.trackers - race.riders))
+    webserver.response_cache.enabled = False
+    webserver.query_budget.mode = 'off'
+    print('{:<12} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+        'profile', 'reads/s', 'read p50', 'read p95', 'writes/s', 'write p50', 'write p95', 'failed', 'retries'))
+    for name, environ in PROFILES:
+        summary = run(race, environ, args.readers, args.writers, args.seconds)
+        reads, writes = summary['reads'], summary['writes']
+        print('{:<12} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+            name, reads['per_s'], reads['p50_ms'], reads['p95_ms'], writes['per_s'], writes['p50_ms'],
+            writes['p95_ms'], reads['failed'] + writes['failed'], summary['busy_retries']))
+
+
+if __name__ == '__main__':
+    main()
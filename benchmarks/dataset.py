@@ -0,0 +1,279 @@
+"""
+Generate a synthetic race: riders and trackers from the model factories, with tracker
+assignments, rider and tracker events with notes, position fixes and checkpoint arrivals.
+
+Sizes are given by a preset and can be overridden one by one. Rows are written with
+bulk_insert, so a race of tens of thousands of riders takes seconds rather than minutes.
+The same seed always gives the same race.
+
+Run with: python -m benchmarks.dataset --size race --db race.sqlite
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import factory
+import factory.random
+from sqlalchemy import create_engine
+
+from tracker import db_interactions as db
+from tracker import rider_search
+from tracker.db_interactions import Base
+from tracker.factory import RiderFactory, TrackerFactory
+from tracker.models import (
+    CheckpointArrivals,
+    Checkpoints,
+    LatestPositions,
+    RiderAssignment,
+    RiderCategories,
+    RiderEventCategories,
+    RiderEvents,
+    RiderNotes,
+    Riders,
+    TrackerEventCategories,
+    TrackerEvents,
+    TrackerLocations,
+    TrackerNotes,
+    Trackers,
+)
+
+# rows per count, for the riders, trackers, events, notes and position fixes of a race
+SIZES = {
+    'small': {'riders': 200, 'trackers': 220, 'events': 3, 'notes': 1, 'positions': 10, 'checkpoints': 4},
+    'race': {'riders': 2000, 'trackers': 2200, 'events': 5, 'notes': 2, 'positions': 50, 'checkpoints': 6},
+    'large': {'riders': 20000, 'trackers': 22000, 'events': 5, 'notes': 2, 'positions': 100, 'checkpoints': 8},
+}
+# rows passed to one bulk_insert
+CHUNK_SIZE = 5000
+RACE_START = datetime(2019, 7, 27, 22)
+# roughly Brest to Meteora, the fixes of each tracker move along it
+START = (48.39, -4.49)
+FINISH = (39.72, 21.63)
+
+
+class Race(object):
+    """
+    Counts of a generated race, ids are 1 to the count of each.
+
+    :param riders: number of riders.
+    :param trackers: number of trackers, the first `riders` of them are assigned to riders.
+    :param events: rider events per rider, and tracker events per tracker.
+    :param notes: notes per rider and per tracker, each on one of its events.
+    :param positions: position fixes per assigned tracker.
+    :param checkpoints: number of checkpoints along the route.
+    """
+
+    def __init__(self, riders, trackers, events, notes, positions, checkpoints):
+        self.riders = riders
+        self.trackers = trackers
+        self.events = events
+        self.notes = notes
+        self.positions = positions
+        self.checkpoints = checkpoints
+
+    @classmethod
+    def preset(cls, size, **overrides):
+        counts = dict(SIZES[size])
+        counts.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**counts)
+
+    def counts(self):
+        return dict(vars(self))
+
+
+def _column_keys(model, row):
+    """Map the attribute names of a factory built dict to column keys, as bulk_insert expects."""
+    columns = {prop.key: prop.columns[0].key for prop in model.__mapper__.column_attrs}
+    return {columns[key]: value for key, value in row.items()}
+
+
+def _insert(session, model, rows):
+    count = 0
+    for start in range(0, len(rows), CHUNK_SIZE):
+        count += db.bulk_insert(session, model, rows[start:start + CHUNK_SIZE])
+    return count
+
+
+def riders(race, rng):
+    categories = [category.name for category in RiderCategories]
+    rows = factory.build_batch(
+        dict,
+        race.riders,
+        FACTORY_CLASS=RiderFactory,
+        id=factory.Sequence(lambda n: n + 1),
+        cap_number=factory.Sequence(lambda n: str(n + 1)),
+        first_name=factory.Faker('first_name'),
+        last_name=factory.Faker('last_name'),
+        email=factory.LazyAttributeSequence(
+            lambda rider, n: '%s.%s%d@example.com' % (rider.first_name, rider.last_name, n)
+        ),
+        balance=factory.LazyFunction(lambda: float(rng.choice((0, 100, 150)))),
+        category=factory.LazyFunction(lambda: rng.choice(categories)),
+    )
+    return [_column_keys(Riders, row) for row in rows]
+
+
+def trackers(race, rng):
+    rows = factory.build_batch(
+        dict,
+        race.trackers,
+        FACTORY_CLASS=TrackerFactory,
+        id=factory.Sequence(lambda n: n + 1),
+        esn_number=factory.Sequence(lambda n: '3%06d' % (n + 1)),
+        owner='lost_dot',
+        last_test_date=factory.LazyFunction(lambda: (RACE_START - timedelta(days=rng.randint(1, 60))).date()),
+        purchase_date=datetime(2018, 1, 1).date(),
+        warranty_expiry=datetime(2020, 1, 1).date(),
+    )
+    return [_column_keys(Trackers, row) for row in rows]
+
+
+def _events(race, rng, owner, owner_count, categories, extra):
+    event_rows = []
+    note_rows = []
+    for owner_id in range(1, owner_count + 1):
+        first = len(event_rows) + 1
+        for n in range(race.events):
+            event_rows.append(dict({
+                'id': len(event_rows) + 1,
+                'user_id': None,
+                'datetime': RACE_START - timedelta(days=2) + timedelta(hours=n * 12, minutes=rng.randint(0, 59)),
+                'event_type': rng.choice(categories),
+                owner: owner_id,
+            }, **extra()))
+        for n in range(min(race.notes, race.events)):
+            event = event_rows[first - 1 + n]
+            note_rows.append({
+                'id': len(note_rows) + 1,
+                owner: owner_id,
+                'datetime': event['datetime'],
+                'notes': 'Note %d on %s %d' % (n + 1, owner, owner_id),
+                'user': None,
+                'event': event['id'],
+            })
+    return event_rows, note_rows
+
+
+def rider_events(race, rng):
+    return _events(
+        race, rng, 'rider', race.riders,
+        [category.name for category in RiderEventCategories if category.name != 'arrive_checkpoint'],
+        lambda: {'balance_change': float(rng.choice((-150, -100, 100, 150)))},
+    )
+
+
+def tracker_events(race, rng):
+    return _events(race, rng, 'tracker', race.trackers, [category.name for category in TrackerEventCategories], dict)
+
+
+def positions(race, rng):
+    """Return tracker_locations rows, one fix every 15 minutes per assigned tracker, and the latest of each."""
+    rows = []
+    latest = []
+    received = RACE_START + timedelta(minutes=15 * race.positions)
+    for tracker_id in range(1, min(race.riders, race.trackers) + 1):
+        # each rider covers a share of the route at their own pace
+        pace = rng.uniform(0.3, 1.0) / max(race.positions, 1)
+        for n in range(race.positions):
+            share = min(pace * n, 1.0)
+            rows.append({
+                'id': len(rows) + 1,
+                'tracker_id': tracker_id,
+                'rider': tracker_id,
+                'time': RACE_START + timedelta(minutes=15 * n),
+                'received': received,
+                'latitude': round(START[0] + (FINISH[0] - START[0]) * share + rng.uniform(-0.05, 0.05), 5),
+                'longitude': round(START[1] + (FINISH[1] - START[1]) * share + rng.uniform(-0.05, 0.05), 5),
+            })
+        if race.positions:
+            latest.append({key: value for key, value in rows[-1].items() if key != 'id'})
+    return rows, latest
+
+
+def checkpoints(race, rng):
+    """Return checkpoint rows and arrivals, each rider has passed a random number of checkpoints."""
+    checkpoint_rows = [{'id': n, 'name': 'CP%d' % n, 'arrivals': 0} for n in range(1, race.checkpoints + 1)]
+    arrivals = []
+    events = []
+    for rider_id in range(1, race.riders + 1):
+        reached = rng.randint(0, race.checkpoints)
+        arrived = RACE_START
+        for checkpoint in checkpoint_rows[:reached]:
+            arrived += timedelta(hours=rng.uniform(20, 50))
+            checkpoint['arrivals'] += 1
+            events.append({'user_id': None, 'datetime': arrived, 'event_type': 'arrive_checkpoint', 'rider': rider_id})
+            arrivals.append({'rider_id': rider_id, 'checkpoint_id': checkpoint['id'], 'time': arrived})
+    return checkpoint_rows, arrivals, events
+
+
+def generate(session, race, seed=1):
+    """
+    Write a race into the db of session, which should have no riders or trackers yet.
+
+    :param session: db session, the rows are written in its transaction.
+    :param race: Race with the counts to generate.
+    :param seed: random seed, the same seed gives the same race.
+    :return: dict of table name to number of rows written.
+    """
+    rng = random.Random(seed)
+    factory.random.reseed_random(seed)
+    written = {}
+    written['riders'] = _insert(session, Riders, riders(race, rng))
+    written['trackers'] = _insert(session, Trackers, trackers(race, rng))
+    assigned = min(race.riders, race.trackers)
+    written['rider_assignment'] = _insert(session, RiderAssignment, [
+        {'id': n, 'rider': n} for n in range(1, assigned + 1)
+    ])
+    db.bulk_update(session, Trackers, [{'id': n, 'rider_assigned': n} for n in range(1, assigned + 1)])
+    event_rows, note_rows = rider_events(race, rng)
+    written['rider_events'] = _insert(session, RiderEvents, event_rows)
+    written['rider_notes'] = _insert(session, RiderNotes, note_rows)
+    event_rows, note_rows = tracker_events(race, rng)
+    written['tracker_events'] = _insert(session, TrackerEvents, event_rows)
+    written['tracker_notes'] = _insert(session, TrackerNotes, note_rows)
+    fixes, latest = positions(race, rng)
+    written['tracker_locations'] = _insert(session, TrackerLocations, fixes)
+    written['latest_positions'] = _insert(session, LatestPositions, latest)
+    checkpoint_rows, arrivals, arrival_events = checkpoints(race, rng)
+    written['checkpoints'] = _insert(session, Checkpoints, checkpoint_rows)
+    first_event = written['rider_events'] + 1
+    written['rider_events'] += _insert(session, RiderEvents, [
+        dict(event, id=first_event + n) for n, event in enumerate(arrival_events)
+    ])
+    written['checkpoint_arrivals'] = _insert(session, CheckpointArrivals, [
+        dict(arrival, id=n + 1, event=first_event + n) for n, arrival in enumerate(arrivals)
+    ])
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic race into a sqlite db.')
+    parser.add_argument('--size', choices=sorted(SIZES), default='race')
+    parser.add_argument('--db', required=True, help='sqlite file to create, it must not have riders yet')
+    parser.add_argument('--riders', type=int)
+    parser.add_argument('--trackers', type=int)
+    parser.add_argument('--events', type=int, help='events per rider and per tracker')
+    parser.add_argument('--notes', type=int, help='notes per rider and per tracker')
+    parser.add_argument('--positions', type=int, help='position fixes per assigned tracker')
+    parser.add_argument('--checkpoints', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    race = Race.preset(
+        args.size, riders=args.riders, trackers=args.trackers, events=args.events, notes=args.notes,
+        positions=args.positions, checkpoints=args.checkpoints,
+    )
+    engine_ = create_engine('sqlite:///' + args.db)
+    Base.metadata.create_all(engine_)
+    rider_search.create(engine_)
+    started = time.perf_counter()
+    with db.session_scope(commit=True, engine=engine_) as session:
+        written = generate(session, race, args.seed)
+    elapsed = time.perf_counter() - started
+    for table, count in written.items():
+        print('{:<20} {:>10}'.format(table, count))
+    print('{} rows in {:.2f}s'.format(sum(written.values()), elapsed))
+
+
+if __name__ == '__main__':
+    main()
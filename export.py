@@ -0,0 +1,5 @@
+from tracker import export
+
+if __name__ == '__main__':
+
+    export.main()
@@ -0,0 +1,69 @@
+from datetime import datetime
+from unittest import TestCase
+
+from tracker.factory import RiderFactory, TrackerFactory
+from tracker.models import RiderAssignment, RiderEvents, RiderNotes, WorkingStatus, LoanStatus
+import tracker.serializers as sl
+import tracker.compiled_serializers as cs
+
+
+class TestCompiledSerializers(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.rider = RiderFactory()
+        cls.rider2 = RiderFactory(category=None, email=None)
+        cls.tracker = TrackerFactory()
+        cls.tracker.rider = cls.rider
+        # enum members, as loaded from the db
+        cls.tracker2 = TrackerFactory(working_status=WorkingStatus.broken, loan_status=LoanStatus.not_loaned)
+        cls.tracker3 = TrackerFactory(last_test_date=None)
+        cls.rider.trackers_assigned = [RiderAssignment(tracker=cls.tracker), RiderAssignment(tracker=cls.tracker2)]
+        cls.rider.notes = [RiderNotes(id=1, datetime=datetime(2019, 7, 27, 22, 5), notes='Paid "cash" – £150')]
+        cls.rider.events = [
+            RiderEvents(
+                id=1,
+                datetime=datetime(2019, 7, 27, 22, 5),
+                event_type='payment_out',
+                balance_change=-150.5,
+                notes=cls.rider.notes
+            )
+        ]
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        # other serializer tests rely on factory ids starting from 1
+        RiderFactory.reset_sequence()
+        TrackerFactory.reset_sequence()
+
+    def assertSameOutput(self, schema, data):
+        expected = schema.dumps(data).encode('utf-8')
+        self.assertEqual(expected, cs.compile_schema(schema)(data))
+        self.assertEqual(expected, cs.dumps(schema, data, engine='compiled'))
+
+    def test_single_rider(self):
+        self.assertSameOutput(sl.single_rider, self.rider)
+        self.assertSameOutput(sl.single_rider, self.rider2)
+
+    def test_many_riders(self):
+        self.assertSameOutput(sl.many_riders, [self.rider, self.rider2])
+        self.assertSameOutput(sl.many_riders, [])
+
+    def test_trackers(self):
+        self.assertSameOutput(sl.single_tracker, self.tracker)
+        self.assertSameOutput(sl.many_trackers, [self.tracker, self.tracker2, self.tracker3])
+
+    def test_rider_change_tracker_state(self):
+        self.assertSameOutput(sl.rider_change_tracker_state, self.rider)
+        self.assertSameOutput(sl.rider_change_tracker_state, self.rider2)
+
+    def test_compiled_once_per_schema(self):
+        self.assertIs(cs.compile_schema(sl.single_rider), cs.compile_schema(sl.single_rider))
+
+    def test_marshmallow_engine(self):
+        self.assertEqual(cs.dumps(sl.single_tracker, self.tracker, engine='marshmallow'),
+                         sl.single_tracker.dumps(self.tracker).encode('utf-8'))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            cs.dumps(sl.single_tracker, self.tracker, engine='nonsense')
@@ -1,15 +1,16 @@
 import os
 import shutil
 import sqlite3
-from datetime import datetime
+import threading
+from datetime import datetime, date
 from tempfile import mkdtemp
 from unittest import TestCase, mock
 from unittest.mock import patch, Mock
 
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError
+from sqlalchemy.orm import selectinload, sessionmaker
 
 from tracker.db_interactions import (
     create,
@@ -19,11 +20,34 @@ from tracker.db_interactions import (
     session_scope,
     update,
     get_resources,
+    get_page,
+    decode_cursor,
+    encode_cursor,
+    bulk_insert,
+    bulk_increment,
+    bulk_insert_returning_ids,
+    bulk_upsert_latest,
+    create_missing_indexes,
+    missing_indexes,
+    add_missing_columns,
+    missing_columns,
+    patch as patch_row,
+    engine_options,
+    make_engine,
+    engine_pragmas,
+    pool_stats,
+    retry_busy,
+    busy_stats,
+    TimedQueuePool,
+    WalCheckpointer,
     get)
+from tracker.query_budget import QueryCounter
 from tracker.models import (
     Base,
     Riders,
     Trackers,
+    LatestPositions,
+    RiderEvents,
     RiderNotes)
 
 
@@ -97,6 +121,156 @@ class TestSetUpDB(DBTests):
         sqlalchemy.orm.Session.rollback.assert_called()
 
 
+class TestEngineConfiguration(DBTests):
+
+    def test_pool_settings_from_environ(self):
+        options = engine_options('postgresql://user@host/tracker', {'DB_POOL_SIZE': '20', 'DB_POOL_PRE_PING': '0'})
+        self.assertEqual(options, {
+            'poolclass': TimedQueuePool,
+            'pool_size': 20,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'pool_recycle': 1800,
+            'pool_pre_ping': False,
+        })
+        self.assertEqual(engine_options('sqlite:///', {'DB_POOL_SIZE': '20'}), {})
+        self.assertEqual(engine_options('sqlite:///' + self.temp_db, {'SQLITE_PROFILE': '0'}), {})
+
+    def test_sqlite_files_are_pooled(self):
+        self.assertEqual(engine_options('sqlite:///' + self.temp_db, {'DB_POOL_SIZE': '20'}), {
+            'poolclass': TimedQueuePool,
+            'pool_size': 20,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'connect_args': {'check_same_thread': False},
+        })
+
+    def test_sqlite_pragmas_on_every_connection(self):
+        temp_db = os.path.join(self.temp_, 'pragmas.db')
+        engine = make_engine('sqlite:///' + temp_db, {'SQLITE_SYNCHRONOUS': 'FULL'})
+        self.assertEqual(engine_pragmas(engine)['synchronous'], 'FULL')
+        connections = [engine.connect() for _ in range(2)]
+        for connection in connections:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.execute('PRAGMA foreign_keys').scalar(), 1)
+            self.assertEqual(connection.execute('PRAGMA busy_timeout').scalar(), 5000)
+            # FULL
+            self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 2)
+            connection.close()
+        self.assertEqual(engine_pragmas(make_engine('sqlite:///')), {})
+
+    def test_session_scope_closes_its_session(self):
+        engine = make_engine('sqlite:///' + self.temp_db)
+        with session_scope(engine=engine) as session:
+            session.query(Riders).all()
+        with session_scope(commit=True, engine=engine) as session:
+            session.add(Riders(id=1))
+        stats = pool_stats(engine)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['checkins'], 2)
+
+    def test_checkout_waits_and_timeouts(self):
+        engine = create_engine('sqlite:///' + self.temp_db, poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+                               pool_timeout=0.05)
+        connection = engine.connect()
+        with self.assertRaises(TimeoutError):
+            engine.connect()
+        connection.close()
+        engine.connect().close()
+        stats = engine.pool.stats.stats
+        self.assertEqual(stats['waits'], 3)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+
+
+class TestBusyRetries(TestCase):
+
+    def busy(self):
+        return OperationalError('INSERT', {}, sqlite3.OperationalError('database is locked'))
+
+    def test_retries_until_not_busy(self):
+        calls = []
+
+        @retry_busy(backoff=0)
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise self.busy()
+            return 'written'
+
+        retries = busy_stats['retries']
+        self.assertEqual(write(), 'written')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(busy_stats['retries'], retries + 2)
+
+    def test_gives_up_and_other_errors_are_raised(self):
+        calls = []
+
+        @retry_busy(attempts=2, backoff=0)
+        def write(error):
+            calls.append(1)
+            raise error
+
+        failures = busy_stats['failures']
+        with self.assertRaises(OperationalError):
+            write(self.busy())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(busy_stats['failures'], failures + 1)
+        with self.assertRaises(OperationalError):
+            write(OperationalError('SELECT', {}, sqlite3.OperationalError('no such table: riders')))
+        self.assertEqual(len(calls), 3)
+
+
+class TestWalCheckpointer(TestCase):
+
+    def test_checkpoint_and_truncate(self):
+        temp_ = mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_)
+        temp_db = os.path.join(temp_, 'wal.db')
+        engine = make_engine('sqlite:///' + temp_db)
+        Base.metadata.create_all(engine)
+        with session_scope(commit=True, engine=engine) as session:
+            bulk_insert(session, Riders, [{'id': i} for i in range(1, 1001)])
+        checkpointer = WalCheckpointer(engine, truncate_pages=1)
+        checkpointer.checkpoint()
+        self.assertEqual(checkpointer.stats['checkpoints'], 1)
+        self.assertEqual(checkpointer.stats['truncates'], 1)
+        self.assertEqual(checkpointer.stats['wal_pages'], 0)
+        self.assertEqual(os.path.getsize(temp_db + '-wal'), 0)
+
+
+class TestMissingIndexes(DBTests):
+
+    def test_builds_indexes_missing_from_existing_db(self):
+        self.assertEqual(missing_indexes(self.test_engine), [])
+        self.cur.execute('DROP INDEX ix_rider_events_rider_datetime_id')
+        self.cur.execute('DROP INDEX ix_trackers_esn_number')
+        self.conn.commit()
+        self.assertEqual([index.name for index in missing_indexes(self.test_engine)],
+                         ['ix_rider_events_rider_datetime_id', 'ix_trackers_esn_number'])
+        self.assertEqual(create_missing_indexes(self.test_engine),
+                         ['ix_rider_events_rider_datetime_id', 'ix_trackers_esn_number'])
+        self.assertEqual(missing_indexes(self.test_engine), [])
+        self.assertEqual(create_missing_indexes(self.test_engine), [])
+
+
+class TestMissingColumns(DBTests):
+
+    def test_adds_columns_missing_from_existing_db(self):
+        self.assertEqual(missing_columns(self.test_engine), [])
+        self.cur.execute("INSERT INTO riders (id, first_name, version) VALUES (1, 'Bob', 1)")
+        # a db made before riders had versions
+        self.cur.execute('ALTER TABLE riders DROP COLUMN version')
+        self.conn.commit()
+        self.assertEqual([str(column) for column in missing_columns(self.test_engine)], ['riders.version'])
+        self.assertEqual(add_missing_columns(self.test_engine), ['riders.version'])
+        self.assertEqual(missing_columns(self.test_engine), [])
+        self.assertEqual(self.cur.execute('SELECT version FROM riders').fetchall(), [(1,)])
+        self.test_session.add(Riders(id=2))
+        self.test_session.commit()
+        self.assertEqual(self.cur.execute('SELECT version FROM riders WHERE id = 2').fetchone(), (1,))
+
+
 class TestCRUD(DBTests):
 
     def test_create(self):
@@ -403,6 +577,224 @@ class TestCRUD(DBTests):
                                      'lost_dot', 1))
 
 
+class TestBulkInsert(DBTests):
+
+    def test_bulk_insert(self):
+        rows = [
+            {'first_name': 'Bobby', 'cap_number': '1', 'category': 'male'},
+            {'first_name': 'Lyle', 'cap_number': '2', 'balance': 150},
+            {'first_name': 'Jo', 'cap_number': '3', 'category': 'pair'},
+        ]
+        self.assertEqual(bulk_insert(self.test_session, Riders, rows), 3)
+        self.test_session.commit()
+        result = self.cur.execute('SELECT first_name, cap_number, category, balance FROM riders '
+                                  'ORDER BY cap_number').fetchall()
+        # columns left out of a row keep their defaults
+        self.assertEqual(result, [('Bobby', '1', 'male', 0), ('Lyle', '2', None, 150), ('Jo', '3', 'pair', 0)])
+
+    def test_bulk_insert_no_rows(self):
+        self.assertEqual(bulk_insert(self.test_session, Riders, []), 0)
+
+
+class TestBulkUpsertLatest(DBTests):
+
+    def _position(self, tracker_id, minute, latitude):
+        return {'tracker_id': tracker_id, 'time': datetime(2019, 6, 1, 10, minute),
+                'latitude': latitude, 'longitude': 0.0}
+
+    def _stored(self):
+        return self.cur.execute('SELECT tracker_id, latitude FROM latest_positions '
+                                'ORDER BY tracker_id').fetchall()
+
+    def test_keeps_latest_per_key(self):
+        rows = [self._position(1, 5, 1.0), self._position(1, 2, 2.0), self._position(2, 1, 3.0)]
+        self.assertEqual(bulk_upsert_latest(self.test_session, LatestPositions, rows, 'tracker_id', 'time'), 2)
+        self.test_session.commit()
+        self.assertEqual(self._stored(), [(1, 1.0), (2, 3.0)])
+
+    def test_older_rows_ignored(self):
+        bulk_upsert_latest(self.test_session, LatestPositions, [self._position(1, 5, 1.0)], 'tracker_id', 'time')
+        bulk_upsert_latest(self.test_session, LatestPositions,
+                           [self._position(1, 4, 2.0), self._position(2, 4, 3.0)], 'tracker_id', 'time')
+        self.test_session.commit()
+        self.assertEqual(self._stored(), [(1, 1.0), (2, 3.0)])
+        bulk_upsert_latest(self.test_session, LatestPositions, [self._position(1, 6, 4.0)], 'tracker_id', 'time')
+        self.test_session.commit()
+        self.assertEqual(self._stored(), [(1, 4.0), (2, 3.0)])
+
+
+class TestBulkIncrement(DBTests):
+
+    def setUp(self):
+        super(TestBulkIncrement, self).setUp()
+        self.test_session.add_all([Riders(id=1, balance=100), Riders(id=2, balance=None)])
+        self.test_session.commit()
+
+    def test_returns_new_values(self):
+        new_values = bulk_increment(self.test_session, Riders, 'balance', [(1, -25), (2, 10), (1, 5), (3, 1)])
+        self.assertEqual(new_values, {1: 80, 2: 10})
+        self.assertEqual(bulk_increment(self.test_session, Riders, 'balance', [(2, 5)]), {2: 15})
+        self.assertEqual(bulk_increment(self.test_session, Riders, 'balance', []), {})
+
+    def test_not_returning_skips_read_back(self):
+        with QueryCounter(self.test_session.get_bind()) as counter:
+            self.assertIsNone(bulk_increment(self.test_session, Riders, 'balance', [(1, -25), (2, 10)],
+                                             returning=False))
+        self.assertEqual(len(counter), 1)
+        self.assertEqual(bulk_increment(self.test_session, Riders, 'balance', [(1, 0), (2, 0)]), {1: 75, 2: 10})
+
+    def test_parallel_changes_not_lost(self):
+        threads = 8
+        changes = 25
+        barrier = threading.Barrier(threads)
+        returned = []
+        errors = []
+
+        def change_deposits(delta):
+            barrier.wait()
+            for _ in range(changes):
+                session = self.TestSession()
+                try:
+                    new_value = bulk_increment(session, Riders, 'balance', [(1, delta)])[1]
+                    bulk_insert_returning_ids(session, RiderEvents, [
+                        {'rider': 1, 'event_type': 'payment_in', 'balance_change': delta}
+                    ])
+                    session.commit()
+                    returned.append(new_value)
+                except Exception as e:
+                    errors.append(e)
+                    session.rollback()
+                finally:
+                    session.close()
+
+        workers = [threading.Thread(target=change_deposits, args=(i + 1,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        balance, = self.cur.execute('SELECT balance FROM riders WHERE id = 1').fetchone()
+        ledger, count = self.cur.execute(
+            'SELECT SUM(balance_change), COUNT(*) FROM rider_events WHERE rider = 1').fetchone()
+        self.assertEqual(count, threads * changes)
+        # every change applied once, and the balance agrees with the ledger
+        self.assertEqual(balance, 100 + changes * threads * (threads + 1) // 2)
+        self.assertEqual(balance, 100 + ledger)
+        # deltas are positive, so each change returning its own result gives distinct values
+        self.assertEqual(len(set(returned)), threads * changes)
+
+
+class TestPatch(DBTests):
+
+    def setUp(self):
+        super(TestPatch, self).setUp()
+        self.test_session.add(Riders(id=1, first_name='Bob', email='hello@email.com', category='male'))
+        self.test_session.commit()
+        self.test_session.close()
+
+    def test_sets_fields_and_bumps_version(self):
+        rider = patch_row(self.test_session, Riders, 1, {'first_name': 'Rob', 'email': None})
+        self.assertEqual((rider.id, rider.first_name, rider.email), (1, 'Rob', None))
+        self.test_session.commit()
+        self.assertEqual(self.cur.execute('SELECT first_name, email, category, version FROM riders').fetchall(),
+                         [('Rob', None, 'male', 2)])
+
+    def test_held_row_is_updated_then_loaded(self):
+        held = self.test_session.query(Riders).get(1)
+        with QueryCounter(self.test_session.get_bind()) as counter:
+            rider = patch_row(self.test_session, Riders, 1, {'cap_number': '7'})
+            self.assertEqual((rider.cap_number, rider.version), ('7', 2))
+        self.assertEqual(len(counter), 2)
+        self.assertTrue(counter.statements[0].startswith('UPDATE riders'))
+        self.assertIs(rider, held)
+
+    def test_loads_with_options(self):
+        rider = patch_row(self.test_session, Riders, 1, {'cap_number': '7'},
+                          options=[selectinload(Riders.notes)])
+        self.assertIn('notes', inspect(rider).dict)
+
+    def test_empty_patch_and_missing_row(self):
+        self.assertEqual(patch_row(self.test_session, Riders, 1, {}).first_name, 'Bob')
+        self.assertFalse(self.test_session.dirty)
+        with QueryCounter(self.test_session.get_bind()) as counter:
+            self.assertIsNone(patch_row(self.test_session, Riders, 2, {'first_name': 'Rob'}))
+        # stops at the update
+        self.assertEqual(len(counter), 1)
+
+
+class TestGetPage(DBTests):
+
+    def setUp(self):
+        super(TestGetPage, self).setUp()
+        # ids with gaps, as left behind by deletes
+        for id_, cap_number in ((1, '30'), (2, '10'), (5, '20'), (9, '10'), (15, None), (16, '40')):
+            self.test_session.add(Riders(id=id_, cap_number=cap_number))
+        self.test_session.commit()
+
+    def _all_pages(self, limit, sort='id'):
+        pages = []
+        data, cursor = get_page(self.test_session, Riders, limit, sort=sort)
+        pages.append([rider.id for rider in data])
+        while cursor is not None:
+            data, cursor = get_page(self.test_session, Riders, limit, sort=sort, cursor=cursor)
+            pages.append([rider.id for rider in data])
+        return pages
+
+    def test_full_pages_across_id_gaps(self):
+        self.assertEqual(self._all_pages(2), [[1, 2], [5, 9], [15, 16]])
+
+    def test_last_page_has_no_cursor(self):
+        data, cursor = get_page(self.test_session, Riders, 10)
+        self.assertEqual(len(data), 6)
+        self.assertIsNone(cursor)
+
+    def test_sort_by_other_key(self):
+        # null cap numbers first, ties broken by id
+        self.assertEqual(self._all_pages(2, sort='cap_number'), [[15, 2], [9, 5], [1, 16]])
+
+    def test_sort_with_nulls_last(self):
+        # as on postgres, whose indexes keep NULLs after other values
+        self.test_session.add(Riders(id=20, cap_number=None))
+        with patch('tracker.db_interactions._nulls_last', return_value=True):
+            self.assertEqual(self._all_pages(2, sort='cap_number'), [[2, 9], [5, 1], [16, 15], [20]])
+
+    def test_start(self):
+        data, cursor = get_page(self.test_session, Riders, 2, start=3)
+        self.assertEqual([rider.id for rider in data], [5, 9])
+
+    def test_empty_db(self):
+        self.test_session.query(Riders).delete()
+        self.assertEqual(get_page(self.test_session, Riders, 2), ([], None))
+
+    def test_cursor_for_other_sort_rejected(self):
+        data, cursor = get_page(self.test_session, Riders, 2, sort='cap_number')
+        with self.assertRaises(ValueError):
+            get_page(self.test_session, Riders, 2, cursor=cursor)
+        with self.assertRaises(ValueError):
+            get_page(self.test_session, Riders, 2, cursor='nonsense')
+
+    def test_decode_date_cursor(self):
+        data, cursor = get_page(self.test_session, Trackers, 1, sort='last_test_date')
+        self.assertIsNone(cursor)
+        self.test_session.add_all([
+            Trackers(id=1, last_test_date=date(2018, 1, 1)),
+            Trackers(id=2, last_test_date=date(2017, 1, 1)),
+        ])
+        self.test_session.commit()
+        data, cursor = get_page(self.test_session, Trackers, 1, sort='last_test_date')
+        self.assertEqual(decode_cursor(cursor, 'last_test_date', Trackers.last_test_date),
+                         (date(2017, 1, 1), 2))
+        data, cursor = get_page(self.test_session, Trackers, 1, sort='last_test_date', cursor=cursor)
+        self.assertEqual(data[0].id, 1)
+
+    def test_malformed_cursor_values_rejected(self):
+        for value in (5, [2018], '2018-13-01'):
+            with self.assertRaises(ValueError):
+                decode_cursor(encode_cursor('last_test_date', value, 1), 'last_test_date', Trackers.last_test_date)
+        with self.assertRaises(ValueError):
+            decode_cursor(encode_cursor('id', 'one', 1), 'id', Riders.id)
+
+
 class TestCRUDUsingContextMgr(DBTests):
 
     def setUp(self):
@@ -414,6 +806,10 @@ class TestCRUDUsingContextMgr(DBTests):
         super(TestCRUDUsingContextMgr, self).tearDown()
         del os.environ['DB_TYPE']
         del os.environ['DB_URI']
+        # session_scope writes to the module's in-memory db, which later tests expect empty
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
 
     def test_insert_multiple_rows_one_commit(self):
         riders = [{'id': 1}, {'id': 2}, {'id': 3}]
@@ -0,0 +1,87 @@
+from unittest import TestCase
+
+from tracker import db_interactions as db
+from tracker.db_interactions import session_scope, Base
+from tracker.esn_index import EsnIndex
+from tracker.models import Riders, RiderAssignment, Trackers
+
+
+class TestEsnIndex(TestCase):
+
+    def setUp(self):
+        Base.metadata.create_all(db.engine)
+        self.index = EsnIndex()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider'))
+            session.add(RiderAssignment(id=1, rider=1))
+            session.add(Trackers(id=1, esn_number='ESN1', rider_assigned=1))
+            session.add(Trackers(id=2, esn_number='ESN2'))
+
+    def tearDown(self):
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def test_lookup_loads_misses_then_hits(self):
+        with session_scope() as session:
+            self.assertEqual(self.index.lookup(session, ['ESN1', 'ESN2', 'NOPE']),
+                             {'ESN1': (1, 1), 'ESN2': (2, None)})
+            self.assertEqual(self.index.lookup(session, ['ESN1']), {'ESN1': (1, 1)})
+        self.assertEqual(self.index.stats['hits'], 1)
+        self.assertEqual(self.index.stats['misses'], 3)
+        self.assertEqual(len(self.index), 2)
+
+    def test_changed_reloads_after_commit(self):
+        with session_scope() as session:
+            self.index.lookup(session, ['ESN1', 'ESN2'])
+        with session_scope(commit=True) as session:
+            session.query(Trackers).filter(Trackers.id == 2).update({'esn_number': 'ESN3'})
+            session.query(Trackers).filter(Trackers.id == 1).update({'rider_assigned': None})
+            self.index.changed(session, [1, 2])
+        with session_scope() as session:
+            self.assertEqual(self.index.lookup(session, ['ESN1', 'ESN2', 'ESN3']),
+                             {'ESN1': (1, None), 'ESN3': (2, None)})
+
+    def test_changed_ignored_on_rollback(self):
+        with session_scope() as session:
+            self.index.lookup(session, ['ESN2'])
+        with self.assertRaises(RuntimeError):
+            with session_scope(commit=True) as session:
+                session.query(Trackers).filter(Trackers.id == 2).update({'esn_number': 'ESN3'})
+                self.index.changed(session, [2])
+                raise RuntimeError
+        self.assertEqual(self.index.stats['reloads'], 0)
+        with session_scope() as session:
+            self.assertEqual(self.index.lookup(session, ['ESN2']), {'ESN2': (2, None)})
+
+    def test_assigned_sets_entries_after_commit(self):
+        with session_scope() as session:
+            self.index.lookup(session, ['ESN1', 'ESN2'])
+        with session_scope(commit=True) as session:
+            session.query(Trackers).filter(Trackers.id == 1).update({'rider_assigned': None})
+            self.index.assigned(session, {1: ('ESN1', None), 2: ('ESN2', 1)})
+            # a tracker changed otherwise is reloaded
+            self.index.changed(session, [2])
+            self.assertEqual(self.index.lookup(session, ['ESN1']), {'ESN1': (1, 1)})
+        self.assertEqual(self.index.stats['reloads'], 1)
+        with session_scope() as session:
+            self.assertEqual(self.index.lookup(session, ['ESN1', 'ESN2']), {'ESN1': (1, None), 'ESN2': (2, None)})
+
+    def test_listeners_added_once_per_session(self):
+        with session_scope() as session:
+            for end in (session.commit, session.rollback, session.commit, session.commit):
+                self.index.changed(session, [2])
+                end()
+            self.assertEqual((len(session.dispatch.after_commit), len(session.dispatch.after_soft_rollback)),
+                             (1, 1))
+        self.assertEqual(self.index.stats['reloads'], 3)
+
+    def test_install_reloads_orm_writes(self):
+        self.index.install()
+        self.addCleanup(self.index.uninstall)
+        with session_scope(commit=True) as session:
+            session.add(Trackers(id=3, esn_number='ESN4'))
+        self.assertEqual(len(self.index), 1)
+        with session_scope() as session:
+            self.assertEqual(self.index.lookup(session, ['ESN4']), {'ESN4': (3, None)})
+        self.assertEqual(self.index.stats['misses'], 0)
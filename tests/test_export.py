@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from unittest import TestCase
+
+from tracker import db_interactions as db
+from tracker.db_interactions import session_scope, Base
+from tracker import export
+from tracker.models import Riders, RiderEvents, Trackers
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        Base.metadata.create_all(db.engine)
+        with session_scope(commit=True) as session:
+            db.bulk_insert(session, Riders, [
+                {'id': i, 'first_name': 'Rider "%d"' % i, 'category': 'female', 'balance': 1.5}
+                for i in range(1, 8)
+            ])
+            db.bulk_insert(session, RiderEvents, [
+                {'id': 1, 'rider': 1, 'event_type': 'payment_in', 'datetime': datetime(2019, 7, 27, 22)},
+            ])
+            db.bulk_insert(session, Trackers, [{'id': 1, 'last_test': date(2019, 1, 2)}])
+
+    def tearDown(self):
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def _export(self, dataset, format_, batch_size=3):
+        with session_scope() as session:
+            chunks = list(export.export(session, dataset, format_, batch_size))
+            session.close()
+        return chunks
+
+    def test_ndjson_in_batches(self):
+        chunks = self._export('riders', 'ndjson')
+        # 7 rows in batches of 3
+        self.assertEqual(len(chunks), 3)
+        rows = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual([row['id'] for row in rows], list(range(1, 8)))
+        self.assertEqual(rows[0]['first_name'], 'Rider "1"')
+        self.assertEqual(rows[0]['category'], 'female')
+        self.assertEqual(rows[0]['balance'], 1.5)
+        self.assertIsNone(rows[0]['email'])
+
+    def test_ndjson_dates_and_enums(self):
+        event = json.loads(b''.join(self._export('rider_events', 'ndjson')))
+        self.assertEqual(event['event_type'], 'payment_in')
+        self.assertEqual(event['datetime'], '2019-07-27T22:00:00')
+        tracker = json.loads(b''.join(self._export('trackers', 'ndjson')))
+        self.assertEqual(tracker['last_test'], '2019-01-02')
+
+    def test_csv(self):
+        body = b''.join(self._export('riders', 'csv')).decode()
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[6]['id'], '7')
+        self.assertEqual(rows[0]['first_name'], 'Rider "1"')
+        self.assertEqual(rows[0]['email'], '')
+
+    def test_empty_csv_has_header(self):
+        self.assertEqual(b''.join(self._export('tracker_notes', 'csv')).decode().strip(),
+                         'id,tracker,datetime,notes,user,event')
+        self.assertEqual(self._export('tracker_notes', 'ndjson'), [])
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self._export('users', 'csv')
+        with self.assertRaises(ValueError):
+            self._export('riders', 'xml')
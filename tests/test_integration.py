@@ -1,17 +1,45 @@
 # Use known sqlite db with correct data in it.
 # Start webserver on known port
 # Send requests and expect known responses returned
-from unittest import TestCase
-from tracker.db_interactions import session_scope, set_up_engine, Base
-from tracker.models import Riders, Trackers
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+from urllib.parse import parse_qsl, urlsplit
+
+from sqlalchemy import event
+
+from tracker import db_interactions as db
+from tracker.db_interactions import session_scope, Base
+from tracker.models import (
+    CheckpointArrivals,
+    Checkpoints,
+    Riders,
+    Trackers,
+    RiderAssignment,
+    RiderEvents,
+    RiderNotes,
+    TrackerEvents,
+    TrackerLocations,
+    TrackerNotes
+)
+from tracker import webserver
 from tracker.webserver import app
 
 class TestTrackerAssignment(TestCase):
 
     def setUp(self):
         self.test_client = app.test_client()
-        engine = set_up_engine()
-        Base.metadata.create_all(engine)
+        Base.metadata.create_all(db.engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(db.engine)
+        webserver.esn_index.clear()
 
     def test_tracker_assigned_OK(self):
         # add tracker and rider to db
@@ -26,3 +54,846 @@ class TestTrackerAssignment(TestCase):
             session.add(tracker)
             session.commit()
         self.test_client.post('/riders/1/trackers/1/addTrackerAssignment')
+
+
+class IntegrationTests(TestCase):
+    """Run requests against the in memory db of db_interactions, counting the statements sent."""
+
+    def setUp(self):
+        self.test_client = app.test_client()
+        Base.metadata.create_all(db.engine)
+        # statement counts are of the handlers themselves, TestResponseCache turns the cache on
+        webserver.response_cache.enabled = False
+        webserver.response_cache.clear()
+        # a request sending more statements than its endpoint's budget fails the test
+        self.query_budget_mode = webserver.query_budget.mode
+        webserver.query_budget.mode = 'raise'
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def tearDown(self):
+        webserver.query_budget.mode = self.query_budget_mode
+        webserver.response_cache.enabled = True
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+        webserver.esn_index.clear()
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+class TestQueryCounts(IntegrationTests):
+    """Query counts per endpoint must not grow with the page size."""
+
+    def _add_riders(self, n):
+        with session_scope(commit=True) as session:
+            for i in range(1, n + 1):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i), category='male'))
+                session.add(RiderAssignment(id=i, rider=i))
+                session.add(Trackers(id=i, esn_number=str(i), working_status='working', rider_assigned=i))
+                for j in range(2):
+                    event_id = i * 10 + j
+                    session.add(RiderEvents(id=event_id, rider=i, event_type='payment_in',
+                                            datetime=datetime(2019, 1, 1)))
+                    session.add(RiderNotes(rider=i, event=event_id, notes='note',
+                                           datetime=datetime(2019, 1, 1)))
+
+    def _queries_for(self, url):
+        self.statements = []
+        result = self.test_client.get(url)
+        self.assertEqual(result.status_code, 200)
+        return len(self.statements)
+
+    def test_get_riders_flat(self):
+        self._add_riders(12)
+        small_page = self._queries_for('/riders?limit=2')
+        large_page = self._queries_for('/riders?limit=12')
+        self.assertEqual(small_page, large_page)
+        # riders, notes, events with their notes, assignments with trackers
+        self.assertEqual(large_page, 5)
+
+    def test_get_trackers_flat(self):
+        self._add_riders(12)
+        small_page = self._queries_for('/trackers?limit=2')
+        large_page = self._queries_for('/trackers?limit=12')
+        self.assertEqual(small_page, large_page)
+        # trackers, their riders
+        self.assertEqual(large_page, 2)
+
+    def test_get_rider_nested(self):
+        self._add_riders(1)
+        result = self.test_client.get('/riders/1')
+        self.assertEqual(result.json['trackers_assigned'],
+                         [{'id': 1, 'esnNumber': '1', 'workingStatus': 'working'}])
+        self.assertEqual(len(result.json['events']), 2)
+        self.assertEqual(result.json['category'], 'male')
+        self.assertEqual(self._queries_for('/riders/1'), 5)
+
+
+class TestConcurrentDeposits(TestCase):
+    """Assignments made by concurrent requests on a sqlite file, as the app runs in production."""
+
+    def setUp(self):
+        self.temp_ = mkdtemp()
+        self.engine = db.make_engine('sqlite:///' + os.path.join(self.temp_, 'deposits.db'))
+        Base.metadata.create_all(self.engine)
+        with session_scope(commit=True, engine=self.engine) as session:
+            session.add(Riders(id=1, balance=0))
+            for tracker_id in range(1, 5):
+                session.add(Trackers(id=tracker_id))
+        self.app_engine, db.engine = db.engine, self.engine
+        webserver.response_cache.enabled = False
+        webserver.esn_index.clear()
+
+    def tearDown(self):
+        db.engine = self.app_engine
+        webserver.response_cache.enabled = True
+        webserver.esn_index.clear()
+        self.engine.dispose()
+        shutil.rmtree(self.temp_)
+
+    def test_balance_is_sum_of_ledger(self):
+        changes = 10
+        barrier = threading.Barrier(4)
+        statuses = []
+
+        def change_deposits(tracker_id):
+            test_client = app.test_client()
+            barrier.wait()
+            # each tracker is assigned and returned, then assigned again for good
+            for action in ['addTrackerAssignment', 'removeTrackerAssignment'] * changes + ['addTrackerAssignment']:
+                result = test_client.post('/riders/1/trackers/%d/%s' % (tracker_id, action),
+                                          json={'depositAmount': tracker_id})
+                statuses.append(result.status_code)
+
+        workers = [threading.Thread(target=change_deposits, args=(tracker_id,)) for tracker_id in range(1, 5)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(set(statuses), {200})
+        with session_scope(engine=self.engine) as session:
+            balance = session.query(Riders.balance).filter(Riders.id == 1).scalar()
+            ledger = [change for change, in session.query(RiderEvents.balance_change).filter(RiderEvents.rider == 1)]
+        self.assertEqual(len(ledger), 4 * (2 * changes + 1))
+        self.assertEqual(balance, sum(ledger))
+        self.assertEqual(balance, -(1 + 2 + 3 + 4))
+
+
+class TestBatchTrackerAssignment(IntegrationTests):
+
+    def setUp(self):
+        super(TestBatchTrackerAssignment, self).setUp()
+        with session_scope(commit=True) as session:
+            for i in range(1, 13):
+                session.add(Riders(id=i, first_name='Rider', balance=100))
+                session.add(Trackers(id=i, esn_number=str(i), working_status='working'))
+
+    def test_batch_assignment(self):
+        result = self.test_client.post('/riders/trackers/addTrackerAssignment', json=[
+            {'riderId': 1, 'trackerId': 1, 'depositAmount': 50, 'notes': 'Paid cash'},
+            {'riderId': 2, 'trackerId': 2, 'depositAmount': 50},
+            {'riderId': 1, 'trackerId': 3, 'depositAmount': 25},
+            {'riderId': 99, 'trackerId': 4},
+            {'riderId': 3, 'trackerId': 1},
+            {'riderId': 3},
+        ])
+        self.assertEqual(result.status_code, 200)
+        results = result.json['results']
+        self.assertEqual(results[0], {
+            'id': 1,
+            'depositBalance': 25,
+            'trackers_assigned': [
+                {'id': 1, 'esnNumber': '1', 'workingStatus': 'working'},
+                {'id': 3, 'esnNumber': '3', 'workingStatus': 'working'},
+            ]
+        })
+        self.assertEqual(results[1]['depositBalance'], 50)
+        self.assertEqual(results[2], results[0])
+        self.assertEqual(results[3], {'status': 404, 'error': 'Rider not found'})
+        self.assertEqual(results[4], {'status': 409, 'error': 'Tracker changed more than once in one request'})
+        self.assertEqual(results[5]['status'], 400)
+        with session_scope() as session:
+            self.assertEqual(session.query(RiderEvents).count(), 3)
+            self.assertEqual(session.query(TrackerEvents).count(), 3)
+            self.assertEqual(session.query(RiderNotes).one().notes, 'Paid cash')
+            self.assertEqual(session.query(TrackerNotes).one().notes, 'Paid cash')
+            self.assertEqual(session.query(Trackers).get(2).rider.id, 2)
+            self.assertIsNone(session.query(Trackers).get(4).rider)
+
+    def _queries_for_batch(self, n, offset):
+        self.statements = []
+        result = self.test_client.post('/riders/trackers/addTrackerAssignment', json=[
+            {'riderId': i, 'trackerId': i, 'depositAmount': 10, 'notes': 'Paid'}
+            for i in range(offset + 1, offset + n + 1)
+        ])
+        self.assertEqual(result.status_code, 200)
+        return len(self.statements)
+
+    def test_batch_statements_flat(self):
+        self.assertEqual(self._queries_for_batch(2, 0), self._queries_for_batch(10, 2))
+
+    def test_add_and_remove_assignment(self):
+        result = self.test_client.post('/riders/1/trackers/1/addTrackerAssignment',
+                                       json={'depositAmount': 50, 'notes': 'Paid'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['depositBalance'], 50)
+        self.assertEqual(len(result.json['trackers_assigned']), 1)
+        result = self.test_client.post('/riders/2/trackers/1/addTrackerAssignment', json={})
+        self.assertEqual(result.status_code, 409)
+        result = self.test_client.post('/riders/2/trackers/1/removeTrackerAssignment', json={})
+        self.assertEqual(result.status_code, 409)
+        result = self.test_client.post('/riders/1/trackers/1/removeTrackerAssignment',
+                                       json={'depositAmount': 50})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json, {'id': 1, 'depositBalance': 100, 'trackers_assigned': []})
+        with session_scope() as session:
+            self.assertEqual(session.query(RiderAssignment).count(), 0)
+            # the ledger records signed changes that add up to the balance change
+            self.assertEqual(
+                [change for change, in session.query(RiderEvents.balance_change).order_by(RiderEvents.id)],
+                [-50, 50]
+            )
+
+    def test_assignment_statements(self):
+        reloads = webserver.esn_index.stats['reloads']
+        self.statements = []
+        self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={'depositAmount': 50})
+        # checks, assignment, tracker, events and balance, then the balance read back
+        self.assertEqual(len(self.statements), 8)
+        # the ESN entry is set from the tracker checked, without reloading it
+        self.assertEqual(webserver.esn_index.stats['reloads'], reloads)
+        with session_scope() as session:
+            self.assertEqual(webserver.esn_index.lookup(session, ['1']), {'1': (1, 1)})
+        self.statements = []
+        self.test_client.post('/riders/1/trackers/1/removeTrackerAssignment',
+                              json={'depositAmount': 50, 'notes': 'Returned'})
+        self.assertEqual(len(self.statements), webserver.QUERY_BUDGETS['tracker_assignment_remove'])
+
+    def test_assignment_events_in_utc(self):
+        # a local time far from utc, events compare with checkpoint arrivals and since/until in utc
+        environ_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Asia/Tokyo'
+        time.tzset()
+        try:
+            before = datetime.utcnow()
+            self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={'depositAmount': 50})
+            after = datetime.utcnow()
+        finally:
+            if environ_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = environ_tz
+            time.tzset()
+        with session_scope() as session:
+            for model in (RiderEvents, TrackerEvents):
+                stamped = session.query(model.datetime).scalar()
+                self.assertTrue(before.replace(microsecond=0) <= stamped <= after, (model, stamped))
+
+    def test_assignment_body_must_be_an_object(self):
+        result = self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json=[1])
+        self.assertEqual(result.status_code, 400)
+        with session_scope() as session:
+            self.assertEqual(session.query(RiderAssignment).count(), 0)
+
+
+class TestPositionIngest(IntegrationTests):
+
+    def setUp(self):
+        super(TestPositionIngest, self).setUp()
+        app.config['POSITION_BACKGROUND_FLUSH'] = False
+        webserver.position_writer.flush()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider'))
+            session.add(RiderAssignment(id=1, rider=1))
+            session.add(Trackers(id=1, esn_number='ESN1', rider_assigned=1))
+            session.add(Trackers(id=2, esn_number='ESN2'))
+
+    def _fix(self, esn, second):
+        return {'esn': esn, 'latitude': 51.5, 'longitude': -0.1,
+                'time': '2019-06-01T10:00:%02dZ' % second}
+
+    def test_fixes_buffered_and_written(self):
+        result = self.test_client.post('/positions', json=[
+            self._fix('ESN1', 0),
+            self._fix('ESN2', 0),
+            self._fix('UNKNOWN', 0),
+            {'esn': 'ESN1', 'latitude': 91, 'longitude': 0, 'time': '2019-06-01T10:00:00Z'},
+            self._fix('ESN1', 0),
+        ])
+        self.assertEqual(result.status_code, 202)
+        self.assertEqual(result.json['accepted'], 2)
+        self.assertEqual([error['index'] for error in result.json['errors']], [2, 3, 4])
+        with session_scope() as session:
+            self.assertEqual(session.query(TrackerLocations).count(), 0)
+        self.assertEqual(webserver.position_writer.flush(), 2)
+        with session_scope() as session:
+            rows = session.query(TrackerLocations).order_by(TrackerLocations.tracker).all()
+            self.assertEqual([(row.tracker, row.rider) for row in rows], [(1, 1), (2, None)])
+            self.assertEqual(rows[0].time, datetime(2019, 6, 1, 10, 0, 0))
+
+    def test_repeated_fix_after_flush_ignored(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', 0)])
+        webserver.position_writer.flush()
+        self.test_client.post('/positions', json=[self._fix('ESN1', 0), self._fix('ESN1', 1)])
+        self.assertEqual(webserver.position_writer.flush(), 1)
+        with session_scope() as session:
+            self.assertEqual(session.query(TrackerLocations).count(), 2)
+
+    def test_failed_group_written_again(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', 0), self._fix('ESN2', 0)])
+        stats = dict(webserver.position_writer.stats)
+        with mock.patch('tracker.ingest.db.bulk_insert_ignore', side_effect=RuntimeError):
+            with self.assertLogs('tracker.ingest', 'ERROR'):
+                self.assertEqual(webserver.position_writer.flush(), 0)
+        self.assertEqual(webserver.position_writer.stats['failed'], stats['failed'] + 2)
+        self.assertEqual(webserver.position_writer.stats['retrying'], 2)
+        self.assertEqual(webserver.position_writer.flush(), 2)
+        self.assertEqual(webserver.position_writer.stats['retrying'], 0)
+        with session_scope() as session:
+            self.assertEqual(session.query(TrackerLocations).count(), 2)
+
+    def test_failed_group_dropped_after_max_attempts(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', 0)])
+        dropped = webserver.position_writer.stats['dropped']
+        with mock.patch('tracker.ingest.db.bulk_insert_ignore', side_effect=RuntimeError):
+            with self.assertLogs('tracker.ingest', 'ERROR'):
+                for _ in range(webserver.position_writer.max_attempts):
+                    webserver.position_writer.flush()
+        self.assertEqual(webserver.position_writer.stats['dropped'], dropped + 1)
+        self.assertEqual(webserver.position_writer.stats['retrying'], 0)
+        self.assertEqual(webserver.position_writer.flush(), 0)
+
+    def test_fixes_already_written_counted_as_duplicates(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', 0)])
+        webserver.position_writer.flush()
+        duplicates = webserver.position_writer.stats['duplicates']
+        result = self.test_client.post('/positions', json=[self._fix('ESN1', 0)])
+        self.assertEqual(result.json['accepted'], 1)
+        self.assertEqual(webserver.position_writer.flush(), 0)
+        self.assertEqual(webserver.position_writer.stats['duplicates'], duplicates + 1)
+
+    def test_one_insert_per_group(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', i) for i in range(20)])
+        self.statements = []
+        webserver.position_writer.flush()
+        inserts = [s for s in self.statements if 'INSERT' in s and 'tracker_locations' in s]
+        self.assertEqual(len(inserts), 1)
+
+    def test_not_a_list(self):
+        result = self.test_client.post('/positions', json={'esn': 'ESN1'})
+        self.assertEqual(result.status_code, 400)
+
+    def test_latest_positions(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', 5), self._fix('ESN1', 1),
+                                                  self._fix('ESN2', 0)])
+        webserver.position_writer.flush()
+        # an older fix arriving late does not move the latest position back
+        self.test_client.post('/positions', json=[self._fix('ESN1', 3), self._fix('ESN2', 9)])
+        webserver.position_writer.flush()
+        result = self.test_client.get('/positions/latest')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            [(position['trackerId'], position['riderId'], position['time'])
+             for position in result.json['positions']],
+            [(1, 1, '2019-06-01T10:00:05+00:00'), (2, None, '2019-06-01T10:00:09+00:00')]
+        )
+        result = self.test_client.get('/positions/latest?rider=1')
+        self.assertEqual([position['trackerId'] for position in result.json['positions']], [1])
+
+    def test_latest_positions_query_flat(self):
+        self.test_client.post('/positions', json=[self._fix('ESN1', i) for i in range(20)])
+        webserver.position_writer.flush()
+        self.statements = []
+        self.test_client.get('/positions/latest')
+        self.assertEqual(len(self.statements), 1)
+        self.assertNotIn('tracker_locations', self.statements[0])
+
+
+class TestTrackersByEsn(IntegrationTests):
+
+    def setUp(self):
+        super(TestTrackersByEsn, self).setUp()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider'))
+            session.add(Trackers(id=1, esn_number='ESN1', working_status='working'))
+            session.add(Trackers(id=2, esn_number='ESN2', working_status='working'))
+
+    def test_lookup_by_esn(self):
+        result = self.test_client.get('/trackers?esn=ESN2&esn=ESN1&esn=NOPE')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([tracker['id'] for tracker in result.json['trackers']], [1, 2])
+        self.assertIsNone(result.json['next'])
+        self.assertEqual(self.test_client.get('/trackers?esn=NOPE').status_code, 204)
+
+    def test_second_lookup_served_from_index(self):
+        self.test_client.get('/trackers?esn=ESN1')
+        hits = webserver.esn_index.stats['hits']
+        self.statements = []
+        self.test_client.get('/trackers?esn=ESN1')
+        self.assertEqual(webserver.esn_index.stats['hits'], hits + 1)
+        # only the tracker and its rider are fetched
+        self.assertEqual(len(self.statements), 2)
+
+    def test_assignment_updates_index(self):
+        with session_scope() as session:
+            self.assertEqual(webserver.esn_index.lookup(session, ['ESN1']), {'ESN1': (1, None)})
+        self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={})
+        with session_scope() as session:
+            self.assertEqual(webserver.esn_index.lookup(session, ['ESN1']), {'ESN1': (1, 1)})
+        self.test_client.post('/riders/1/trackers/1/removeTrackerAssignment', json={})
+        with session_scope() as session:
+            self.assertEqual(webserver.esn_index.lookup(session, ['ESN1']), {'ESN1': (1, None)})
+
+
+class TestCheckpointArrivals(IntegrationTests):
+
+    def setUp(self):
+        super(TestCheckpointArrivals, self).setUp()
+        with session_scope(commit=True) as session:
+            for i in range(1, 6):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i)))
+        for checkpoint_id, name in ((1, 'Start'), (2, 'CP1')):
+            result = self.test_client.post('/races/%d' % checkpoint_id, json={'name': name})
+            self.assertEqual(result.status_code, 201)
+
+    def _arrive(self, rider_id, checkpoint_id, minute):
+        return self.test_client.post('/riders/%d/%d/arrival' % (rider_id, checkpoint_id),
+                                     json={'time': '2019-07-28T08:%02d:00Z' % minute})
+
+    def test_arrivals_listed_in_order_with_counts(self):
+        for rider_id, minute in ((3, 10), (1, 30), (2, 20), (5, 40)):
+            self.assertEqual(self._arrive(rider_id, 2, minute).status_code, 200)
+        result = self._arrive(1, 1, 5)
+        self.assertEqual(result.json, [
+            {'checkPoint': 1, 'timeSeen': '2019-07-28T08:05:00+00:00'},
+            {'checkPoint': 2, 'timeSeen': '2019-07-28T08:30:00+00:00'},
+        ])
+        pages = []
+        url = '/races/2?limit=3'
+        while url:
+            result = self.test_client.get(url)
+            self.assertEqual(result.json['checkpoint'], {'id': 2, 'name': 'CP1', 'arrivals': 4})
+            pages.append([rider['id'] for rider in result.json['riders']])
+            url = result.json['next']
+        self.assertEqual(pages, [[3, 2, 1], [5]])
+        result = self.test_client.get('/races')
+        self.assertEqual([checkpoint['arrivals'] for checkpoint in result.json['checkpoints']], [1, 4])
+        with session_scope() as session:
+            self.assertEqual(
+                session.query(RiderEvents).filter(RiderEvents.event_type == 'arrive_checkpoint').count(), 5)
+
+    def test_arrival_errors(self):
+        self.assertEqual(self._arrive(1, 1, 0).status_code, 200)
+        self.assertEqual(self._arrive(1, 1, 1).status_code, 409)
+        self.assertEqual(self._arrive(9, 1, 0).status_code, 404)
+        self.assertEqual(self._arrive(1, 9, 0).status_code, 404)
+        result = self.test_client.post('/riders/1/2/arrival', json={'time': 'soon'})
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(self.test_client.post('/races/3', json={'name': 'Start'}).status_code, 409)
+        self.assertEqual(self.test_client.get('/races/9').status_code, 404)
+        with session_scope() as session:
+            self.assertEqual(session.query(Checkpoints).get(1).arrivals, 1)
+            self.assertEqual(session.query(CheckpointArrivals).count(), 1)
+
+    def test_listing_is_a_single_query(self):
+        for rider_id in range(1, 6):
+            self._arrive(rider_id, 2, rider_id)
+        self.statements = []
+        self.test_client.get('/races/2?limit=2')
+        # the checkpoint, then one page of arrivals joined to their riders
+        self.assertEqual(len(self.statements), 2)
+
+
+class TestConditionalGet(IntegrationTests):
+
+    def setUp(self):
+        super(TestConditionalGet, self).setUp()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider', cap_number='1'))
+            session.add(Trackers(id=1, esn_number='ESN1', working_status='working'))
+
+    def _get(self, url, etag):
+        self.statements = []
+        return self.test_client.get(url, headers={'If-None-Match': '"%s"' % etag})
+
+    def test_not_modified_from_version_lookup(self):
+        for url in ('/riders/1', '/trackers/1'):
+            result = self.test_client.get(url)
+            self.assertEqual(result.status_code, 200)
+            etag, weak = result.get_etag()
+            self.assertFalse(weak)
+            result = self._get(url, etag)
+            self.assertEqual(result.status_code, 304)
+            self.assertEqual(result.get_etag()[0], etag)
+            self.assertEqual(result.data, b'')
+            self.assertEqual(len(self.statements), 1)
+
+    def test_assignment_changes_etags(self):
+        rider_etag = self.test_client.get('/riders/1').get_etag()[0]
+        tracker_etag = self.test_client.get('/trackers/1').get_etag()[0]
+        self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={})
+        result = self._get('/riders/1', rider_etag)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(result.json['trackers_assigned']), 1)
+        result = self._get('/trackers/1', tracker_etag)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['rider']['id'], 1)
+        # the etag of a 200 matches the one the version lookup gives
+        self.assertEqual(self._get('/trackers/1', result.get_etag()[0]).status_code, 304)
+
+    def test_nested_changes_change_etags(self):
+        self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={})
+        rider_etag = self.test_client.get('/riders/1').get_etag()[0]
+        tracker_etag = self.test_client.get('/trackers/1').get_etag()[0]
+        with session_scope(commit=True) as session:
+            db.update(session, Trackers, {'esn_number': 'ESN2'}, id=1)
+        self.assertEqual(self._get('/riders/1', rider_etag).status_code, 200)
+        with session_scope(commit=True) as session:
+            db.update(session, Riders, {'first_name': 'Renamed'}, id=1)
+        self.assertEqual(self._get('/trackers/1', tracker_etag).status_code, 200)
+
+
+class TestResponseCache(IntegrationTests):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        webserver.response_cache.enabled = True
+        with session_scope(commit=True) as session:
+            for i in (1, 2):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i)))
+                session.add(Trackers(id=i, esn_number='ESN%d' % i, working_status='working'))
+
+    def _get(self, url, **kwargs):
+        self.statements = []
+        result = self.test_client.get(url, **kwargs)
+        return result, len(self.statements)
+
+    def test_repeated_reads_served_from_cache(self):
+        hits = webserver.response_cache.info()['hits']
+        for url in ('/riders/1', '/trackers/1', '/riders?limit=1', '/trackers?esn=ESN1'):
+            first, queries = self._get(url)
+            self.assertGreater(queries, 0)
+            second, queries = self._get(url)
+            self.assertEqual(queries, 0)
+            self.assertEqual(second.data, first.data)
+        # query args are part of the key
+        self.assertGreater(self._get('/riders?limit=2')[1], 0)
+        etag = self.test_client.get('/riders/1').get_etag()[0]
+        result, queries = self._get('/riders/1', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual((result.status_code, queries), (304, 0))
+        stats = self.test_client.get('/cache/stats').json
+        self.assertEqual(stats['hits'] - hits, 6)
+
+    def test_assignment_invalidates_affected_entities(self):
+        urls = ('/riders/1', '/riders/2', '/trackers/1', '/trackers/2', '/riders', '/trackers')
+        for url in urls:
+            self.test_client.get(url)
+        self.test_client.post('/riders/1/trackers/1/addTrackerAssignment', json={})
+        requeried = [url for url in urls if self._get(url)[1] > 0]
+        self.assertEqual(requeried, ['/riders/1', '/trackers/1', '/riders', '/trackers'])
+        self.assertEqual(self.test_client.get('/trackers/1').json['rider']['id'], 1)
+
+    def test_created_rider_invalidates_listing(self):
+        self.assertEqual(len(self.test_client.get('/riders').json['riders']), 2)
+        result = self.test_client.post('/riders', json={'firstName': 'New', 'lastName': 'Rider', 'capNumber': '3'})
+        self.assertEqual(result.status_code, 201)
+        self.assertEqual(result.json, self.test_client.get('/riders/%d' % result.json['id']).json)
+        riders, queries = self._get('/riders')
+        self.assertGreater(queries, 0)
+        self.assertEqual([rider['firstName'] for rider in riders.json['riders']], ['Rider', 'Rider', 'New'])
+
+    def test_lru_eviction(self):
+        backend = webserver.response_cache.backend
+        max_bytes = backend.max_bytes
+        self.test_client.get('/riders/1')
+        # room for two cached riders
+        backend.max_bytes = backend.info()['bytes'] * 2
+        evictions = backend.info()['evictions']
+        try:
+            webserver.response_cache.clear()
+            self.test_client.get('/riders/1')
+            self.test_client.get('/riders/2')
+            self.test_client.get('/riders/1')
+            # unknown args are part of the key, so this caches a third copy
+            self.test_client.get('/riders/1?view=desk')
+            # /riders/2 was the least recently used
+            self.assertEqual(self._get('/riders/1')[1], 0)
+            self.assertGreater(self._get('/riders/2')[1], 0)
+            self.assertGreater(backend.info()['evictions'], evictions)
+        finally:
+            backend.max_bytes = max_bytes
+
+
+class TestStreamedPages(IntegrationTests):
+    """Streamed pages have the same body as buffered ones."""
+
+    _add_riders = TestQueryCounts._add_riders
+    _queries_for = TestQueryCounts._queries_for
+
+    def test_same_body_as_buffered(self):
+        self._add_riders(7)
+        for url in ('/riders?limit=3', '/riders?limit=3&sort=lastName', '/riders?limit=10',
+                    '/trackers?limit=3', '/trackers?limit=10&sort=lastTestDate'):
+            buffered = self.test_client.get(url)
+            streamed = self.test_client.get(url + '&stream=1')
+            self.assertEqual(streamed.status_code, 200)
+            self.assertTrue(streamed.is_streamed)
+            streamed, buffered = json.loads(streamed.data), buffered.json
+            # but for the next page, which streams too
+            self.assertEqual(self._args(streamed.pop('next')), self._args(buffered.pop('next'), stream='1'))
+            self.assertEqual(streamed, buffered)
+
+    @staticmethod
+    def _args(url, **more):
+        return url and dict(parse_qsl(urlsplit(url).query), **more)
+
+    def test_follows_next(self):
+        self._add_riders(7)
+        ids = []
+        url = '/riders?limit=3&stream=1'
+        while url:
+            result = self.test_client.get(url).json
+            ids.extend(rider['id'] for rider in result['riders'])
+            url = result['next']
+        self.assertEqual(ids, list(range(1, 8)))
+
+    def test_query_count_flat(self):
+        self._add_riders(12)
+        self.assertEqual(self._queries_for('/riders?limit=2&stream=1'),
+                         self._queries_for('/riders?limit=12&stream=1'))
+
+    def test_gzip(self):
+        self._add_riders(3)
+        buffered = self.test_client.get('/riders')
+        result = self.test_client.get('/riders?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        self.assertEqual(gzip.decompress(result.data), buffered.data)
+
+    def test_empty(self):
+        self.assertEqual(self.test_client.get('/riders?stream=1').status_code, 204)
+        self._add_riders(1)
+        self.assertEqual(self.test_client.get('/riders?stream=1&start=5').status_code, 416)
+        self.assertEqual(self.test_client.get('/riders?stream=1&cursor=x').status_code, 400)
+
+    def test_malformed_cursor_value(self):
+        self._add_riders(1)
+        cursor = db.encode_cursor('last_test_date', 5, 1)
+        self.assertEqual(self.test_client.get('/trackers?sort=lastTestDate&cursor=' + cursor).status_code, 400)
+        self.assertEqual(self.test_client.get('/trackers?sort=lastTestDate&stream=1&cursor=' + cursor).status_code,
+                         400)
+
+
+class TestExport(IntegrationTests):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        with session_scope(commit=True) as session:
+            for i in range(1, 4):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i)))
+
+    def test_ndjson(self):
+        result = self.test_client.get('/export/riders')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.is_streamed)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        self.assertEqual(result.headers['Content-Disposition'], 'attachment; filename=riders.ndjson')
+        lines = result.data.splitlines()
+        self.assertEqual([json.loads(line)['cap_number'] for line in lines], ['1', '2', '3'])
+
+    def test_csv_gzipped(self):
+        result = self.test_client.get('/export/riders?format=csv', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result.mimetype, 'text/csv')
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(result.data).splitlines()), 4)
+
+    def test_invalid(self):
+        self.assertEqual(self.test_client.get('/export/users').status_code, 404)
+        self.assertEqual(self.test_client.get('/export/riders?format=xml').status_code, 400)
+
+
+class TestEventTimelines(IntegrationTests):
+
+    def setUp(self):
+        super(TestEventTimelines, self).setUp()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider'))
+            session.add(Riders(id=2, first_name='Other'))
+            session.add(Trackers(id=1, esn_number='ESN1'))
+            for i in range(1, 8):
+                session.add(RiderEvents(id=i, rider=1, datetime=datetime(2019, 7, 27, i),
+                                        event_type='payment_in' if i % 2 else 'arrive_checkpoint'))
+                session.add(TrackerEvents(id=i, tracker=1, datetime=datetime(2019, 7, 27, i),
+                                          event_type='tested_OK'))
+            session.add(RiderEvents(id=8, rider=2, datetime=datetime(2019, 7, 27, 1), event_type='payment_in'))
+            session.add(RiderNotes(rider=1, event=1, notes='note', datetime=datetime(2019, 7, 27, 1)))
+
+    def _pages(self, url):
+        ids = []
+        while url:
+            result = self.test_client.get(url)
+            self.assertEqual(result.status_code, 200)
+            ids.extend(event['id'] for event in result.json['events'])
+            url = result.json['next']
+        return ids
+
+    def test_pages_in_time_order(self):
+        self.assertEqual(self._pages('/riders/1/events?limit=3'), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(self._pages('/trackers/1/events?limit=2'), [1, 2, 3, 4, 5, 6, 7])
+        first = self.test_client.get('/riders/1/events?limit=1').json['events'][0]
+        self.assertEqual(first['notes'], [1])
+        self.assertEqual(first['event_type'], 'payment_in')
+
+    def test_filters_carried_to_next_page(self):
+        url = '/riders/1/events?limit=1&since=2019-07-27T02:00:00Z&until=2019-07-27T07:00:00&type=payment_in'
+        self.assertEqual(self._pages(url), [3, 5])
+        url = '/riders/1/events?type=payment_in&type=arrive_checkpoint&since=2019-07-27T06:00:00'
+        self.assertEqual(self._pages(url), [6, 7])
+
+    def test_invalid(self):
+        self.assertEqual(self.test_client.get('/riders/3/events').status_code, 404)
+        self.assertEqual(self.test_client.get('/riders/1/events?type=nope').status_code, 400)
+        self.assertEqual(self.test_client.get('/riders/1/events?since=yesterday').status_code, 400)
+        self.assertEqual(self.test_client.get('/riders/1/events?cursor=x').status_code, 400)
+        self.assertEqual(self.test_client.get('/riders/1?exclude=trackers_assigned').status_code, 400)
+
+    def test_detail_without_history(self):
+        full = self.test_client.get('/riders/1').json
+        self.assertEqual(len(full['events']), 7)
+        self.statements = []
+        lean = self.test_client.get('/riders/1?exclude=events,notes').json
+        self.assertNotIn('events', lean)
+        self.assertNotIn('notes', lean)
+        self.assertEqual(lean['firstName'], 'Rider')
+        # the rider and its trackers
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn('notes', self.test_client.get('/riders/1?exclude=events').json)
+
+
+class TestRiderSearch(IntegrationTests):
+
+    def setUp(self):
+        super(TestRiderSearch, self).setUp()
+        with session_scope(commit=True) as session:
+            for i, last_name in enumerate(['Smith', 'Smithers', 'Jones', 'Smit'], 1):
+                session.add(Riders(id=i, first_name='Rider', last_name=last_name, cap_number=str(i)))
+            session.add(RiderAssignment(id=1, rider=1))
+            session.add(Trackers(id=1, esn_number='ESN1', rider_assigned=1))
+
+    def test_search_pages(self):
+        result = self.test_client.get('/riders/search?q=smi&limit=2')
+        self.assertEqual(result.status_code, 200)
+        first = result.json
+        self.assertEqual(len(first['riders']), 2)
+        self.assertNotIn('events', first['riders'][0])
+        second = self.test_client.get(first['next']).json
+        self.assertIsNone(second['next'])
+        ids = [rider['id'] for rider in first['riders'] + second['riders']]
+        self.assertEqual(sorted(ids), [1, 2, 4])
+        self.assertEqual(self.test_client.get('/riders/search?q=3').json['riders'][0]['lastName'], 'Jones')
+
+    def test_flat_query_count(self):
+        self.statements = []
+        result = self.test_client.get('/riders/search?q=smi')
+        self.assertEqual(result.json['riders'][0]['trackers_assigned'][0]['esnNumber'], 'ESN1')
+        # ranked ids, riders, their trackers
+        self.assertEqual(len(self.statements), 3)
+
+    def test_new_rider_found(self):
+        webserver.response_cache.enabled = True
+        self.assertEqual(len(self.test_client.get('/riders/search?q=smi').json['riders']), 3)
+        self.test_client.post('/riders/import', json=[
+            {'firstName': 'Rider', 'lastName': 'Smithson', 'capNumber': '5'}
+        ])
+        self.assertEqual(len(self.test_client.get('/riders/search?q=smi').json['riders']), 4)
+
+    def test_invalid(self):
+        self.assertEqual(self.test_client.get('/riders/search').status_code, 400)
+        self.assertEqual(self.test_client.get('/riders/search?q=smi&cursor=x').status_code, 400)
+        cursor = db.encode_cursor('rank', -5, 1)
+        self.assertEqual(self.test_client.get('/riders/search?q=smi&cursor=' + cursor).status_code, 400)
+
+
+class TestPatch(IntegrationTests):
+
+    def setUp(self):
+        super(TestPatch, self).setUp()
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider', last_name='One', email='one@email.com',
+                               cap_number='1', category='male'))
+            session.add(RiderAssignment(id=1, rider=1))
+            session.add(Trackers(id=1, esn_number='ESN1', working_status='working', rider_assigned=1))
+            session.add(RiderEvents(id=1, rider=1, event_type='payment_in', datetime=datetime(2019, 1, 1)))
+            session.add(RiderNotes(rider=1, event=1, notes='Paid cash', datetime=datetime(2019, 1, 1)))
+
+    def test_rider_patch_is_stored_and_rendered_as_get(self):
+        self.statements = []
+        result = self.test_client.patch('/riders/1', data='{"lastName": "Uno", "email": null}',
+                                         content_type='application/merge-patch+json')
+        self.assertEqual(result.status_code, 200)
+        # the update, then the rider loaded as GET loads it
+        self.assertEqual(len(self.statements), webserver.QUERY_BUDGETS['patch_rider'])
+        rider = self.test_client.get('/riders/1').json
+        self.assertEqual((rider['lastName'], rider['email'], rider['firstName']), ('Uno', None, 'Rider'))
+        self.assertEqual([tracker['id'] for tracker in rider['trackers_assigned']], [1])
+        self.assertEqual(result.json, rider)
+
+    def test_tracker_patch_is_rendered_as_get(self):
+        result = self.test_client.patch('/trackers/1', json={'workingStatus': 'broken'})
+        self.assertEqual(result.status_code, 200)
+        tracker = self.test_client.get('/trackers/1').json
+        self.assertEqual((tracker['workingStatus'], tracker['rider']['id']), ('broken', 1))
+        self.assertEqual(result.json, tracker)
+
+    def test_patch_changes_etag_and_cached_responses(self):
+        webserver.response_cache.enabled = True
+        etag = self.test_client.get('/riders/1').headers['ETag']
+        self.test_client.patch('/riders/1', json={'capNumber': '2'})
+        result = self.test_client.get('/riders/1')
+        self.assertEqual(result.json['capNumber'], '2')
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+    def test_tracker_esn_patch_updates_index(self):
+        result = self.test_client.patch('/trackers/1', json={'esnNumber': 'ESN9', 'lastTestDate': '2019-07-01'})
+        self.assertEqual(result.json['esnNumber'], 'ESN9')
+        self.assertEqual(result.json['lastTestDate'], '2019-07-01')
+        self.assertEqual(self.test_client.get('/trackers?esn=ESN9').json['trackers'][0]['id'], 1)
+        self.assertEqual(self.test_client.get('/trackers?esn=ESN1').status_code, 204)
+
+    def test_invalid_patch_changes_nothing(self):
+        result = self.test_client.patch('/riders/1', json={'lastName': 'Uno', 'capNumber': 2})
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(self.test_client.get('/riders/1').json['lastName'], 'One')
+
+
+class TestRequestSessions(IntegrationTests):
+
+    def test_one_session_per_request_released_at_teardown(self):
+        stats = db.pool_stats()
+        with app.test_request_context('/riders'):
+            app.preprocess_request()
+            with session_scope() as first:
+                first.query(Riders).all()
+            with session_scope() as second:
+                pass
+            self.assertIs(first, second)
+            # the session's connection is held until the request ends
+            self.assertEqual(db.pool_stats()['checkins'], stats['checkins'])
+            app.do_teardown_request()
+        self.assertEqual(db.pool_stats()['checkins'], stats['checkins'] + 1)
+
+    def test_sessions_outside_requests_are_closed(self):
+        stats = db.pool_stats()
+        with session_scope() as session:
+            session.query(Riders).all()
+        self.assertEqual(db.pool_stats()['checkins'], stats['checkins'] + 1)
+
+    def test_db_stats(self):
+        self.test_client.get('/riders')
+        result = self.test_client.get('/db/stats')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['checkouts'], result.json['checkins'])
+        self.assertEqual(result.json['pool'], 'SingletonThreadPool')
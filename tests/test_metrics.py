@@ -0,0 +1,90 @@
+import re
+from unittest import TestCase
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base, session_scope
+from tracker.metrics import Histogram
+from tracker.models import Riders
+from tracker.webserver import app
+
+
+class TestHistogram(TestCase):
+
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(('a',), value)
+        self.assertEqual(histogram.render('h', ('endpoint',)), [
+            'h_bucket{endpoint="a",le="1.0"} 2',
+            'h_bucket{endpoint="a",le="5.0"} 3',
+            'h_bucket{endpoint="a",le="+Inf"} 4',
+            'h_sum{endpoint="a"} 14.5',
+            'h_count{endpoint="a"} 4',
+        ])
+
+
+class TestMetricsEndpoint(TestCase):
+
+    def setUp(self):
+        self.test_client = app.test_client()
+        Base.metadata.create_all(db.engine)
+        webserver.response_cache.enabled = False
+        webserver.metrics.clear()
+
+    def tearDown(self):
+        webserver.response_cache.enabled = True
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def _metrics(self):
+        result = self.test_client.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.content_type.startswith('text/plain; version=0.0.4'))
+        return result.data.decode()
+
+    def _value(self, text, name, **labels):
+        label_text = ','.join('%s="%s"' % item for item in labels.items())
+        match = re.search(r'^%s\{%s\} (\S+)$' % (re.escape(name), re.escape(label_text)), text, re.MULTILINE)
+        self.assertIsNotNone(match, '%s{%s} not in metrics' % (name, label_text))
+        return float(match.group(1))
+
+    def test_requests_latency_and_statements_per_endpoint(self):
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider', cap_number='1', category='male'))
+        self.test_client.get('/riders/1')
+        self.test_client.get('/riders/1')
+        self.test_client.get('/riders/2')
+        text = self._metrics()
+        self.assertEqual(self._value(
+            text, 'tracker_requests_total', endpoint='get_rider', method='GET', status='200'), 2)
+        self.assertEqual(self._value(
+            text, 'tracker_requests_total', endpoint='get_rider', method='GET', status='204'), 1)
+        self.assertEqual(self._value(
+            text, 'tracker_request_duration_seconds_count', endpoint='get_rider', method='GET'), 3)
+        self.assertEqual(self._value(
+            text, 'tracker_request_duration_seconds_bucket', endpoint='get_rider', method='GET', le='+Inf'), 3)
+        statements = self._value(text, 'tracker_sql_statements_total', endpoint='get_rider')
+        self.assertGreater(statements, 3)
+        self.assertEqual(self._value(text, 'tracker_request_sql_statements_sum', endpoint='get_rider'), statements)
+        self.assertGreater(self._value(text, 'tracker_db_seconds_total', endpoint='get_rider'), 0)
+
+    def test_streamed_statements_count_for_their_request(self):
+        with session_scope(commit=True) as session:
+            for i in range(1, 4):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i), category='male'))
+        result = self.test_client.get('/riders?stream=1&limit=2')
+        self.assertEqual(len(result.json['riders']), 2)
+        text = self._metrics()
+        self.assertEqual(self._value(text, 'tracker_request_sql_statements_count', endpoint='get_riders'), 1)
+        self.assertGreater(self._value(text, 'tracker_sql_statements_total', endpoint='get_riders'), 1)
+
+    def test_unmatched_and_component_gauges(self):
+        self.test_client.get('/nowhere')
+        text = self._metrics()
+        self.assertEqual(self._value(
+            text, 'tracker_requests_total', endpoint='unmatched', method='GET', status='404'), 1)
+        self.assertEqual(self._value(text, 'tracker_response_cache', stat='enabled'), 0)
+        self.assertIn('tracker_position_writer{stat="written"}', text)
+        self.assertIn('tracker_esn_index{stat="entries"}', text)
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base, session_scope
+from tracker.models import Riders
+from tracker.query_budget import QueryBudgetExceeded, QueryCounter, describe
+from tracker.webserver import app
+
+
+class TestQueryCounter(TestCase):
+
+    def test_counts_statements_in_block(self):
+        engine = create_engine('sqlite://')
+        engine.execute(text('SELECT 1'))
+        with QueryCounter(engine) as counter:
+            engine.execute(text('SELECT 2'))
+            engine.execute(text('SELECT 3'))
+        engine.execute(text('SELECT 4'))
+        self.assertEqual(len(counter), 2)
+        self.assertEqual(counter.statements, ['SELECT 2', 'SELECT 3'])
+
+    def test_describe_names_statements(self):
+        self.assertEqual(
+            describe('get_rider', 1, ['SELECT 1', 'SELECT\n  2']),
+            'get_rider sent 2 statements, its budget is 1:\n  1. SELECT 1\n  2. SELECT 2'
+        )
+
+
+class TestQueryBudgets(TestCase):
+
+    def setUp(self):
+        self.test_client = app.test_client()
+        Base.metadata.create_all(db.engine)
+        webserver.response_cache.enabled = False
+        self.mode = webserver.query_budget.mode
+        self.budget = webserver.QUERY_BUDGETS['get_riders']
+        with session_scope(commit=True) as session:
+            for i in range(1, 4):
+                session.add(Riders(id=i, first_name='Rider', cap_number=str(i), category='male'))
+
+    def tearDown(self):
+        webserver.query_budget.mode = self.mode
+        webserver.QUERY_BUDGETS['get_riders'] = self.budget
+        app.debug = False
+        webserver.response_cache.enabled = True
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def test_budgets_name_endpoints(self):
+        self.assertFalse(set(webserver.QUERY_BUDGETS) - set(app.view_functions))
+
+    def test_within_budget(self):
+        webserver.query_budget.mode = 'raise'
+        with QueryCounter(db.engine) as counter:
+            self.assertEqual(self.test_client.get('/riders').status_code, 200)
+        self.assertLessEqual(len(counter), self.budget)
+
+    def test_over_budget_raises_naming_statements(self):
+        webserver.query_budget.mode = 'raise'
+        webserver.QUERY_BUDGETS['get_riders'] = 1
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            self.test_client.get('/riders')
+        self.assertEqual(context.exception.endpoint, 'get_riders')
+        statements = len(context.exception.statements)
+        self.assertGreater(statements, 1)
+        self.assertIn('get_riders sent %d statements, its budget is 1' % statements, str(context.exception))
+        self.assertIn('FROM riders', str(context.exception))
+
+    def test_over_budget_streamed(self):
+        webserver.query_budget.mode = 'raise'
+        webserver.QUERY_BUDGETS['get_riders'] = 1
+        with self.assertRaises(QueryBudgetExceeded):
+            self.test_client.get('/riders?stream=1').get_data()
+
+    def test_over_budget_warns_in_debug(self):
+        webserver.query_budget.mode = None
+        webserver.QUERY_BUDGETS['get_riders'] = 1
+        app.debug = True
+        with self.assertLogs('tracker.query_budget', 'WARNING') as logs:
+            self.assertEqual(self.test_client.get('/riders').status_code, 200)
+        self.assertIn('FROM riders', logs.output[0])
+
+    def test_off_and_large_pages_are_not_checked(self):
+        webserver.QUERY_BUDGETS['get_riders'] = 1
+        webserver.query_budget.mode = 'off'
+        self.assertEqual(self.test_client.get('/riders').status_code, 200)
+        webserver.query_budget.mode = 'raise'
+        self.assertEqual(self.test_client.get('/riders?limit=100').status_code, 200)
@@ -0,0 +1,236 @@
+"""
+EXPLAIN QUERY PLAN of the queries the hot paths send, failing when one scans a whole table.
+
+Each scenario is run against a small dataset while the statements it sends are recorded,
+then every recorded select, update and delete is explained with its own parameters. Tables
+are not analyzed, so sqlite plans as if they were large rather than for the few rows here. A full
+scan is only accepted for pages in primary key order, which read the table in rowid order and
+stop after LIMIT rows, and for the tables in UNBOUNDED, whose endpoints return every row by
+design. A filtered scan with a LIMIT is still reported, as it stops early only when matches
+happen to come first.
+"""
+import re
+from datetime import date, datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from tracker import db_interactions as db
+from tracker.db_interactions import session_scope, Base
+from tracker.models import (
+    CheckpointArrivals,
+    Checkpoints,
+    Riders,
+    RiderAssignment,
+    RiderEvents,
+    RiderNotes,
+    TrackerEvents,
+    TrackerNotes,
+    Trackers,
+)
+from tracker import export
+from tracker import webserver
+from tracker.webserver import app
+
+# tables whose whole contents an endpoint returns
+UNBOUNDED = {'checkpoints', 'latest_positions'}
+# virtual tables, e.g. the fts5 rider search, are searched through their own index
+_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)\b(?! USING (COVERING )?INDEX| VIRTUAL TABLE)')
+
+
+def primary_key_page(statement, table):
+    """Return whether statement reads a page of table in primary key order, without filtering it."""
+    statement = ' '.join(statement.split())
+    return (
+        re.search(r'\bFROM %s ORDER BY %s\.id (ASC )?LIMIT\b' % (table, table), statement) is not None
+    )
+
+
+def full_scans(connection, statement, parameters):
+    """Return the tables a statement reads in full, from sqlite's EXPLAIN QUERY PLAN."""
+    cursor = connection.connection.cursor()
+    plan = [row[3] for row in cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    sorted_ = any('TEMP B-TREE' in line for line in plan)
+    scans = []
+    for line in plan:
+        match = _SCAN.match(line)
+        if not match or match.group(1) in UNBOUNDED:
+            continue
+        if not sorted_ and primary_key_page(statement, match.group(1)):
+            continue
+        scans.append(line)
+    return plan, scans
+
+
+class TestFullScans(TestCase):
+
+    def setUp(self):
+        Base.metadata.create_all(db.engine)
+
+    def _scans(self, statement, parameters=()):
+        with db.engine.connect() as connection:
+            return full_scans(connection, statement, parameters)[1]
+
+    def test_primary_key_pages_accepted(self):
+        self.assertEqual(self._scans('SELECT riders.id FROM riders ORDER BY riders.id LIMIT ? OFFSET ?', (5, 0)), [])
+
+    def test_filtered_and_sorted_pages_reported(self):
+        self.assertEqual(len(self._scans('SELECT riders.id FROM riders WHERE riders.email = ? LIMIT ?', ('x', 1))), 1)
+        self.assertEqual(len(self._scans(
+            'SELECT riders.id FROM riders WHERE riders.email = ? ORDER BY riders.id LIMIT ?', ('x', 1)
+        )), 1)
+        self.assertEqual(len(self._scans('SELECT riders.id FROM riders ORDER BY riders.email LIMIT ?', (1,))), 1)
+
+
+class TestQueryPlans(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(db.engine)
+        with session_scope(commit=True) as session:
+            for i in range(1, 21):
+                session.add(Riders(id=i, first_name='Rider', last_name='L%d' % i, cap_number=str(i)))
+                session.add(RiderAssignment(id=i, rider=i))
+                session.add(Trackers(id=i, esn_number='ESN%d' % i, rider_assigned=i,
+                                     last_test_date=date(2019, 1, 1)))
+                session.add(RiderEvents(id=i, rider=i, event_type='payment_in', datetime=datetime(2019, 1, 1)))
+                session.add(RiderNotes(rider=i, event=i, notes='note', datetime=datetime(2019, 1, 1)))
+                session.add(TrackerEvents(id=i, tracker=i, event_type='tested_OK', datetime=datetime(2019, 1, 1)))
+                session.add(TrackerNotes(tracker=i, event=i, notes='note', datetime=datetime(2019, 1, 1)))
+            # free riders and trackers, for the assignment writes
+            for i in range(21, 24):
+                session.add(Riders(id=i, first_name='Rider', last_name='L%d' % i, cap_number=str(i)))
+                session.add(RiderAssignment(id=i, rider=i))
+                session.add(Trackers(id=i, esn_number='ESN%d' % i, last_test_date=date(2019, 1, 1)))
+            session.add(RiderEvents(id=100, rider=1, event_type='payment_out', datetime=datetime(2019, 1, 2)))
+            session.add(Checkpoints(id=1, name='CP1'))
+            session.add(CheckpointArrivals(rider=1, checkpoint=1, time=datetime(2019, 1, 1)))
+
+    @classmethod
+    def tearDownClass(cls):
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+        webserver.esn_index.clear()
+
+    def setUp(self):
+        self.test_client = app.test_client()
+        webserver.response_cache.enabled = False
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+
+    def tearDown(self):
+        webserver.response_cache.enabled = True
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            self.statements.append((statement, parameters[0] if executemany else parameters))
+
+    def assertNoFullScans(self, *scenario):
+        self.statements = []
+        for step in scenario:
+            step()
+        self.assertTrue(self.statements)
+        statements, self.statements = self.statements, []
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                plan, scans = full_scans(connection, statement, parameters)
+                self.assertEqual(scans, [], '%s\n%s' % (statement, '\n'.join(plan)))
+
+    def _get(self, url):
+        return lambda: self.assertEqual(self.test_client.get(url).status_code, 200, url)
+
+    def test_rider_pages(self):
+        self.assertNoFullScans(
+            self._get('/riders?limit=5'),
+            self._get('/riders?limit=5&sort=capNumber'),
+            self._get('/riders?limit=5&sort=lastName'),
+            self._get('/riders?limit=5&start=3'),
+            self._get('/riders?limit=5&stream=1'),
+        )
+
+    def test_rider_cursor(self):
+        for sort in ('id', 'capNumber', 'lastName'):
+            next_url = self.test_client.get('/riders?limit=5&sort=' + sort).json['next']
+            self.assertNoFullScans(self._get(next_url))
+
+    def test_tracker_pages(self):
+        self.assertNoFullScans(
+            self._get('/trackers?limit=5'),
+            self._get('/trackers?limit=5&sort=lastTestDate'),
+            self._get('/trackers?esn=ESN1&esn=ESN2'),
+        )
+        next_url = self.test_client.get('/trackers?limit=5&sort=lastTestDate').json['next']
+        self.assertNoFullScans(self._get(next_url))
+
+    def test_details(self):
+        self.assertNoFullScans(self._get('/riders/1'), self._get('/trackers/1'))
+
+    def test_event_timelines(self):
+        self.assertNoFullScans(
+            self._get('/riders/1/events?limit=5'),
+            self._get('/riders/1/events?since=2019-01-01T00:00:00&until=2019-02-01T00:00:00&type=payment_in'),
+            self._get('/trackers/1/events?limit=5'),
+            self._get('/riders/1?exclude=events,notes'),
+        )
+        next_url = self.test_client.get('/riders/1/events?limit=1').json['next']
+        self.assertNoFullScans(self._get(next_url))
+
+    def test_rider_search(self):
+        self.assertNoFullScans(self._get('/riders/search?q=L1&limit=2'))
+
+    def test_checkpoints(self):
+        self.assertNoFullScans(self._get('/races'), self._get('/races/1'), self._get('/positions/latest'),
+                               self._get('/positions/latest?rider=1'))
+
+    def test_export(self):
+        def run():
+            with session_scope() as session:
+                for dataset in export.DATASETS:
+                    list(export.export(session, dataset, 'ndjson', batch_size=5))
+        self.assertNoFullScans(run)
+
+    def _send(self, method, url, payload=None, status=200):
+        def send():
+            self.assertEqual(self.test_client.open(url, method=method, json=payload).status_code, status, url)
+        return send
+
+    def test_writes(self):
+        scenario = (
+            self._send('POST', '/riders/21/trackers/21/addTrackerAssignment', {}),
+            self._send('POST', '/riders/21/trackers/21/removeTrackerAssignment', {}),
+            self._send('POST', '/riders/trackers/addTrackerAssignment', [
+                {'riderId': 22, 'trackerId': 22}, {'riderId': 23, 'trackerId': 23}
+            ]),
+            self._send('PATCH', '/trackers/3', {'esnNumber': 'ESN300'}),
+            self._send('PATCH', '/riders/2', {'capNumber': '200', 'email': None}),
+            self._send('POST', '/riders/8/1/arrival', {}),
+            self._send('POST', '/positions', [
+                {'esn': 'ESN9', 'latitude': 48.0, 'longitude': 2.0, 'time': '2019-07-27T22:00:00'},
+            ], status=202),
+            webserver.position_writer.flush,
+        )
+        recorded = []
+        self.assertNoFullScans(*scenario, lambda: recorded.extend(self.statements))
+        # the assignment writes were sent, so their plans were checked: the add, the remove and the batch
+        writes = [statement.split(' WHERE')[0] for statement, _ in recorded]
+        self.assertEqual(writes.count('UPDATE trackers SET rider_assigned=?, version=(trackers.version + ?)'), 3)
+        self.assertEqual(writes.count(
+            'UPDATE riders SET balance=(coalesce(riders.balance, ?) + ?), version=(riders.version + ?)'
+        ), 3)
+
+    def test_db_interactions(self):
+        def run():
+            with session_scope(commit=True) as session:
+                db.get_by_ids(session, Riders, [1, 2])
+                db.get(session, Trackers, id=1)
+                db.bulk_update(session, Trackers, [{'id': 1, 'esn_number': 'ESN1'}])
+                db.bulk_increment(session, Riders, 'balance', [(1, 5.0), (2, 5.0)])
+                db.bulk_delete(session, TrackerNotes, [20])
+                db.has_rows(session, Riders)
+                webserver.esn_index.reload(session, [1, 2])
+            with session_scope() as session:
+                webserver.esn_index.clear()
+                webserver.esn_index.lookup(session, ['ESN1', 'ESN2'])
+        self.assertNoFullScans(run)
@@ -0,0 +1,151 @@
+import os
+import shutil
+import sqlite3
+import time
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base, session_scope
+from tracker.models import Riders
+from tracker.replicas import ReplicaRouter
+from tracker.webserver import app
+
+
+class ReplicaTests(TestCase):
+    """A primary sqlite file and a replica made by copying it."""
+
+    def setUp(self):
+        self.temp_ = mkdtemp()
+        self.primary_db = os.path.join(self.temp_, 'primary.db')
+        self.replica_db = os.path.join(self.temp_, 'replica.db')
+        self.primary = create_engine('sqlite:///' + self.primary_db)
+        Base.metadata.create_all(self.primary)
+        self.replica = create_engine('sqlite:///' + self.replica_db)
+        # time of the last write of the client reading
+        self.client_write = None
+        self.router = ReplicaRouter(self.primary, [self.replica], max_lag=5, check_interval=0,
+                                    last_write=lambda: self.client_write)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_)
+
+    def replicate(self):
+        shutil.copy(self.primary_db, self.replica_db)
+
+    def set_replica_heartbeat(self, at):
+        conn = sqlite3.connect(self.replica_db)
+        conn.execute('INSERT OR REPLACE INTO replica_heartbeat (id, at) VALUES (1, ?)', (at,))
+        conn.commit()
+        conn.close()
+
+
+class TestReplicaRouter(ReplicaTests):
+
+    def test_fresh_replica_serves_reads(self):
+        self.router.beat()
+        self.replicate()
+        self.assertIs(self.router.engine(), self.replica)
+        self.assertEqual(self.router.stats['replica_reads'], 1)
+
+    def test_reads_after_a_write_stay_on_primary_until_replicated(self):
+        self.router.beat()
+        self.replicate()
+        self.client_write = time.time()
+        self.assertIs(self.router.engine(), self.primary)
+        self.router.beat()
+        self.replicate()
+        self.assertIs(self.router.engine(), self.replica)
+
+    def test_writes_of_other_clients_do_not_hold_reads_on_primary(self):
+        self.router.beat()
+        self.replicate()
+        with session_scope(commit=True, engine=self.primary) as session:
+            session.add(Riders(id=1))
+        self.router.beat()
+        self.assertIs(self.router.engine(), self.replica)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.router.beat()
+        self.replicate()
+        self.set_replica_heartbeat(time.time() - 10)
+        self.assertIs(self.router.engine(), self.primary)
+        self.assertEqual(self.router.stats['lagging'], 1)
+        self.assertEqual(self.router.stats['primary_reads'], 1)
+        self.assertGreater(self.router.info()['lag_seconds_0'], 5)
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        # the replica file has no heartbeat table
+        with self.assertLogs('tracker.replicas', 'ERROR'):
+            self.assertIs(self.router.engine(), self.primary)
+        self.assertEqual(self.router.stats['errors'], 1)
+
+    def test_heartbeats_are_cached(self):
+        self.router.check_interval = 60
+        self.router.beat()
+        self.replicate()
+        self.assertIs(self.router.engine(), self.replica)
+        self.set_replica_heartbeat(time.time() - 10)
+        self.assertIs(self.router.engine(), self.replica)
+
+
+class TestReplicaReads(ReplicaTests):
+    """Requests against the in memory db of db_interactions as primary, with a replica file."""
+
+    def setUp(self):
+        super(TestReplicaReads, self).setUp()
+        Base.metadata.create_all(db.engine)
+        webserver.response_cache.enabled = False
+        self.test_client = app.test_client()
+        # the replica has a rider the in memory primary does not
+        with session_scope(commit=True, engine=self.primary) as session:
+            session.add(Riders(id=1, first_name='Replica', cap_number='1', category='male'))
+        self.router = ReplicaRouter(db.engine, [self.replica], max_lag=5, check_interval=0,
+                                    last_write=webserver._client_last_write)
+        self.replicate()
+        self.set_replica_heartbeat(time.time())
+        db.use_replicas(self.router)
+
+    def tearDown(self):
+        db.use_replicas(None)
+        webserver.response_cache.enabled = True
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+        super(TestReplicaReads, self).tearDown()
+
+    def test_details_and_pages_are_read_from_replica(self):
+        self.assertEqual(self.test_client.get('/riders/1').json['firstName'], 'Replica')
+        self.assertEqual(len(self.test_client.get('/riders').json['riders']), 1)
+        self.assertEqual(self.router.stats['replica_reads'], 2)
+
+    def test_writes_outside_requests_do_not_route_reads_to_primary(self):
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=2, first_name='Primary', cap_number='2', category='male'))
+        self.assertEqual(self.test_client.get('/riders/1').json['firstName'], 'Replica')
+        self.assertEqual(self.router.stats['primary_reads'], 0)
+
+    def test_clients_read_their_own_writes(self):
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Primary', cap_number='1', category='male'))
+        self.test_client.patch('/riders/1', json={'lastName': 'Written'})
+        # the writing client sends its session cookie back and reads the primary
+        self.assertEqual(self.test_client.get('/riders/1').json['lastName'], 'Written')
+        self.assertEqual(self.router.stats['primary_reads'], 1)
+        # a time sent by the client itself is not trusted
+        client = app.test_client()
+        client.set_cookie('localhost', 'last_write', '%.6f' % time.time())
+        client.set_cookie('localhost', 'session', 'eyJsYXN0X3dyaXRlIjo5OTk5OTk5OTk5LjB9.forged.signature')
+        result = client.get('/riders/1', headers={'X-Last-Write': '%.6f' % time.time()})
+        self.assertEqual(result.json['firstName'], 'Replica')
+        self.assertEqual(self.router.stats['primary_reads'], 1)
+        # clients that have not written read the replica
+        self.assertEqual(app.test_client().get('/riders/1').json['firstName'], 'Replica')
+        # until it has caught up with the write
+        self.set_replica_heartbeat(time.time())
+        self.assertEqual(self.test_client.get('/riders/1').json['firstName'], 'Replica')
+        self.assertEqual(self.router.stats['primary_reads'], 1)
+        self.assertEqual(self.router.stats['replica_reads'], 3)
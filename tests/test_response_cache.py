@@ -0,0 +1,85 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from tracker.response_cache import MemoryBackend, SqliteBackend, make_backend
+
+
+class BackendTests(object):
+    """Behaviour every backend shares, run against each in the classes below."""
+
+    def make_backend(self, max_bytes=1000):
+        raise NotImplementedError
+
+    def test_set_get_and_invalidate_by_tag(self):
+        backend = self.make_backend()
+        generation = backend.generation()
+        self.assertTrue(backend.set('a', b'value a', 60, ['riders', 'rider:1'], generation))
+        self.assertTrue(backend.set('b', b'value b', 60, ['riders', 'rider:2'], generation))
+        self.assertEqual(backend.get('a'), b'value a')
+        backend.invalidate({'rider:1'})
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), b'value b')
+        backend.invalidate({'riders'})
+        self.assertIsNone(backend.get('b'))
+
+    def test_set_refused_after_invalidation(self):
+        backend = self.make_backend()
+        generation = backend.generation()
+        backend.invalidate({'rider:1'})
+        self.assertFalse(backend.set('a', b'stale', 60, ['rider:1'], generation))
+        self.assertIsNone(backend.get('a'))
+
+    def test_ttl(self):
+        backend = self.make_backend()
+        backend.set('a', b'value a', -1, ['riders'], backend.generation())
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.info()['expired'], 1)
+
+    def test_lru_eviction(self):
+        backend = self.make_backend(max_bytes=20)
+        generation = backend.generation()
+        backend.set('a', b'0123456789', 60, ['riders'], generation)
+        backend.set('b', b'0123456789', 60, ['riders'], generation)
+        backend.get('a')
+        backend.set('c', b'0123456789', 60, ['riders'], generation)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'0123456789')
+        info = backend.info()
+        self.assertEqual((info['evictions'], info['entries'], info['bytes']), (1, 2, 20))
+        self.assertFalse(backend.set('d', b'x' * 21, 60, ['riders'], generation))
+
+
+class TestMemoryBackend(BackendTests, TestCase):
+
+    def make_backend(self, max_bytes=1000):
+        return MemoryBackend(max_bytes)
+
+
+class TestSqliteBackend(BackendTests, TestCase):
+
+    def setUp(self):
+        self.temp = mkdtemp()
+        self.path = os.path.join(self.temp, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def make_backend(self, max_bytes=1000):
+        return SqliteBackend(self.path, max_bytes)
+
+    def test_shared_between_instances(self):
+        first, second = self.make_backend(), self.make_backend()
+        first.set('a', b'value a', 60, ['rider:1'], first.generation())
+        self.assertEqual(second.get('a'), b'value a')
+        generation = first.generation()
+        second.invalidate({'rider:1'})
+        self.assertIsNone(first.get('a'))
+        self.assertFalse(first.set('a', b'stale', 60, ['rider:1'], generation))
+
+    def test_make_backend(self):
+        self.assertIsInstance(make_backend('sqlite:' + self.path, 10), SqliteBackend)
+        self.assertIsInstance(make_backend('memory', 10), MemoryBackend)
+        with self.assertRaises(ValueError):
+            make_backend('redis', 10)
@@ -0,0 +1,81 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+from tracker import db_interactions as db
+from tracker.db_interactions import session_scope, Base
+from tracker import rider_search
+from tracker.models import Riders
+
+
+class TestRiderSearch(TestCase):
+
+    def setUp(self):
+        Base.metadata.create_all(db.engine)
+        rider_search.create(db.engine)
+        with session_scope(commit=True) as session:
+            db.bulk_insert(session, Riders, [
+                {'id': 1, 'first_name': 'Anna', 'last_name': 'Smith', 'cap_number': '12', 'email': 'anna@example.com'},
+                {'id': 2, 'first_name': 'Smithy', 'last_name': 'Jones', 'cap_number': '120', 'email': 'sj@example.com'},
+                {'id': 3, 'first_name': 'Ben', 'last_name': 'Smithers', 'cap_number': '7', 'email': None},
+                {'id': 4, 'first_name': 'Zoë', 'last_name': "O'Neill", 'cap_number': '1', 'email': 'zoe@test.org'},
+            ])
+
+    def tearDown(self):
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def _search(self, query, limit=10, offset=0):
+        with session_scope() as session:
+            return rider_search.search(session, query, limit, offset)
+
+    def test_prefix_of_any_column(self):
+        self.assertEqual(set(self._search('smi')), {1, 2, 3})
+        self.assertEqual(self._search('anna@example'), [1])
+        self.assertEqual(self._search('zoë'), [4])
+        self.assertEqual(self._search("o'neill"), [4])
+        self.assertEqual(self._search('nobody'), [])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self._search('smi ben'), [3])
+
+    def test_ranking(self):
+        # an exact cap number first, then surname matches above first name matches
+        self.assertEqual(self._search('12'), [1, 2])
+        self.assertEqual(self._search('120'), [2])
+        self.assertEqual(self._search('smith')[-1], 2)
+
+    def test_paging(self):
+        ranked = self._search('smi')
+        self.assertEqual(self._search('smi', limit=2) + self._search('smi', limit=2, offset=2), ranked)
+
+    def test_kept_current_by_writes(self):
+        with session_scope(commit=True) as session:
+            db.update(session, Riders, {'last_name': 'Brown'}, id=1)
+            db.bulk_delete(session, Riders, [3])
+            session.add(Riders(id=5, first_name='Smitha'))
+        self.assertEqual(set(self._search('smi')), {2, 5})
+        self.assertEqual(self._search('brown'), [1])
+
+    def test_rebuilds_existing_riders(self):
+        rider_search.drop(db.engine)
+        rider_search.create(db.engine)
+        self.assertEqual(set(self._search('smi')), {1, 2, 3})
+
+    def test_punctuation_only(self):
+        self.assertEqual(rider_search.terms('"*-'), [])
+        self.assertEqual(self._search('"*'), [])
+
+
+class TestInstall(TestCase):
+
+    def test_builds_index_with_riders_only(self):
+        engine = create_engine('sqlite://')
+        Riders.__table__.create(engine)
+        rider_search.install(engine)
+        self.addCleanup(Base.metadata.drop_all, engine)
+        self.assertNotIn('rider_search', inspect(engine).get_table_names())
+        Riders.__table__.drop(engine)
+        Base.metadata.create_all(engine)
+        self.assertIn('rider_search', inspect(engine).get_table_names())
@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from tracker import db_interactions as db
+from tracker import webserver
+from tracker.db_interactions import Base, session_scope
+from tracker.models import Riders
+from tracker.slow_queries import SlowQueryLog, fingerprint
+from tracker.webserver import app
+
+
+class TestFingerprint(TestCase):
+
+    def test_values_are_replaced(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM riders WHERE last_name = 'O''Neil' AND id > 10 LIMIT ? OFFSET ?"),
+            'SELECT * FROM riders WHERE last_name = ? AND id > ? LIMIT ? OFFSET ?'
+        )
+
+    def test_named_parameters_and_casts(self):
+        self.assertEqual(
+            fingerprint('SELECT id::text FROM riders WHERE id = %(id_1)s OR cap_number = :cap'),
+            'SELECT id::text FROM riders WHERE id = ? OR cap_number = ?'
+        )
+
+    def test_in_lists_and_rows_are_collapsed(self):
+        self.assertEqual(
+            fingerprint('SELECT id FROM riders WHERE id IN (?, ?, ?)'),
+            fingerprint('SELECT id FROM riders WHERE id IN (?, ?)')
+        )
+        self.assertEqual(
+            fingerprint('INSERT INTO riders (id, cap_number) VALUES (?, ?), (?, ?), (?, ?)'),
+            'INSERT INTO riders (id, cap_number) VALUES (?, ...), ...'
+        )
+
+    def test_whitespace_comments_and_identifiers(self):
+        self.assertEqual(
+            fingerprint('SELECT t1.col2\n  FROM t1 -- comment\n WHERE /* hint */ t1.id = 3'),
+            'SELECT t1.col2 FROM t1 WHERE t1.id = ?'
+        )
+
+
+class TestSlowQueryLog(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.log = SlowQueryLog(threshold=0.5, samples=2)
+        self.log.install(self.engine)
+
+    def test_aggregates_by_fingerprint(self):
+        for i in range(3):
+            self.engine.execute(text('SELECT %d' % i))
+        self.engine.execute(text('SELECT 1, 2'))
+        report = self.log.report()
+        self.assertEqual(report['statements'], 4)
+        counts = {entry['fingerprint']: entry['count'] for entry in report['fingerprints']}
+        self.assertEqual(counts, {'SELECT ?': 3, 'SELECT ?, ?': 1})
+        entry = next(entry for entry in report['fingerprints'] if entry['fingerprint'] == 'SELECT ?')
+        self.assertEqual(entry['endpoints'], {'background': 3})
+        self.assertEqual(entry['slow'], 0)
+        self.assertEqual(entry['samples'], [])
+        self.assertLessEqual(entry['max_ms'], entry['total_ms'])
+
+    def test_slow_executions_keep_their_parameters(self):
+        with self.assertLogs('tracker.slow_queries', 'WARNING') as logs:
+            for i in range(3):
+                self.log.record('SELECT * FROM riders WHERE id = ?', 0.5 + i, (i,))
+        self.log.record('SELECT * FROM riders WHERE id = ?', 0.1, (9,))
+        self.assertEqual(len(logs.output), 3)
+        self.assertIn('(2,)', logs.output[-1])
+        entry, = self.log.report()['fingerprints']
+        self.assertEqual(entry['count'], 4)
+        self.assertEqual(entry['slow'], 3)
+        self.assertEqual(entry['max_ms'], 2500)
+        # only the latest slow executions are kept
+        self.assertEqual([sample['parameters'] for sample in entry['samples']], ['(1,)', '(2,)'])
+
+    def test_report_is_ordered_by_total_time(self):
+        self.log.record('SELECT a FROM t', 0.2)
+        self.log.record('SELECT b FROM t', 0.1)
+        self.log.record('SELECT b FROM t', 0.15)
+        report = self.log.report(limit=1)
+        self.assertEqual([entry['fingerprint'] for entry in report['fingerprints']], ['SELECT b FROM t'])
+
+    def test_max_fingerprints(self):
+        log = SlowQueryLog(max_fingerprints=1)
+        log.record('SELECT a FROM t', 0.1)
+        log.record('SELECT b FROM t', 0.1)
+        self.assertEqual(log.report()['dropped'], 1)
+        self.assertEqual(len(log.report()['fingerprints']), 1)
+
+
+class TestSlowQueriesEndpoint(TestCase):
+
+    def setUp(self):
+        self.test_client = app.test_client()
+        Base.metadata.create_all(db.engine)
+        webserver.response_cache.enabled = False
+        webserver.slow_queries.clear()
+        self.threshold = webserver.slow_queries.threshold
+
+    def tearDown(self):
+        webserver.slow_queries.threshold = self.threshold
+        webserver.response_cache.enabled = True
+        with session_scope(commit=True) as session:
+            for table in reversed(Base.metadata.sorted_tables):
+                session.execute(table.delete())
+
+    def test_statements_are_tied_to_their_endpoint(self):
+        with session_scope(commit=True) as session:
+            session.add(Riders(id=1, first_name='Rider', cap_number='1', category='male'))
+        # every statement is slow
+        webserver.slow_queries.threshold = 0
+        with self.assertLogs('tracker.slow_queries', 'WARNING'):
+            self.test_client.get('/riders/1')
+            self.test_client.get('/riders/1')
+        result = self.test_client.get('/queries/slow?limit=50')
+        self.assertEqual(result.status_code, 200)
+        riders = [entry for entry in result.json['fingerprints'] if entry['fingerprint'].startswith(
+            'SELECT riders.id AS riders_id')]
+        self.assertEqual(len(riders), 1)
+        self.assertEqual(riders[0]['endpoints'], {'get_rider': 2})
+        self.assertEqual(riders[0]['slow'], 2)
+        self.assertEqual(riders[0]['samples'][0]['endpoint'], 'get_rider')
+        self.assertIn('1', riders[0]['samples'][0]['parameters'])
+
+    def test_invalid_limit(self):
+        self.assertEqual(self.test_client.get('/queries/slow?limit=0').status_code, 400)
@@ -1,9 +1,9 @@
-from datetime import datetime
+from datetime import date, datetime
 from unittest import TestCase, mock
 from unittest.mock import mock_open
 import connexion
 from tracker.models import Riders, Trackers
-from tracker.webserver import app
+from tracker.webserver import app, response_cache
 
 # todo - set up test client with connexion
 # todo - ensure where no relationship, key returns None or empty list
@@ -14,6 +14,7 @@ class WebTests(TestCase):
     def setUp(self):
 
         self.test_client = app.test_client()
+        response_cache.clear()
         self.mock_riders = [
             Riders(
                 id=1,
@@ -69,7 +70,8 @@ class TestRiderEndpoints(WebTests):
             '/riders',
             json=rider_details
         )
-        mock_create.assert_called_with(mock.ANY, mock_riders, **rider_details)
+        mock_create.assert_called_with(mock.ANY, mock_riders, first_name='Bob', last_name='Green',
+                                       email='hello@email.com', cap_number='171', category='male')
 
     # # todo test this with validation tests
     # def test_post_rider_error(self):
@@ -83,14 +85,14 @@ class TestRiderEndpoints(WebTests):
     #     response = self.test_client.post('/riders', json=rider_details)
     #     self.assertEqual(response.status_code, 400)
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_riders_simple(self, mock_get_riders):
-        # return a mock list and a last rider with a high id
-        mock_get_riders.return_value = (self.mock_riders, Riders(id=2))
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_simple(self, mock_get_page):
+        mock_get_page.return_value = (self.mock_riders, None)
         # pass no parameters, to use defaults
         result = self.test_client.get('/riders')
-        # assert db.get_riders called with right params
-        mock_get_riders.assert_called_with(mock.ANY, 1, 26, Riders)
+        # assert db.get_page called with right params
+        mock_get_page.assert_called_with(mock.ANY, Riders, 25, sort='id', cursor=None, start=None,
+                                         options=mock.ANY)
         self.assertEqual(result.status_code, 200)
         expected_result = [
             {
@@ -116,30 +118,67 @@ class TestRiderEndpoints(WebTests):
                 "events": []
             }
         ]
-        self.assertDictEqual(result.json[0], expected_result[0])
-        self.assertDictEqual(result.json[1], expected_result[1])
+        self.assertIsNone(result.json['next'])
+        self.assertDictEqual(result.json['riders'][0], expected_result[0])
+        self.assertDictEqual(result.json['riders'][1], expected_result[1])
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_riders_no_data(self, mock_get_riders):
-        # return a mock list and a last rider with a high id
-        mock_get_riders.return_value = ([], None)
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_next_keeps_args(self, mock_get_page):
+        mock_get_page.return_value = (self.mock_riders, 'abc')
+        result = self.test_client.get('/riders', query_string={'start': 2, 'sort': 'lastName', 'cursor': 'xyz'})
+        self.assertEqual(result.json['next'], '/riders?start=2&sort=lastName&cursor=abc&limit=25')
+        self.test_client.get(result.json['next'])
+        mock_get_page.assert_called_with(mock.ANY, Riders, 25, sort='last_name', cursor='abc', start=2,
+                                         options=mock.ANY)
+
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_next_cursor(self, mock_get_page):
+        mock_get_page.return_value = (self.mock_riders, 'abc')
+        result = self.test_client.get('/riders', query_string={'limit': 2, 'sort': 'capNumber'})
+        mock_get_page.assert_called_with(mock.ANY, Riders, 2, sort='cap_number', cursor=None, start=None,
+                                         options=mock.ANY)
+        self.assertEqual(result.json['next'], '/riders?limit=2&sort=capNumber&cursor=abc')
+        self.test_client.get(result.json['next'])
+        mock_get_page.assert_called_with(mock.ANY, Riders, 2, sort='cap_number', cursor='abc', start=None,
+                                         options=mock.ANY)
+
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_bad_sort(self, mock_get_page):
+        result = self.test_client.get('/riders', query_string={'sort': 'email'})
+        self.assertEqual(result.status_code, 400)
+        mock_get_page.assert_not_called()
+
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_bad_cursor(self, mock_get_page):
+        mock_get_page.side_effect = ValueError
+        result = self.test_client.get('/riders', query_string={'cursor': 'nonsense'})
+        self.assertEqual(result.status_code, 400)
+
+    @mock.patch('tracker.webserver.db.has_rows')
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_no_data(self, mock_get_page, mock_has_rows):
+        mock_get_page.return_value = ([], None)
+        mock_has_rows.return_value = False
         # pass no parameters, to use defaults
         result = self.test_client.get('/riders')
         self.assertEqual(result.status_code, 204)
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_riders_bad_request(self, mock_get_riders):
-        # return a mock list and a last rider with a high id
-        mock_get_riders.return_value = ([], Riders(id=40))
-        # pass no parameters, to use defaults
+    @mock.patch('tracker.webserver.db.has_rows')
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_riders_bad_request(self, mock_get_page, mock_has_rows):
+        # no riders from the start id, but riders before it
+        mock_get_page.return_value = ([], None)
+        mock_has_rows.return_value = True
         result = self.test_client.get('/riders', query_string={'start': 50})
+        mock_get_page.assert_called_with(mock.ANY, Riders, 25, sort='id', cursor=None, start=50,
+                                         options=mock.ANY)
         self.assertEqual(result.status_code, 416)
 
     @mock.patch('tracker.webserver.db.get')
     def test_get_rider(self, mock_get):
-        mock_get.return_value = self.mock_riders[0]
+        mock_get.return_value = [self.mock_riders[0]]
         result = self.test_client.get('/riders/1')
-        mock_get.assert_called_with(mock.ANY, Riders, **{'id': 1})
+        mock_get.assert_called_with(mock.ANY, Riders, options=mock.ANY, **{'id': 1})
         self.assertEqual(result.status_code, 200)
         expected_result = {
             "capNumber": "100",
@@ -159,25 +198,49 @@ class TestRiderEndpoints(WebTests):
     def test_get_rider_no_data(self, mock_get):
         mock_get.return_value = None
         result = self.test_client.get('/riders/1')
-        mock_get.assert_called_with(mock.ANY, Riders, **{'id': 1})
+        mock_get.assert_called_with(mock.ANY, Riders, options=mock.ANY, **{'id': 1})
         self.assertEqual(result.status_code, 204)
 
-    @mock.patch('tracker.webserver.db.update')
-    def test_patch_rider(self, mock_update):
-        mock_update.return_value = 'mock_rider'
-        result = self.test_client.patch('/riders/1', json={'capNumber': '100'})
-        mock_update.assert_called_with(mock.ANY, Riders, {'capNumber': '100'}, id=1)
+    @mock.patch('tracker.webserver.db.patch')
+    def test_patch_rider(self, mock_patch):
+        updated_rider = self.mock_riders[0]
+        updated_rider.email = None
+        mock_patch.return_value = updated_rider
+        result = self.test_client.patch('/riders/1', data='{"capNumber": "100", "email": null}',
+                                        content_type='application/merge-patch+json')
+        mock_patch.assert_called_with(mock.ANY, Riders, 1, {'cap_number': '100', 'email': None}, options=mock.ANY)
         self.assertEqual(result.status_code, 200)
-        self.assertEqual(result.data, b'"mock_rider"')
+        expected_result = {
+            'id': 1,
+            'firstName': 'Bob',
+            'lastName': 'Green',
+            'email': None,
+            'category': 'male',
+            'capNumber': '100',
+            'trackers_assigned': [],
+            'notes': [],
+            'events': []
+        }
+        self.assertEqual(result.json, expected_result)
 
-    @mock.patch('tracker.webserver.db.update')
-    def test_patch_rider_fail(self, mock_update):
-        mock_update.return_value = False
-        # todo this should use application/json-merge-patch
+    @mock.patch('tracker.webserver.db.patch')
+    def test_patch_rider_fail(self, mock_patch):
+        mock_patch.return_value = None
         result = self.test_client.patch('/riders/1', json={'capNumber': '100'})
-        mock_update.assert_called_with(mock.ANY, Riders, {'capNumber': '100'}, id=1)
+        mock_patch.assert_called_with(mock.ANY, Riders, 1, {'cap_number': '100'}, options=mock.ANY)
         self.assertEqual(result.status_code, 204)
 
+    @mock.patch('tracker.webserver.db.patch')
+    def test_patch_rider_invalid(self, mock_patch):
+        result = self.test_client.patch('/riders/1', json={'category': 'unicycle', 'events': []})
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual(set(result.json), {'category', 'events'})
+        self.assertEqual(self.test_client.patch('/riders/1', json=['capNumber']).status_code, 400)
+        result = self.test_client.patch('/riders/1', data='capNumber=100',
+                                        content_type='application/x-www-form-urlencoded')
+        self.assertEqual(result.status_code, 415)
+        mock_patch.assert_not_called()
+
     @mock.patch('tracker.webserver.db.create')
     @mock.patch('tracker.webserver.Trackers')
     def test_post_tracker(self, mock_trackers, mock_create):
@@ -192,16 +255,19 @@ class TestRiderEndpoints(WebTests):
 
     @mock.patch('tracker.webserver.db.get')
     def test_get_tracker(self, mock_get):
-        mock_get.return_value = self.mock_trackers[0]
+        mock_get.return_value = [self.mock_trackers[0]]
         result = self.test_client.get('/trackers/1')
-        mock_get.assert_called_with(mock.ANY, Trackers, **{'id': 1})
+        mock_get.assert_called_with(mock.ANY, Trackers, options=mock.ANY, **{'id': 1})
         self.assertEqual(result.status_code, 200)
         expected_result = {
             'esnNumber': '123',
             'id': 1,
             'loanStatus': 'with_rider',
+            'lastTestDate': '2018-01-01',
             'purchaseDate': '2018-01-01',
-            'workingStatus': 'working'
+            'warrantyExpiry': '2018-01-01',
+            'workingStatus': 'working',
+            'rider': None
         }
         self.assertEqual(result.json,
                          expected_result)
@@ -210,17 +276,16 @@ class TestRiderEndpoints(WebTests):
     def test_get_tracker_no_data(self, mock_get):
         mock_get.return_value = None
         result = self.test_client.get('/trackers/1')
-        mock_get.assert_called_with(mock.ANY, Trackers, **{'id': 1})
+        mock_get.assert_called_with(mock.ANY, Trackers, options=mock.ANY, **{'id': 1})
         self.assertEqual(result.status_code, 204)
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_trackers_simple(self, mock_get_resources):
-        # return a mock list and a last rider with a high id
-        mock_get_resources.return_value = (self.mock_trackers, Trackers(id=2))
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_trackers_simple(self, mock_get_page):
+        mock_get_page.return_value = (self.mock_trackers, None)
         # pass no parameters, to use defaults
         result = self.test_client.get('/trackers')
-        # assert db.get_riders called with right params
-        mock_get_resources.assert_called_with(mock.ANY, 1, 26, Trackers)
+        mock_get_page.assert_called_with(mock.ANY, Trackers, 25, sort='id', cursor=None, start=None,
+                                         options=mock.ANY)
         self.assertEqual(result.status_code, 200)
         expected_result = [
             {
@@ -228,55 +293,136 @@ class TestRiderEndpoints(WebTests):
                 'esnNumber': '123',
                 'workingStatus': 'working',
                 'loanStatus': 'with_rider',
+                'lastTestDate': '2018-01-01',
                 'purchaseDate': '2018-01-01',
+                'warrantyExpiry': '2018-01-01',
+                'rider': None,
             },
             {
                 'id': 2,
                 'esnNumber': '456',
                 'workingStatus': 'working',
                 'loanStatus': 'with_rider',
+                'lastTestDate': '2018-01-01',
                 'purchaseDate': '2018-01-01',
+                'warrantyExpiry': '2018-01-01',
+                'rider': None,
             }
         ]
-        self.assertEqual(result.json, expected_result)
+        self.assertEqual(result.json['trackers'], expected_result)
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_trackers_no_data(self, mock_get_resources):
-        mock_get_resources.return_value = ([], None)
+    @mock.patch('tracker.webserver.db.has_rows')
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_trackers_no_data(self, mock_get_page, mock_has_rows):
+        mock_get_page.return_value = ([], None)
+        mock_has_rows.return_value = False
         # pass no parameters, to use defaults
         result = self.test_client.get('/trackers')
         self.assertEqual(result.status_code, 204)
 
-    @mock.patch('tracker.webserver.db.get_resources')
-    def test_get_trackers_bad_request(self, mock_get_resources):
-        mock_get_resources.return_value = ([], Trackers(id=40))
+    @mock.patch('tracker.webserver.db.has_rows')
+    @mock.patch('tracker.webserver.db.get_page')
+    def test_get_trackers_bad_request(self, mock_get_page, mock_has_rows):
+        mock_get_page.return_value = ([], None)
+        mock_has_rows.return_value = True
         result = self.test_client.get('/trackers', query_string={'start': 50})
         self.assertEqual(result.status_code, 416)
 
-    @mock.patch('tracker.webserver.db.update')
-    def test_patch_tracker(self, mock_update):
+    @mock.patch('tracker.webserver.db.patch')
+    def test_patch_tracker(self, mock_patch):
         updated_tracker = self.mock_trackers[0]
-        updated_tracker.esn_number = 100
-        mock_update.return_value = updated_tracker
-        result = self.test_client.patch('/trackers/1', json={'esnNumber': '100'})
-        mock_update.assert_called_with(mock.ANY, Trackers, {'esnNumber': '100'}, id=1)
+        updated_tracker.working_status = 'broken'
+        mock_patch.return_value = updated_tracker
+        result = self.test_client.patch('/trackers/1', json={'workingStatus': 'broken'})
+        mock_patch.assert_called_with(mock.ANY, Trackers, 1, {'working_status': 'broken'}, options=mock.ANY)
         self.assertEqual(result.status_code, 200)
         expected_result = {
             'id': 1,
-            'esnNumber': '100',
-            'workingStatus': 'working',
+            'esnNumber': '123',
+            'workingStatus': 'broken',
             'loanStatus': 'with_rider',
-            'purchaseDate': '2018-01-01'
+            'lastTestDate': '2018-01-01',
+            'purchaseDate': '2018-01-01',
+            'warrantyExpiry': '2018-01-01',
+            'rider': None
         }
         self.assertEqual(result.json, expected_result)
 
-    @mock.patch('tracker.webserver.db.update')
-    def test_patch_tracker_fail(self, mock_update):
-        mock_update.return_value = False
-        result = self.test_client.patch('/trackers/1', json={'esnNumber': '100'})
-        mock_update.assert_called_with(mock.ANY, Trackers, {'esnNumber': '100'}, id=1)
+    @mock.patch('tracker.webserver.db.patch')
+    def test_patch_tracker_fail(self, mock_patch):
+        mock_patch.return_value = None
+        result = self.test_client.patch('/trackers/1', json={'lastTestDate': '2019-07-01'})
+        mock_patch.assert_called_with(mock.ANY, Trackers, 1, {'last_test_date': date(2019, 7, 1)}, options=mock.ANY)
         self.assertEqual(result.status_code, 204)
 
+    @mock.patch('tracker.webserver.IMPORT_BATCH_SIZE', 2)
+    @mock.patch('tracker.webserver.db.bulk_insert')
+    def test_import_riders_csv(self, mock_bulk_insert):
+        mock_bulk_insert.side_effect = lambda session, model, rows: len(rows)
+        body = (
+            'firstName,lastName,email,capNumber,category\n'
+            'Bob,Green,hello@email.com,100,male\n'
+            'Lyle,Taylor,,105,pair\n'
+            'Bad,Rider,hello@email.com,,unicycle\n'
+            'Jo,"Smith, Jr",jo@email.com,106,female\n'
+        )
+        result = self.test_client.post('/riders/import', data=body, content_type='text/csv')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['created'], 3)
+        self.assertEqual(len(result.json['errors']), 1)
+        self.assertEqual(result.json['errors'][0]['row'], 3)
+        self.assertCountEqual(result.json['errors'][0]['errors'], ['capNumber', 'category'])
+        # one full batch, then the remainder
+        self.assertEqual(mock_bulk_insert.call_count, 2)
+        first_batch = mock_bulk_insert.call_args_list[0][0][2]
+        self.assertEqual(first_batch[1], {'first_name': 'Lyle', 'last_name': 'Taylor',
+                                          'cap_number': '105', 'category': 'pair'})
+        self.assertEqual(mock_bulk_insert.call_args_list[1][0][2][0]['last_name'], 'Smith, Jr')
+
+    @mock.patch('tracker.webserver.db.bulk_insert')
+    def test_import_riders_csv_too_many_columns(self, mock_bulk_insert):
+        mock_bulk_insert.side_effect = lambda session, model, rows: len(rows)
+        body = (
+            'firstName,lastName,capNumber\n'
+            'Bob,Green,100,extra\n'
+            'Jo,Smith,101\n'
+        )
+        result = self.test_client.post('/riders/import', data=body, content_type='text/csv')
+        self.assertEqual(result.json, {'created': 1, 'errors': [{'row': 1, 'errors': ['Too many columns']}]})
+
+    @mock.patch('tracker.webserver.db.bulk_insert')
+    def test_import_riders_json(self, mock_bulk_insert):
+        mock_bulk_insert.side_effect = lambda session, model, rows: len(rows)
+        riders = [
+            {'firstName': 'Bob', 'lastName': 'Green', 'capNumber': '100', 'depositBalance': 150},
+            {'firstName': 'Bob', 'lastName': 'Green', 'capNumber': '101', 'nonsense': 1},
+        ]
+        result = self.test_client.post('/riders/import', json=riders)
+        self.assertEqual(result.json, {'created': 1, 'errors': [{'row': 2, 'errors': {'nonsense': ['Unknown field.']}}]})
+        mock_bulk_insert.assert_called_with(mock.ANY, Riders, [
+            {'first_name': 'Bob', 'last_name': 'Green', 'cap_number': '100', 'balance': 150.0}
+        ])
+
+    @mock.patch('tracker.webserver.db.bulk_insert')
+    def test_import_riders_ndjson(self, mock_bulk_insert):
+        mock_bulk_insert.side_effect = lambda session, model, rows: len(rows)
+        body = (
+            '{"firstName": "Bob", "lastName": "Green", "capNumber": "100"}\n'
+            '\n'
+            '{"firstName": "Bob", \n'
+        )
+        result = self.test_client.post('/riders/import', data=body, content_type='application/x-ndjson')
+        self.assertEqual(result.json['created'], 1)
+        self.assertEqual(result.json['errors'], [{'row': 2, 'errors': ['Invalid json']}])
+
+    @mock.patch('tracker.webserver.db.bulk_insert')
+    def test_import_riders_bad_body(self, mock_bulk_insert):
+        result = self.test_client.post('/riders/import', json={'firstName': 'Bob'})
+        self.assertEqual(result.status_code, 400)
+        result = self.test_client.post('/riders/import', data='x', content_type='text/plain')
+        self.assertEqual(result.status_code, 415)
+        mock_bulk_insert.assert_not_called()
+
     @mock.patch('tracker.webserver.db.create_')
     @mock.patch('tracker.webserver.db.update')
     def test_tracker_assignment_add(self, mock_create, mock_update):
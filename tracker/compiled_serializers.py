@@ -0,0 +1,155 @@
+"""
+A compiled fast path for the marshmallow serializers.
+
+compile_schema turns a schema instance into a specialised function that writes the same JSON as
+schema.dumps straight to bytes, skipping marshmallow's per-field dispatch, error store and
+intermediate dicts. Field order, formatting and null handling match the schema exactly, so the
+engine can be switched with the SERIALIZER_ENGINE env variable without clients noticing.
+"""
+import json
+import math
+import os
+from datetime import date
+from enum import Enum
+
+from marshmallow import fields, missing, utils
+
+from tracker.serializers import EnumName
+
+ENGINES = ('marshmallow', 'compiled')
+ENGINE = os.environ.get('SERIALIZER_ENGINE', 'marshmallow')
+
+_compiled = {}
+
+
+def _int(value):
+    # marshmallow refuses booleans for number fields
+    if value is True or value is False:
+        raise TypeError('value must be a Number, not a boolean.')
+    return int.__repr__(int(value))
+
+
+def _float(value):
+    if value is True or value is False:
+        raise TypeError('value must be a Number, not a boolean.')
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError('Special numeric values (nan or infinity) are not permitted.')
+    return float.__repr__(value)
+
+
+def _get_path(obj, path, default):
+    for key in path:
+        obj = getattr(obj, key, default)
+        if obj is default:
+            break
+    return obj
+
+
+def _field_expression(name, field, index, namespace):
+    """Return a python expression that renders the non-missing value v of field as JSON text."""
+    field_type = type(field)
+    if isinstance(field, EnumName):
+        return "'null' if v is None else _enc(v.name if isinstance(v, _Enum) else _text(v))"
+    if field_type is fields.String:
+        return "'null' if v is None else _enc(_text(v))"
+    if field_type is fields.Integer and not field.as_string:
+        return "'null' if v is None else _int(v)"
+    if field_type is fields.Float and not field.as_string and not field.allow_nan:
+        return "'null' if v is None else _float(v)"
+    if field_type is fields.Date and (field.format or field.DEFAULT_FORMAT) in ('iso', 'iso8601'):
+        return "'null' if v is None else '\"' + _date_iso(v) + '\"'"
+    if field_type is fields.DateTime and (field.format or field.DEFAULT_FORMAT) in ('iso', 'iso8601'):
+        return "'null' if v is None else '\"' + _isoformat(v) + '\"'"
+    if field_type is fields.Nested:
+        namespace['_nested_%d' % index] = _compile(field.schema, field.many)
+        return "'null' if v is None else _nested_%d(v)" % index
+    if field_type is fields.Field:
+        return '_dumps(v)'
+    # anything else goes through the field's own formatting
+    namespace['_field_%d' % index] = field
+    return '_dumps(_field_%d._serialize(v, %r, obj))' % (index, name)
+
+
+def _compile(schema, many):
+    """Return a function rendering one object, or a list of objects if many, as JSON text."""
+    namespace = {
+        '_missing': missing,
+        '_enc': json.encoder.encode_basestring_ascii,
+        '_text': utils.ensure_text_type,
+        '_Enum': Enum,
+        '_int': _int,
+        '_float': _float,
+        '_date_iso': date.isoformat,
+        '_isoformat': utils.isoformat,
+        '_dumps': json.dumps,
+        '_get_path': _get_path,
+    }
+    lines = ['def dump_one(obj):', '    out = []']
+    for index, (name, field) in enumerate(schema.fields.items()):
+        if field.load_only:
+            continue
+        key = field.data_key or name
+        attribute = field.attribute or name
+        if not field._CHECK_ATTRIBUTE:
+            namespace['_field_%d' % index] = field
+            lines.append('    v = _field_%d.serialize(%r, obj, accessor=_accessor)' % (index, name))
+            namespace['_accessor'] = schema.get_attribute
+            lines.append('    if v is not _missing:')
+            lines.append('        out.append(%r + _dumps(v))' % (json.dumps(key) + ': '))
+            continue
+        if '.' in attribute:
+            lines.append('    v = _get_path(obj, %r, _missing)' % (tuple(attribute.split('.')),))
+        else:
+            lines.append('    v = getattr(obj, %r, _missing)' % attribute)
+        default = getattr(field, 'default', missing)
+        if default is not missing:
+            namespace['_default_%d' % index] = default
+            if callable(default):
+                lines.append('    if v is _missing: v = _default_%d()' % index)
+            else:
+                lines.append('    if v is _missing: v = _default_%d' % index)
+        lines.append('    if v is not _missing:')
+        lines.append('        out.append(%r + (%s))' % (
+            json.dumps(key) + ': ',
+            _field_expression(name, field, index, namespace),
+        ))
+    lines.append("    return '{' + ', '.join(out) + '}'")
+    lines.append('def dump_many(objs):')
+    lines.append("    return '[' + ', '.join([dump_one(obj) for obj in objs]) + ']'")
+    exec(compile('\n'.join(lines), '<compiled %s>' % type(schema).__name__, 'exec'), namespace)
+    return namespace['dump_many'] if many else namespace['dump_one']
+
+
+def compile_schema(schema):
+    """
+    Return a function that renders obj exactly as schema.dumps(obj) would, as utf-8 bytes.
+
+    Compiled functions are cached per schema instance.
+
+    :param schema: marshmallow schema instance, its many option is respected.
+    :return: function taking an object (or list of objects) and returning bytes.
+    """
+    cached = _compiled.get(id(schema))
+    if cached is None or cached[0] is not schema:
+        dump = _compile(schema, schema.many)
+        cached = (schema, lambda obj: dump(obj).encode('utf-8'))
+        _compiled[id(schema)] = cached
+    return cached[1]
+
+
+def dumps(schema, obj, engine=None):
+    """
+    Render obj with schema as JSON bytes using the selected serializer engine.
+
+    :param schema: marshmallow schema instance.
+    :param obj: object, or list of objects for many schemas, to render.
+    :param engine: 'marshmallow' or 'compiled', defaults to the SERIALIZER_ENGINE env variable.
+    :return: bytes.
+    """
+    engine = engine or ENGINE
+    if engine == 'compiled':
+        return compile_schema(schema)(obj)
+    if engine == 'marshmallow':
+        return schema.dumps(obj).encode('utf-8')
+    raise ValueError('Unknown serializer engine %s, choose from %s' % (engine, ENGINES))
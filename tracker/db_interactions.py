@@ -1,50 +1,496 @@
 """A set of helper functions to interact with the DB, using SQLA ORM"""
 # todo add typehinting
 
+import base64
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import weakref
 from contextlib import contextmanager
+from datetime import date, datetime
 
-from sqlalchemy import create_engine
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import create_engine, event, inspect, or_, and_, tuple_, nullsfirst, nullslast, bindparam, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# pool settings of engines on server dbs, each overridden by the env variable of the same name
+POOL_SETTINGS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    # seconds before a connection is replaced, below server side idle timeouts
+    'DB_POOL_RECYCLE': 1800,
+    # test each connection as it is checked out, so connections dropped by the server are replaced
+    'DB_POOL_PRE_PING': 1,
+}
 
-def set_up_engine():
+# pragmas set on every connection to a sqlite file, each overridden by the env variable SQLITE_<NAME>,
+# e.g. SQLITE_SYNCHRONOUS=FULL. SQLITE_PROFILE=0 leaves sqlite's defaults.
+SQLITE_PRAGMAS = {
+    # readers see the last commit while a write is in progress, instead of waiting for it
+    'journal_mode': 'WAL',
+    # in WAL mode, a power loss may lose the last commits but never corrupts the db
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    # negative sizes are in KiB, 64MiB per connection
+    'cache_size': -64 * 1024,
+    # milliseconds a statement waits for another connection's lock before failing as busy
+    'busy_timeout': 5000,
+    'foreign_keys': 'ON',
+}
+
+
+class PoolStats(object):
     """
-    Return a db engine to use, as long as env variables are set properly.
+    Connection, checkout and checkin counts of an engine's pool, and how long checkouts waited.
 
-    :return:
+    Waits are only timed for TimedQueuePool, the pool of engines on server dbs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {
+            'connects': 0, 'checkouts': 0, 'checkins': 0, 'invalidations': 0,
+            'waits': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'timeouts': 0,
+        }
+
+    def install(self, engine_):
+        event.listen(engine_, 'connect', lambda *args: self._count('connects'))
+        event.listen(engine_, 'checkout', lambda *args: self._count('checkouts'))
+        event.listen(engine_, 'checkin', lambda *args: self._count('checkins'))
+        event.listen(engine_, 'invalidate', lambda *args: self._count('invalidations'))
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def waited(self, seconds, timed_out=False):
+        with self._lock:
+            self.stats['waits'] += 1
+            self.stats['wait_seconds'] += seconds
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], seconds)
+            if timed_out:
+                self.stats['timeouts'] += 1
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording in its PoolStats how long each checkout waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        self.stats = kwargs.pop('stats', None) or PoolStats()
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            self.stats.waited(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.waited(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # e.g. on engine.dispose(), the new pool keeps counting into the same stats
+        pool = super(TimedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+
+# PoolStats and sqlite pragmas of each engine made by make_engine
+_pool_stats = weakref.WeakKeyDictionary()
+_sqlite_pragmas = weakref.WeakKeyDictionary()
+
+
+def is_sqlite_file(url):
+    """Return whether url is of a sqlite db in a file, rather than in memory."""
+    url = make_url(url)
+    return url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:')
+
+
+def sqlite_pragmas(environ=None):
+    """
+    Return the pragmas of SQLITE_PRAGMAS with their env overrides, or {} if SQLITE_PROFILE is 0.
+
+    :param environ: mapping of env variables, defaults to os.environ.
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get('SQLITE_PROFILE', '1') != '1':
+        return {}
+    return {name: environ.get('SQLITE_' + name.upper(), default) for name, default in SQLITE_PRAGMAS.items()}
+
+
+def engine_options(url, environ=None):
     """
-    db_type = 'sqlite:///'
-    db_uri = ''
-    if db_type is not None and db_uri is not None:
-        engine_ = create_engine(db_type + db_uri)
-        Base.metadata.create_all(engine_)
+    Return create_engine keyword arguments for url, with the pool settings of POOL_SETTINGS.
+
+    In-memory sqlite keeps the pool sqlalchemy chooses for it, one connection per thread. Sqlite
+    files with the pragmas of sqlite_pragmas share a pool too, so pragmas are set once per
+    connection rather than on every checkout.
+
+    :param url: db url.
+    :param environ: mapping of env variables, defaults to os.environ.
+    """
+    environ = os.environ if environ is None else environ
+    sqlite_file = is_sqlite_file(url)
+    if url.startswith('sqlite') and not (sqlite_file and sqlite_pragmas(environ)):
+        return {}
+    settings = {name: int(environ.get(name, default)) for name, default in POOL_SETTINGS.items()}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['DB_POOL_SIZE'],
+        'max_overflow': settings['DB_MAX_OVERFLOW'],
+        'pool_timeout': settings['DB_POOL_TIMEOUT'],
+    }
+    if sqlite_file:
+        # pooled connections move between threads, each is used by one thread at a time
+        options['connect_args'] = {'check_same_thread': False}
     else:
-        engine_ = None
+        options.update(
+            pool_recycle=settings['DB_POOL_RECYCLE'],
+            pool_pre_ping=bool(settings['DB_POOL_PRE_PING']),
+        )
+    return options
+
+
+def _set_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
+    return connect
+
+
+def make_engine(url, environ=None):
+    """
+    Return an engine on url with the pool settings of engine_options, counting pool use in PoolStats.
+
+    Connections to sqlite files get the pragmas of sqlite_pragmas.
+
+    :param url: db url.
+    :param environ: mapping of env variables, defaults to os.environ.
+    """
+    options = engine_options(url, environ)
+    engine_ = create_engine(url, **options)
+    stats = getattr(engine_.pool, 'stats', None) or PoolStats()
+    stats.install(engine_)
+    _pool_stats[engine_] = stats
+    pragmas = sqlite_pragmas(environ) if is_sqlite_file(url) else {}
+    if pragmas:
+        event.listen(engine_, 'connect', _set_pragmas(pragmas))
+    _sqlite_pragmas[engine_] = pragmas
     return engine_
 
+
+def engine_pragmas(engine_):
+    """Return the pragmas set on connections of an engine made by make_engine, {} for none."""
+    return _sqlite_pragmas.get(engine_, {})
+
+
+def is_busy(error):
+    """Return whether error is sqlite failing on a lock held by another connection."""
+    return isinstance(error, OperationalError) and any(
+        message in str(error.orig) for message in ('database is locked', 'database table is locked',
+                                                    'database is busy')
+    )
+
+
+# retries of functions decorated by retry_busy, and failures after the last attempt
+busy_stats = {'retries': 0, 'failures': 0}
+
+
+def retry_busy(func=None, attempts=5, backoff=0.02):
+    """
+    Decorator running func again when sqlite is busy, after waiting with exponential backoff.
+
+    busy_timeout already waits for locks, but a transaction that read before it writes fails at
+    once if another connection committed in between, and retrying it is the only way through.
+    Decorated functions must leave nothing behind when they fail, as with session_scope, which
+    rolls its session back.
+
+    :param func: function to decorate.
+    :param attempts: number of times func is run at most.
+    :param backoff: seconds waited before the first retry, doubled for each one after, with jitter.
+    """
+    if func is None:
+        return functools.partial(retry_busy, attempts=attempts, backoff=backoff)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_busy(e):
+                    raise
+                if attempt == attempts - 1:
+                    busy_stats['failures'] += 1
+                    raise
+                busy_stats['retries'] += 1
+                delay = backoff * 2 ** attempt
+                logger.info('%s: db busy, retrying in %.3fs', func.__name__, delay)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+class WalCheckpointer(object):
+    """
+    Checkpoint the WAL of a sqlite db from a background thread.
+
+    Sqlite checkpoints on the commit that takes the WAL past wal_autocheckpoint pages, in the
+    request making it. Passive checkpoints every interval keep the WAL short so that rarely
+    happens, and a WAL that grew past truncate_pages while readers held it is truncated once
+    they let go.
+
+    :param engine_: engine on a sqlite file in WAL mode.
+    :param interval: seconds between checkpoints.
+    :param truncate_pages: WAL pages after which the checkpoint truncates the WAL.
+    """
+
+    def __init__(self, engine_, interval=10.0, truncate_pages=10000):
+        self.engine = engine_
+        self.interval = interval
+        self.truncate_pages = truncate_pages
+        self._thread = None
+        self.stats = {'checkpoints': 0, 'truncates': 0, 'busy': 0, 'wal_pages': 0, 'checkpointed_pages': 0}
+
+    def checkpoint(self):
+        """Run one checkpoint, truncating the WAL if it is over truncate_pages pages."""
+        # a raw connection, so checkpoints are not counted as statements of any request
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            busy, wal_pages, checkpointed = cursor.fetchone()
+            if wal_pages > self.truncate_pages:
+                cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                busy, wal_pages, checkpointed = cursor.fetchone()
+                if not busy:
+                    self.stats['truncates'] += 1
+        finally:
+            connection.close()
+        self.stats['checkpoints'] += 1
+        self.stats['busy'] += busy
+        self.stats['wal_pages'] = max(wal_pages, 0)
+        self.stats['checkpointed_pages'] = max(checkpointed, 0)
+
+    def start(self):
+        """Start a daemon thread checkpointing every interval seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='wal-checkpointer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception('WAL checkpoint failed')
+
+
+def pool_stats(engine_=None):
+    """
+    Return pool use of an engine made by make_engine: checkout counts and waits, and the pool's
+    current size and connections checked out where the pool keeps them.
+
+    :param engine_: engine, defaults to the app's engine.
+    """
+    engine_ = engine_ or engine
+    pool = engine_.pool
+    info = dict(_pool_stats[engine_].stats, pool=type(pool).__name__)
+    if isinstance(pool, QueuePool):
+        info.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    return info
+
+
+def set_up_engine():
+    """
+    Return an engine on the db given by the DB_TYPE and DB_URI env variables, e.g. 'postgresql://'
+    and 'user:password@host/tracker', or None if they are not set.
+
+    Tables and indexes are not created here, run tracker.migrate to bring a db up to the models.
+
+    :return: engine or None.
+    """
+    db_type = os.environ.get('DB_TYPE')
+    db_uri = os.environ.get('DB_URI')
+    if db_type is None or db_uri is None:
+        return None
+    return make_engine(db_type + db_uri)
+
+
+def missing_columns(engine_):
+    """
+    Return the columns declared on the models that existing tables of a db do not have yet.
+
+    create_all skips tables that already exist, so columns added to the models later are only
+    added by add_missing_columns.
+
+    :param engine_: db engine.
+    :return: list of sqlalchemy Column objects.
+    """
+    inspector = inspect(engine_)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing)
+    return missing
+
+
+def add_column_statement(engine_, column):
+    """
+    Return the ALTER TABLE statement adding a column to its existing table.
+
+    Existing rows get the column's server default, which NOT NULL columns must have.
+
+    :param engine_: db engine.
+    :param column: sqlalchemy Column of a model.
+    :return: sql string.
+    """
+    if not column.nullable and column.server_default is None:
+        raise ValueError('%s is NOT NULL without a server default, existing rows would break it' % column)
+    dialect = engine_.dialect
+    return 'ALTER TABLE %s ADD COLUMN %s' % (
+        dialect.identifier_preparer.format_table(column.table),
+        dialect.ddl_compiler(dialect, None).get_column_specification(column),
+    )
+
+
+def add_missing_columns(engine_):
+    """
+    Add the columns declared on the models that existing tables of the db do not have yet.
+
+    :param engine_: db engine.
+    :return: list of the names of the columns added, as table.column.
+    """
+    missing = missing_columns(engine_)
+    for column in missing:
+        engine_.execute(add_column_statement(engine_, column))
+    return [str(column) for column in missing]
+
+
+def missing_indexes(engine_):
+    """
+    Return the indexes declared on the models that an existing db does not have yet.
+
+    create_all skips tables that already exist, so indexes added to the models later are
+    only built by create_missing_indexes.
+
+    :param engine_: db engine.
+    :return: list of sqlalchemy Index objects.
+    """
+    inspector = inspect(engine_)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in sorted(table.indexes, key=lambda i: i.name) if index.name not in existing)
+    return missing
+
+
+def create_missing_indexes(engine_):
+    """
+    Build the indexes declared on the models that the db does not have yet.
+
+    :param engine_: db engine.
+    :return: list of the names of the indexes built.
+    """
+    missing = missing_indexes(engine_)
+    for index in missing:
+        index.create(engine_)
+    return [index.name for index in missing]
+
+
 engine = set_up_engine()
+# no db configured, e.g. in development and the tests: an in-memory sqlite db per thread, which
+# starts empty and has nothing to migrate, so tracker.models creates its tables
+in_memory = engine is None
+if in_memory:
+    engine = make_engine('sqlite:///')
+
+# function returning the session of the current request, or None outside of requests
+_request_session = None
+
+
+def use_request_sessions(request_session):
+    """
+    Make session_scope use the session of the current request, so each request has one session.
+
+    :param request_session: function returning the session of the current request or None, the
+        caller closes the session when its request ends.
+    """
+    global _request_session
+    _request_session = request_session
+
+
+# router choosing the engine of read only sessions among replicas, None to read from the primary
+_replicas = None
+
+
+def use_replicas(router):
+    """
+    Route read only session_scopes through router, e.g. a replicas.ReplicaRouter.
+
+    :param router: object whose engine() returns the engine of the next read only session, or
+        None to read from the primary again.
+    """
+    global _replicas
+    _replicas = router
+
 
 @contextmanager
-def session_scope(commit=False, engine=engine):
-    """Provide a transactional scope around a series of operations."""
-    if not engine:
-        engine = set_up_engine()
-    session = Session(bind=engine)
-    if commit:
-        try:
-            yield session
+def session_scope(commit=False, engine=None, read_only=False):
+    """
+    Provide a transactional scope around a series of operations.
+
+    Within a request the request's session is used, and released when the request ends. Otherwise,
+    or when given an engine, a new session is used and closed at the end of the block.
+
+    :param commit: bool as to whether commit at the end of the block.
+    :param engine: engine of a new session, defaults to the app's engine.
+    :param read_only: bool as to whether the block only reads, so it may be served by a replica in
+        a new session of its own.
+    """
+    session = None
+    if engine is None and read_only and _replicas is not None:
+        replica = _replicas.engine()
+        if replica is not globals()['engine']:
+            engine = replica
+    if engine is None and _request_session is not None:
+        session = _request_session()
+    owned = session is None
+    if owned:
+        # the module's engine, shadowed by the argument
+        session = Session(bind=engine or globals()['engine'])
+    try:
+        yield session
+        if commit:
             session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
+    except:
+        session.rollback()
+        raise
+    finally:
+        if owned:
             session.close()
-    else:
-        yield session
 
 
 def create_(session, instance, commit=False):
@@ -83,14 +529,238 @@ def create(session, model, commit=False, **kwargs):
     if commit:
         try:
             session.commit()
-            return instance
         except IntegrityError:
             return False
+    return instance
+
+
+def bulk_insert(session, model, rows):
+    """
+    Insert many rows with executemany, skipping the ORM unit of work.
+
+    Rows are grouped by the columns they set, so there is one statement per distinct set of keys
+    and columns left out of a row still get their defaults.
+
+    :param session: db session, the insert joins its transaction.
+    :param model: db model to insert rows into.
+    :param rows: list of dicts of column values.
+    :return: number of rows inserted.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    for group in groups.values():
+        session.execute(model.__table__.insert(), group)
+    return len(rows)
+
+
+def _chunks(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def bulk_insert_returning_ids(session, model, rows):
+    """
+    Insert many rows and return their new ids, in the order of rows.
+
+    On postgres this is a multi row INSERT ... RETURNING. On sqlite a multi row INSERT holds the
+    write lock for the whole statement, so its rowids are consecutive and end at the cursor's
+    lastrowid. Other backends fall back to one INSERT per row.
+
+    :param session: db session, the insert joins its transaction.
+    :param model: db model to insert rows into.
+    :param rows: list of dicts of column values, all with the same keys and without ids.
+    :return: list of ids.
+    """
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    ids = []
+    if dialect == 'postgresql':
+        for chunk in _chunks(rows, 1000):
+            result = session.execute(table.insert().values(chunk).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    elif dialect == 'sqlite':
+        # keep below the default limit of 999 bound parameters per statement
+        for chunk in _chunks(rows, max(1, 999 // len(rows[0]))) if rows else ():
+            last_id = session.execute(table.insert().values(chunk)).lastrowid
+            ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+    else:
+        for row in rows:
+            ids.append(session.execute(table.insert(), row).inserted_primary_key[0])
+    return ids
+
+
+def bulk_insert_ignore(session, model, rows):
+    """
+    Insert many rows with executemany, silently skipping rows that break a unique constraint.
+
+    :param session: db session, the insert joins its transaction.
+    :param model: db model to insert rows into.
+    :param rows: list of dicts of column values, all with the same keys.
+    :return: number of rows actually inserted.
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = pg_insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    else:
+        statement = table.insert().prefix_with('IGNORE')
+    return session.execute(statement, rows).rowcount
+
+
+def bulk_upsert_latest(session, model, rows, key, order):
+    """
+    Insert or update many rows by key, keeping per key the row with the greatest order value.
+
+    Rows older than the one already stored for their key are ignored, so groups written out of
+    order never move a key backwards.
+
+    :param session: db session, the statements join its transaction.
+    :param model: db model whose table has a primary key or unique constraint on key.
+    :param rows: list of dicts of column values, all with the same keys.
+    :param key: name of the key column.
+    :param order: name of the column compared to pick the latest row, e.g. a timestamp.
+    :return: number of distinct keys given.
+    """
+    latest = {}
+    for row in rows:
+        current = latest.get(row[key])
+        if current is None or row[order] > current[order]:
+            latest[row[key]] = row
+    if not latest:
+        return 0
+    rows = list(latest.values())
+    table = model.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        statement = pg_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[key]],
+            set_={name: statement.excluded[name] for name in rows[0] if name != key},
+            where=table.c[order] < statement.excluded[order]
+        )
+        session.execute(statement, rows)
+        return len(rows)
+    stored = dict(session.query(table.c[key], table.c[order]).filter(table.c[key].in_(latest)))
+    inserts = [row for row in rows if row[key] not in stored]
+    updates = [
+        dict({name: value for name, value in row.items() if name != key}, _key=row[key])
+        for row in rows if row[key] in stored and stored[row[key]] < row[order]
+    ]
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates:
+        session.execute(table.update().where(table.c[key] == bindparam('_key')), updates)
+    return len(rows)
+
+
+def _bump_version(table, statement):
+    if 'version' in table.c:
+        statement = statement.values({table.c.version: table.c.version + 1})
+    return statement
+
+
+def bulk_update(session, model, rows):
+    """
+    Update many rows by id with executemany, bumping the version column of tables that have one.
+
+    :param session: db session, the update joins its transaction.
+    :param model: db model to update.
+    :param rows: list of dicts, each with the id of the row to update and the columns to set.
+    :return: number of rows given.
+    """
+    table = model.__table__
+    groups = {}
+    for row in rows:
+        params = {key: value for key, value in row.items() if key != 'id'}
+        params['_id'] = row['id']
+        groups.setdefault(frozenset(params), []).append(params)
+    statement = _bump_version(table, table.update().where(table.c.id == bindparam('_id')))
+    for group in groups.values():
+        session.execute(statement, group)
+    return len(rows)
+
+
+def bulk_increment(session, model, attribute, deltas, returning=True):
+    """
+    Add a delta to a numeric column of many rows in the db, returning the new values.
+
+    The version column of tables that have one is bumped along with the change.
+
+    Each row is changed by a single `column = column + :delta` statement, so concurrent changes
+    to the same row never overwrite each other. A single row is updated with UPDATE ... RETURNING
+    where the db supports it; otherwise the new values are read back with one IN query, which
+    sees this transaction's values as the updated rows stay locked until it ends.
+
+    :param session: db session, the update joins its transaction.
+    :param model: db model to update.
+    :param attribute: name of the numeric column, NULL is treated as 0.
+    :param deltas: list of (id, delta) tuples.
+    :param returning: bool as to whether to return the new values, callers that don't use them
+        save the statement reading them back.
+    :return: dict of id to the column's new value, ids not found are left out, or None if not
+        returning.
+    """
+    if not deltas:
+        return {} if returning else None
+    table = model.__table__
+    column = table.c[attribute]
+    statement = (
+        table.update()
+        .where(table.c.id == bindparam('_id'))
+        .values({column: func.coalesce(column, 0) + bindparam('_delta')})
+    )
+    if attribute != 'version':
+        statement = _bump_version(table, statement)
+    params = [{'_id': id_, '_delta': delta} for id_, delta in deltas]
+    if not returning:
+        session.execute(statement, params)
+        return None
+    if len(params) == 1 and session.get_bind().dialect.name == 'postgresql':
+        new_value = session.execute(statement.returning(column), params[0]).scalar()
+        return {} if new_value is None else {deltas[0][0]: new_value}
+    session.execute(statement, params)
+    ids = {id_ for id_, _ in deltas}
+    return dict(session.query(table.c.id, column).filter(table.c.id.in_(ids)))
+
+
+def bulk_delete(session, model, ids):
+    """
+    Delete rows by id in one statement.
+
+    :param session: db session, the delete joins its transaction.
+    :param model: db model to delete rows from.
+    :param ids: ids of the rows to delete.
+    :return: number of rows deleted.
+    """
+    if not ids:
+        return 0
+    table = model.__table__
+    return session.execute(table.delete().where(table.c.id.in_(ids))).rowcount
+
+
+def get_by_ids(session, model, ids, options=()):
+    """
+    Return instances of model with the given ids, fetched in one IN query.
+
+    :param session: db session.
+    :param model: db model to query.
+    :param ids: ids to fetch.
+    :param options: loader options applied to the query.
+    :return: dict of id to instance, ids not found are left out.
+    """
+    if not ids:
+        return {}
+    instances = session.query(model).options(*options).filter(model.id.in_(ids)).all()
+    return {instance.id: instance for instance in instances}
 
 
-def get(session, model, **kwargs):
+def get(session, model, options=(), **kwargs):
     # todo docstring here
-    instances = session.query(model).filter_by(**kwargs).all()
+    instances = session.query(model).options(*options).filter_by(**kwargs).all()
     if instances:
         return instances
     else:
@@ -112,6 +782,132 @@ def get_resources(session, start, end, model):
     return data, last_resource
 
 
+def _encode_cursor_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _decode_cursor_value(value, column):
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value[:10])
+    return python_type(value)
+
+
+def encode_cursor(sort, value, id_):
+    """
+    Return an opaque cursor pointing just after the row with the given sort value and id.
+
+    :param sort: name of the attribute the page is sorted by.
+    :param value: value of the sort attribute on the last row of the page.
+    :param id_: id of the last row of the page.
+    :return: url safe string.
+    """
+    raw = json.dumps([sort, _encode_cursor_value(value), id_], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort, column):
+    """
+    Decode a cursor made by encode_cursor, raising ValueError if it is malformed or for another sort.
+
+    :param cursor: cursor string from a previous page.
+    :param sort: name of the attribute the page is sorted by.
+    :param column: model attribute the page is sorted by, used to restore the value type.
+    :return: tuple of (sort value, id).
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, id_ = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if cursor_sort != sort or not isinstance(id_, int):
+        raise ValueError('Cursor does not match sort order')
+    try:
+        return _decode_cursor_value(value, column), id_
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor value') from e
+
+
+def page_query(session, model, limit, sort='id', cursor=None, start=None, options=(), filters=()):
+    """
+    Return the query for one page of get_page, for callers that iterate rows themselves.
+
+    The query returns up to limit + 1 rows, the extra row showing there is a next page; use
+    page_cursor on the limit-th row for its cursor. Arguments are as for get_page.
+    """
+    sort_column = getattr(model, sort)
+    query = session.query(model).options(*options).filter(*filters)
+    if start is not None:
+        query = query.filter(model.id >= start)
+    if sort == 'id':
+        if cursor is not None:
+            query = query.filter(model.id > decode_cursor(cursor, sort, sort_column)[1])
+        query = query.order_by(model.id)
+    else:
+        nulls_last = _nulls_last(session)
+        if cursor is not None:
+            last_value, last_id = decode_cursor(cursor, sort, sort_column)
+            # rows after the cursor in index order, where the db keeps NULLs first or last
+            if last_value is None:
+                after = and_(sort_column.is_(None), model.id > last_id)
+                if not nulls_last:
+                    after = or_(after, sort_column.isnot(None))
+            else:
+                after = tuple_(sort_column, model.id) > tuple_(last_value, last_id)
+                if nulls_last:
+                    after = or_(after, sort_column.is_(None))
+            query = query.filter(after)
+        # the order of the (sort, id) index, so pages are read from it without sorting
+        query = query.order_by((nullslast if nulls_last else nullsfirst)(sort_column), model.id)
+    return query.limit(limit + 1)
+
+
+def _nulls_last(session):
+    """Return whether the db sorts NULLs after other values in ascending order and indexes."""
+    return session.get_bind().dialect.name == 'postgresql'
+
+
+def page_cursor(instance, sort='id'):
+    """Return the cursor of the page following instance, for pages sorted by sort."""
+    return encode_cursor(sort, getattr(instance, sort), instance.id)
+
+
+def get_page(session, model, limit, sort='id', cursor=None, start=None, options=(), filters=()):
+    """
+    Return one page of resources ordered by (sort, id), using keyset pagination.
+
+    Rows are fetched with a single query for limit + 1 rows seeking past the cursor, so gaps in
+    ids never produce short pages and no OFFSET scan is needed. NULL sort values come where the
+    db's (sort, id) index keeps them: first on sqlite, last on postgres.
+
+    :param session: db session.
+    :param model: db model to page through.
+    :param limit: maximum number of rows to return.
+    :param sort: name of the model attribute to sort by.
+    :param cursor: cursor returned with the previous page, or None for the first page.
+    :param start: optional lowest id to return.
+    :param options: loader options applied to the query, e.g. a serializer loading profile.
+    :param filters: criteria restricting the rows paged through.
+    :return: tuple of (list of instances, cursor for the next page or None).
+    """
+    data = page_query(session, model, limit, sort, cursor, start, options, filters).all()
+    if len(data) > limit:
+        data = data[:limit]
+        return data, page_cursor(data[-1], sort)
+    return data, None
+
+
+def has_rows(session, model):
+    """Return True if the table for model has at least one row."""
+    return session.query(model.id).limit(1).first() is not None
+
+
 def get_or_create(session, model, commit=False, **kwargs):
     # todo docstring here
     instances = session.query(model).filter_by(**kwargs).all()
@@ -135,8 +931,40 @@ def get_and_delete(session, model, commit=False, **kwargs):
         return False
 
 
+def patch(session, model, id_, values, options=()):
+    """
+    Set columns of one row by id, bumping its version, and return the row loaded in the session.
+
+    The change is one UPDATE, then the row is loaded with options as GET loads it, so the
+    instance returned renders and lazy loads like any other. That is one statement more than
+    reading the row; a patch of a missing row stops at the UPDATE.
+
+    :param session: db session, the update joins its transaction.
+    :param model: db model to update.
+    :param id_: id of the row.
+    :param values: dict of attribute names to new values, e.g. a patch loaded by sl.rider_patch.
+    :param options: query options loading the row, e.g. the loading profile of its serializer.
+    :return: instance of model, or None if there is no row with id_.
+    """
+    mapper = inspect(model)
+    if values:
+        table = model.__table__
+        statement = table.update().where(table.c.id == id_).values(
+            {mapper.column_attrs[key].columns[0]: value for key, value in values.items()}
+        )
+        if session.execute(_bump_version(table, statement)).rowcount == 0:
+            return None
+        # an instance the session already holds is now out of date
+        held = session.identity_map.get(mapper.identity_key_from_primary_key((id_,)))
+        if held is not None:
+            session.expire(held)
+    return session.query(model).options(*options).filter(model.id == id_).first()
+
+
 def update(session, model, to_be_updated: dict, commit=False, **filter_):
     # todo docstring here
+    if hasattr(model, 'version'):
+        to_be_updated = dict(to_be_updated, version=model.version + 1)
     n_rows_updated = session.query(model).filter_by(**filter_).update(to_be_updated)
     if n_rows_updated > 0:
         if commit:
@@ -0,0 +1,176 @@
+"""In-process map of tracker ESNs to the tracker and the rider it is currently assigned to."""
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from tracker import db_interactions as db
+from tracker.models import Trackers, RiderAssignment
+
+
+
+def _query(session, *criteria):
+    return session.query(
+        Trackers.esn_number,
+        Trackers.id,
+        RiderAssignment.rider
+    ).outerjoin(
+        RiderAssignment,
+        Trackers.rider_assigned == RiderAssignment.id
+    ).filter(*criteria)
+
+
+class EsnIndex(object):
+    """
+    Resolve ESNs to (tracker id, rider id or None) from memory, loading misses from the db.
+
+    Entries are kept current by reloading changed trackers after their transaction commits.
+    Trackers inserted or updated through the ORM are picked up by mapper events once install()
+    has been called; bulk writes must call changed() with the tracker ids they touch, or
+    assigned() with the entries they leave when they already know them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._esns = {}
+        # bumped by every reload, so a miss loaded concurrently with a reload is not cached stale
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+        # key in session.info holding tracker ids to reload once the session commits
+        self._pending = ('esn_index_pending', id(self))
+        # key in session.info marking sessions this index listens to
+        self._listening = ('esn_index_listening', id(self))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, session, esns):
+        """
+        Resolve ESNs, with one query for all the ESNs that are not in memory.
+
+        :param session: db session used to load misses.
+        :param esns: iterable of ESN strings.
+        :return: dict of esn to (tracker id, rider id or None), unknown ESNs are left out.
+        """
+        found = {}
+        missing = set()
+        with self._lock:
+            for esn in set(esns):
+                entry = self._entries.get(esn)
+                if entry is None:
+                    missing.add(esn)
+                else:
+                    found[esn] = entry
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(missing)
+            generation = self._generation
+        if missing:
+            loaded = {
+                esn: (tracker_id, rider_id)
+                for esn, tracker_id, rider_id in _query(session, Trackers.esn_number.in_(missing))
+            }
+            with self._lock:
+                if generation == self._generation:
+                    for esn, entry in loaded.items():
+                        self._set(esn, entry)
+            found.update(loaded)
+        return found
+
+    def _set(self, esn, entry):
+        self._entries[esn] = entry
+        self._esns[entry[0]] = esn
+
+    def reload(self, session, tracker_ids):
+        """
+        Replace the entries of trackers with their current db state.
+
+        :param session: db session.
+        :param tracker_ids: ids of trackers whose ESN or assignment may have changed.
+        """
+        tracker_ids = set(tracker_ids)
+        if not tracker_ids:
+            return
+        self._replace(tracker_ids, _query(session, Trackers.id.in_(tracker_ids)).all())
+        self.stats['reloads'] += 1
+
+    def _replace(self, tracker_ids, rows):
+        with self._lock:
+            for tracker_id in tracker_ids:
+                esn = self._esns.pop(tracker_id, None)
+                if esn is not None and self._entries.get(esn, (None,))[0] == tracker_id:
+                    del self._entries[esn]
+            for esn, tracker_id, rider_id in rows:
+                if esn is not None:
+                    self._set(esn, (tracker_id, rider_id))
+            self._generation += 1
+
+    def changed(self, session, tracker_ids):
+        """
+        Reload trackers once session commits, nothing is reloaded if it rolls back.
+
+        :param session: session the trackers are written in.
+        :param tracker_ids: ids of trackers written.
+        """
+        self._pending_in(session).update(dict.fromkeys(tracker_ids))
+
+    def assigned(self, session, entries):
+        """
+        Set the entries of trackers once session commits, without reloading them.
+
+        Trackers also passed to changed() in the session are reloaded instead.
+
+        :param session: session the trackers are written in.
+        :param entries: dict of tracker id to (esn, rider id or None), as the session leaves them.
+        """
+        pending = self._pending_in(session)
+        for tracker_id, entry in entries.items():
+            if pending.get(tracker_id, entry) is not None:
+                pending[tracker_id] = entry
+
+    def _pending_in(self, session):
+        # listeners are added once per session, a request's session may commit many times
+        if self._listening not in session.info:
+            session.info[self._listening] = True
+            event.listen(session, 'after_commit', self._after_commit)
+            event.listen(session, 'after_soft_rollback', self._after_rollback)
+        # tracker ids to their entries, or None for those to reload
+        return session.info.setdefault(self._pending, {})
+
+    def _after_commit(self, session):
+        pending = session.info.pop(self._pending, None)
+        if not pending:
+            return
+        known = {tracker_id: entry for tracker_id, entry in pending.items() if entry is not None}
+        if known:
+            self._replace(known, [(esn, tracker_id, rider_id) for tracker_id, (esn, rider_id) in known.items()])
+        tracker_ids = [tracker_id for tracker_id, entry in pending.items() if entry is None]
+        if not tracker_ids:
+            return
+        # the committed session cannot emit sql, reload in a new one on the same engine
+        with db.session_scope(engine=session.bind) as reload_session:
+            self.reload(reload_session, tracker_ids)
+            reload_session.close()
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop(self._pending, None)
+
+    def clear(self):
+        """Drop all entries, they are loaded again on lookup."""
+        with self._lock:
+            self._entries = {}
+            self._esns = {}
+
+    def install(self):
+        """Reload trackers inserted or updated through the ORM after they are committed."""
+        event.listen(Trackers, 'after_insert', self._tracker_written)
+        event.listen(Trackers, 'after_update', self._tracker_written)
+
+    def uninstall(self):
+        event.remove(Trackers, 'after_insert', self._tracker_written)
+        event.remove(Trackers, 'after_update', self._tracker_written)
+
+    def _tracker_written(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            self.changed(session, [target.id])
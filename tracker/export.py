@@ -0,0 +1,169 @@
+"""
+Streamed NDJSON and CSV dumps of whole tables, for after-race exports.
+
+Each dataset is read with keyset batches of BATCH_SIZE rows over its primary key, as plain
+rows without the ORM, and written out batch by batch, so memory use does not depend on the
+size of the table. Rows are flat: related rows are in their own dataset, joined by id, e.g.
+rider_events.rider is the id of a row in riders.
+
+Run from the command line with: python export.py riders --format csv --output riders.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import date, datetime
+from enum import Enum
+
+from sqlalchemy import select
+
+from tracker import db_interactions as db
+from tracker.models import Riders, RiderEvents, RiderNotes, Trackers, TrackerEvents, TrackerNotes
+
+DATASETS = {
+    'riders': Riders,
+    'rider_events': RiderEvents,
+    'rider_notes': RiderNotes,
+    'trackers': Trackers,
+    'tracker_events': TrackerEvents,
+    'tracker_notes': TrackerNotes,
+}
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# rows read per query
+BATCH_SIZE = 5000
+
+
+def _enum_names(column, encode, null):
+    """Map an enum column's members, and None, to their rendered names."""
+    names = {member: encode(member.name) for member in column.type.enum_class}
+    names[None] = null
+    return names
+
+
+def _compile_row(table, format_):
+    """
+    Return a function rendering a row of table, built once per export so each value is
+    converted by code chosen for its column type rather than by inspecting the value.
+
+    For ndjson the function returns a line of json, for csv the list of cell values.
+    """
+    namespace = {'_enc': json.encoder.encode_basestring_ascii, '_int': int.__repr__, '_float': float.__repr__}
+    keys = []
+    parts = []
+    for index, column in enumerate(table.columns):
+        value = 'row[%d]' % index
+        python_type = None
+        if getattr(column.type, 'enum_class', None) is not None:
+            python_type = Enum
+        else:
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:
+                pass
+        if format_ == 'csv':
+            if python_type is Enum:
+                namespace['_enum_%d' % index] = _enum_names(column, str, None)
+                parts.append('_enum_%d[%s]' % (index, value))
+            elif python_type in (date, datetime):
+                parts.append('None if %s is None else %s.isoformat()' % (value, value))
+            else:
+                parts.append(value)
+            continue
+        key = json.dumps(column.name) + ': '
+        if python_type is Enum:
+            namespace['_enum_%d' % index] = _enum_names(column, namespace['_enc'], 'null')
+            rendered = '_enum_%d[%s]' % (index, value)
+        elif python_type is str:
+            rendered = "'null' if %s is None else _enc(%s)" % (value, value)
+        elif python_type is int:
+            rendered = "'null' if %s is None else _int(%s)" % (value, value)
+        elif python_type is float:
+            rendered = "'null' if %s is None else _float(float(%s))" % (value, value)
+        elif python_type in (date, datetime):
+            rendered = "'null' if %s is None else '\"' + %s.isoformat() + '\"'" % (value, value)
+        else:
+            namespace['_dumps'] = json.dumps
+            rendered = '_dumps(%s)' % value
+        keys.append(key.replace('%', '%%') + '%s')
+        parts.append('(%s)' % rendered)
+    if format_ == 'csv':
+        body = '[' + ', '.join(parts) + ']'
+    else:
+        # one format operation per row
+        body = '%r %% (%s,)' % ('{' + ', '.join(keys) + '}\n', ', '.join(parts))
+    source = 'def render(row):\n    return ' + body
+    exec(compile(source, '<export %s %s>' % (table.name, format_), 'exec'), namespace)
+    return namespace['render']
+
+
+def _rows(session, table, batch_size):
+    """Yield lists of up to batch_size rows of table, in primary key order."""
+    key = list(table.primary_key.columns)[0]
+    query = select(list(table.columns)).order_by(key).limit(batch_size)
+    last = None
+    while True:
+        batch = session.execute(query if last is None else query.where(key > last)).fetchall()
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][key.name]
+
+
+def export(session, dataset, format_, batch_size=BATCH_SIZE):
+    """
+    Yield a dataset as chunks of utf-8 encoded NDJSON or CSV, one chunk per batch of rows.
+
+    :param session: db session to read with.
+    :param dataset: one of DATASETS.
+    :param format_: one of FORMATS.
+    :param batch_size: rows read per query.
+    :return: generator of bytes.
+    """
+    if dataset not in DATASETS:
+        raise ValueError('Unknown dataset %s, choose from %s' % (dataset, ', '.join(sorted(DATASETS))))
+    if format_ not in FORMATS:
+        raise ValueError('Unknown format %s, choose from %s' % (format_, ', '.join(sorted(FORMATS))))
+    table = DATASETS[dataset].__table__
+    render = _compile_row(table, format_)
+    if format_ == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([column.name for column in table.columns])
+        for batch in _rows(session, table, batch_size):
+            writer.writerows([render(row) for row in batch])
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+    else:
+        for batch in _rows(session, table, batch_size):
+            yield ''.join([render(row) for row in batch]).encode('utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a dataset as NDJSON or CSV.')
+    parser.add_argument('dataset', choices=sorted(DATASETS))
+    parser.add_argument('--format', dest='format_', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('--output', help='file to write, defaults to stdout')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        with db.session_scope() as session:
+            for chunk in export(session, args.dataset, args.format_, args.batch_size):
+                output.write(chunk)
+            session.close()
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Buffered ingestion of tracker position fixes."""
+import logging
+import threading
+import time
+from datetime import datetime
+
+from tracker import db_interactions as db
+from tracker.models import LatestPositions, TrackerLocations
+
+logger = logging.getLogger(__name__)
+
+
+class PositionWriter(object):
+    """
+    Buffers position rows and writes them in groups, each group in one transaction.
+
+    A group is written when the buffer reaches batch_size rows, when the oldest buffered row is
+    older than max_delay seconds, or on flush(). If started, a background thread also flushes
+    every max_delay seconds so quiet periods do not leave fixes unwritten. Repeated fixes (same
+    tracker and time) are rejected by add() while buffered; repeats of fixes already in the db are
+    skipped by the unique constraint when written and counted as duplicates. Each group also moves
+    latest_positions forward, in the same transaction.
+
+    A group whose write fails is kept and written again by the next flushes, up to max_attempts
+    writes in all; its rows are then dropped and counted as dropped.
+
+    :param batch_size: most rows written in one group.
+    :param max_delay: seconds a row may wait in the buffer.
+    :param max_attempts: writes of a group before its rows are dropped.
+    """
+
+    def __init__(self, batch_size=500, max_delay=1.0, max_attempts=3):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        self._keys = set()
+        self._oldest = None
+        # (failed writes, rows) of groups to write again, only used under _flush_lock
+        self._retries = []
+        self._thread = None
+        self.stats = {
+            'buffered': 0, 'written': 0, 'duplicates': 0, 'flushes': 0, 'failed': 0, 'retrying': 0, 'dropped': 0,
+        }
+
+    def add(self, rows):
+        """
+        Buffer position rows, flushing if the buffer is full or old enough.
+
+        :param rows: list of dicts of tracker_locations column values.
+        :return: list of booleans, False where a row repeats one that is already buffered.
+        """
+        added = []
+        with self._lock:
+            for row in rows:
+                key = (row['tracker_id'], row['time'])
+                if key in self._keys:
+                    self.stats['duplicates'] += 1
+                    added.append(False)
+                    continue
+                self._keys.add(key)
+                self._rows.append(row)
+                added.append(True)
+            if self._oldest is None and self._rows:
+                self._oldest = time.monotonic()
+            self.stats['buffered'] = len(self._rows)
+            due = self._rows and (
+                len(self._rows) >= self.batch_size or time.monotonic() - self._oldest >= self.max_delay
+            )
+        if due:
+            self.flush()
+        return added
+
+    def flush(self):
+        """
+        Write groups that failed before, then all buffered rows in groups of batch_size, one
+        transaction per group.
+
+        :return: number of rows written, not counting repeats of rows already in the db.
+        """
+        # one flush at a time, so groups are written in the order they were buffered
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._keys = set()
+                self._oldest = None
+                self.stats['buffered'] = 0
+            groups, self._retries = self._retries, []
+            groups += [(0, rows[start:start + self.batch_size]) for start in range(0, len(rows), self.batch_size)]
+            written = 0
+            for attempts, group in groups:
+                try:
+                    written += self._write(group)
+                except Exception:
+                    attempts += 1
+                    self.stats['failed'] += len(group)
+                    if attempts < self.max_attempts:
+                        logger.exception('Failed to write %s positions, writing them again on the next flush',
+                                         len(group))
+                        self._retries.append((attempts, group))
+                    else:
+                        logger.exception('Failed to write %s positions %s times, dropping them',
+                                         len(group), attempts)
+                        self.stats['dropped'] += len(group)
+            self.stats['retrying'] = sum(len(group) for _, group in self._retries)
+            return written
+
+    @db.retry_busy
+    def _write(self, rows):
+        with db.session_scope(commit=True) as session:
+            written = db.bulk_insert_ignore(session, TrackerLocations, rows)
+            db.bulk_upsert_latest(session, LatestPositions, rows, 'tracker_id', 'time')
+        self.stats['written'] += written
+        self.stats['duplicates'] += len(rows) - written
+        self.stats['flushes'] += 1
+        return written
+
+    def start(self):
+        """Start a daemon thread that flushes the buffer every max_delay seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='position-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.max_delay)
+            if self._rows or self._retries:
+                self.flush()
+
+
+def position_rows(fixes, trackers, received=None):
+    """
+    Turn validated fixes into tracker_locations rows.
+
+    :param fixes: list of (index, fix) for fixes loaded with sl.position_fix.
+    :param trackers: dict of esn to (tracker id, rider id) as returned by EsnIndex.lookup.
+    :param received: time the fixes were received, defaults to now.
+    :return: list of (index, row) for fixes with a known ESN.
+    """
+    received = received or datetime.utcnow()
+    rows = []
+    for index, fix in fixes:
+        tracker = trackers.get(fix['esn'])
+        if tracker is None:
+            continue
+        rows.append((index, {
+            'tracker_id': tracker[0],
+            'rider': tracker[1],
+            'time': fix['time'],
+            'received': received,
+            'latitude': fix['latitude'],
+            'longitude': fix['longitude'],
+        }))
+    return rows
@@ -0,0 +1,200 @@
+"""
+Per endpoint request metrics in the Prometheus text format.
+
+For each Flask endpoint, request latency and the number of SQL statements each request sent
+are kept as histograms, with the total time spent in the db. Statements are timed with
+engine events, and attributed to the endpoint of the request that sent them; statements sent
+outside a request, e.g. by the position writer's thread, are counted under 'background'.
+Stats of other components, e.g. the response cache, are published as gauges read when the
+metrics are rendered.
+
+Counting is a few additions per statement and a lock per request, cheap enough to leave on.
+"""
+import bisect
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the statements per request histogram buckets
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+MIMETYPE = 'text/plain; version=0.0.4'
+BACKGROUND = 'background'
+
+
+class Histogram(object):
+    """Bucketed observations with their sum, per label values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, (counts, total) in sorted(self.series.items()):
+            label_text = _labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = bound if isinstance(bound, str) else repr(float(bound))
+                lines.append('%s_bucket{%s} %d' % (name, _labels(label_names + ('le',), labels + (le,)), cumulative))
+            lines.append('%s_sum{%s} %r' % (name, label_text, total))
+            lines.append('%s_count{%s} %d' % (name, label_text, cumulative))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+class Metrics(object):
+    """
+    Request and db metrics of a Flask app, rendered with render().
+
+    Call init_app with the app, and install with each engine whose statements are counted.
+    """
+
+    def __init__(self, prefix='tracker'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._latency = Histogram(LATENCY_BUCKETS)
+        self._statements = Histogram(STATEMENT_BUCKETS)
+        self._requests = {}
+        self._sql = {}
+        self._gauges = []
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._response_status)
+        # streamed responses are still being sent after after_request, teardown runs once they end
+        app.teardown_request(self._end_request)
+
+    def install(self, engine):
+        """Time and count the statements engine sends."""
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def uninstall(self, engine):
+        event.remove(engine, 'before_cursor_execute', self._before_execute)
+        event.remove(engine, 'after_cursor_execute', self._after_execute)
+
+    def gauges(self, name, help_, stats):
+        """
+        Publish numeric values of a dict as a gauge, labelled by key.
+
+        :param name: metric name, after the prefix.
+        :param help_: metric description.
+        :param stats: function returning the dict, called on every render, e.g. response_cache.info.
+        """
+        self._gauges.append(('%s_%s' % (self.prefix, name), help_, stats))
+
+    @staticmethod
+    def _start_request():
+        # start time, statements, db seconds and status of this request
+        g.metrics = [time.perf_counter(), 0, 0.0, 500]
+
+    @staticmethod
+    def _response_status(response):
+        metrics = g.get('metrics')
+        if metrics is not None:
+            metrics[3] = response.status_code
+        return response
+
+    def _end_request(self, exception=None):
+        metrics = g.pop('metrics', None)
+        if metrics is None:
+            return
+        started, statements, db_time, status = metrics
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        key = (endpoint, request.method)
+        with self._lock:
+            self._latency.observe(key, elapsed)
+            self._statements.observe((endpoint,), statements)
+            request_key = key + (str(status),)
+            self._requests[request_key] = self._requests.get(request_key, 0) + 1
+            self._add_sql(endpoint, statements, db_time)
+
+    def _add_sql(self, endpoint, statements, db_time):
+        sql = self._sql.get(endpoint)
+        if sql is None:
+            sql = self._sql[endpoint] = [0, 0.0]
+        sql[0] += statements
+        sql[1] += db_time
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['metrics_started'] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('metrics_started', time.perf_counter())
+        metrics = g.get('metrics') if has_request_context() else None
+        if metrics is not None:
+            metrics[1] += 1
+            metrics[2] += elapsed
+        else:
+            with self._lock:
+                self._add_sql(BACKGROUND, 1, elapsed)
+
+    def clear(self):
+        with self._lock:
+            self._latency = Histogram(LATENCY_BUCKETS)
+            self._statements = Histogram(STATEMENT_BUCKETS)
+            self._requests = {}
+            self._sql = {}
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        prefix = self.prefix
+        with self._lock:
+            lines = [
+                '# HELP %s_requests_total Requests handled, by endpoint, method and status.' % prefix,
+                '# TYPE %s_requests_total counter' % prefix,
+            ]
+            for labels, count in sorted(self._requests.items()):
+                lines.append('%s_requests_total{%s} %d' % (
+                    prefix, _labels(('endpoint', 'method', 'status'), labels), count))
+            lines += [
+                '# HELP %s_request_duration_seconds Request latency, by endpoint and method.' % prefix,
+                '# TYPE %s_request_duration_seconds histogram' % prefix,
+            ]
+            lines += self._latency.render(prefix + '_request_duration_seconds', ('endpoint', 'method'))
+            lines += [
+                '# HELP %s_request_sql_statements SQL statements sent per request, by endpoint.' % prefix,
+                '# TYPE %s_request_sql_statements histogram' % prefix,
+            ]
+            lines += self._statements.render(prefix + '_request_sql_statements', ('endpoint',))
+            sql = sorted((endpoint, tuple(totals)) for endpoint, totals in self._sql.items())
+        lines += [
+            '# HELP %s_sql_statements_total SQL statements sent, by endpoint.' % prefix,
+            '# TYPE %s_sql_statements_total counter' % prefix,
+        ]
+        lines += ['%s_sql_statements_total{endpoint="%s"} %d' % (prefix, _escape(endpoint), statements)
+                  for endpoint, (statements, _) in sql]
+        lines += [
+            '# HELP %s_db_seconds_total Time spent executing SQL statements, by endpoint.' % prefix,
+            '# TYPE %s_db_seconds_total counter' % prefix,
+        ]
+        lines += ['%s_db_seconds_total{endpoint="%s"} %r' % (prefix, _escape(endpoint), db_time)
+                  for endpoint, (_, db_time) in sql]
+        for name, help_, stats in self._gauges:
+            lines += ['# HELP %s %s' % (name, help_), '# TYPE %s gauge' % name]
+            for key, value in sorted(stats().items()):
+                # booleans are published as 0 or 1, other values are skipped
+                if isinstance(value, (bool, int, float)):
+                    lines.append('%s{stat="%s"} %r' % (name, _escape(key), float(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+"""
+Bring a db up to the tables, columns and indexes declared on the models.
+
+The app does not create tables or indexes when it starts; run this on a new db, and on a large
+one ahead of a deploy to add new columns and build new indexes, or with --dry-run to print the
+column and index statements. Added columns are filled from their server default, e.g. version
+is 1 on existing rows.
+
+Run with: python -m tracker.migrate [--dry-run]
+"""
+import argparse
+
+from sqlalchemy.schema import CreateIndex
+
+from tracker import db_interactions as db
+from tracker import models  # noqa: F401, declares the tables on db.Base
+from tracker import rider_search
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create tables, columns and indexes missing from the db.')
+    parser.add_argument('--dry-run', action='store_true', help='print the statements without running them')
+    args = parser.parse_args(argv)
+    if args.dry_run:
+        for column in db.missing_columns(db.engine):
+            print('%s;' % db.add_column_statement(db.engine, column))
+        for index in db.missing_indexes(db.engine):
+            print('%s;' % str(CreateIndex(index).compile(db.engine)).strip())
+        return
+    db.Base.metadata.create_all(db.engine)
+    # before the indexes, which may cover new columns
+    for name in db.add_missing_columns(db.engine):
+        print('added %s' % name)
+    for name in db.create_missing_indexes(db.engine):
+        print('built %s' % name)
+    # the rider search index is created if missing, and filled from existing riders
+    rider_search.create(db.engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,13 @@ from sqlalchemy import (
     ForeignKey,
     Float,
     Enum,
-    DATE
+    DATE,
+    Index,
+    UniqueConstraint
 )
 from sqlalchemy.orm import relationship
 
+from tracker import db_interactions
 from tracker.db_interactions import Base
 
 
@@ -86,36 +89,51 @@ class Trackers(Base, ):
     purchase_date = Column('purchase', DATE)
     warranty_expiry = Column('warranty', DATE)
     owner = Column('owner', Enum(OwnerChoices))
-    rider_assigned = Column('rider_assigned', ForeignKey('rider_assignment.id'))
-    rider_possess = Column('rider_possess', ForeignKey('rider_possession.id'))
+    rider_assigned = Column('rider_assigned', ForeignKey('rider_assignment.id'), index=True)
+    rider_possess = Column('rider_possess', ForeignKey('rider_possession.id'), index=True)
+    # bumped by every update, used as the tracker's etag
+    version = Column('version', Integer, default=1, server_default='1', nullable=False)
+    rider = relationship(
+        'Riders',
+        secondary='rider_assignment',
+        primaryjoin='Trackers.rider_assigned == RiderAssignment.id',
+        secondaryjoin='RiderAssignment.rider == Riders.id',
+        uselist=False,
+        viewonly=True,
+    )
+    # composite indexes back keyset pagination on the sortable columns, esn backs lookups by esn
+    __table_args__ = (
+        Index('ix_trackers_last_test_id', 'last_test', 'id'),
+        Index('ix_trackers_esn_number', 'esn_number'),
+    )
     #location = relationship('tracker_locations')
 
 
 class RiderAssignment(Base):
     __tablename__ = 'rider_assignment'
     id = Column('id', Integer, primary_key=True)
-    rider = Column('rider', ForeignKey('riders.id'))
+    rider = Column('rider', ForeignKey('riders.id'), index=True)
     tracker = relationship('Trackers', uselist=False)
 
 
 class RiderPossession(Base):
     __tablename__ = 'rider_possession'
     id = Column('id', Integer, primary_key=True)
-    rider = Column('rider', ForeignKey('riders.id'))
+    rider = Column('rider', ForeignKey('riders.id'), index=True)
     tracker = relationship('Trackers', uselist=False)
 
 
 class TrackerAssignment(Base):
     __tablename__ = 'tracker_assignment'
     id = Column('id', Integer, primary_key=True)
-    tracker = Column('tracker', ForeignKey('trackers.id'))
+    tracker = Column('tracker', ForeignKey('trackers.id'), index=True)
     rider = relationship('Riders', uselist=False)
 
 
 class TrackerPossession(Base):
     __tablename__ = 'tracker_possession'
     id = Column('id', Integer, primary_key=True)
-    tracker = Column('tracker', ForeignKey('trackers.id'))
+    tracker = Column('tracker', ForeignKey('trackers.id'), index=True)
     rider = relationship('Riders', uselist=False)
 
 
@@ -129,10 +147,17 @@ class Riders(Base, ):
     cap_number = Column('cap_number', String)
     category = Column('category', Enum(RiderCategories, validate_strings=True))
     notes = relationship('RiderNotes')
-    tracker_assigned = Column('tracker_assigned', ForeignKey('tracker_assignment.id'))
-    tracker_possesed = Column('tracker_possesed', ForeignKey('tracker_possession.id'))
+    tracker_assigned = Column('tracker_assigned', ForeignKey('tracker_assignment.id'), index=True)
+    tracker_possesed = Column('tracker_possesed', ForeignKey('tracker_possession.id'), index=True)
     events = relationship('RiderEvents')
+    trackers_assigned = relationship('RiderAssignment')
     balance = Column('balance', Float, default=0)
+    # bumped by every update, used as the rider's etag
+    version = Column('version', Integer, default=1, server_default='1', nullable=False)
+    __table_args__ = (
+        Index('ix_riders_cap_number_id', 'cap_number', 'id'),
+        Index('ix_riders_last_name_id', 'last_name', 'id'),
+    )
     # todo link riders who are in pairs? or does the capnumber do that???
     # todo add checkpoints stuff!
 
@@ -142,7 +167,49 @@ class TrackerLocations(Base, ):
     id = Column('id', Integer, primary_key=True)
     tracker = Column('tracker_id', ForeignKey('trackers.id'), nullable=False)
     rider = Column('rider', ForeignKey('riders.id'))
+    time = Column('time', DATETIME, nullable=False)
+    received = Column('received', DATETIME)
+    latitude = Column('latitude', Float, nullable=False)
+    longitude = Column('longitude', Float, nullable=False)
     # location = Column('location', ForeignKey('locations.id'))
+    # a tracker reports each fix once, repeats are dropped on insert
+    __table_args__ = (
+        UniqueConstraint('tracker_id', 'time', name='uq_tracker_locations_tracker_time'),
+    )
+
+
+class LatestPositions(Base, ):
+    """Newest fix per tracker, upserted on ingest so live maps never scan tracker_locations."""
+    __tablename__ = 'latest_positions'
+    tracker = Column('tracker_id', ForeignKey('trackers.id'), primary_key=True)
+    rider = Column('rider', ForeignKey('riders.id'), index=True)
+    time = Column('time', DATETIME, nullable=False)
+    received = Column('received', DATETIME)
+    latitude = Column('latitude', Float, nullable=False)
+    longitude = Column('longitude', Float, nullable=False)
+
+
+class Checkpoints(Base, ):
+    __tablename__ = 'checkpoints'
+    id = Column('id', Integer, primary_key=True)
+    name = Column('name', String, unique=True)
+    # number of riders through the checkpoint, kept up to date as arrivals are recorded
+    arrivals = Column('arrivals', Integer, default=0, nullable=False)
+
+
+class CheckpointArrivals(Base, ):
+    __tablename__ = 'checkpoint_arrivals'
+    id = Column('id', Integer, primary_key=True)
+    rider = Column('rider_id', ForeignKey('riders.id'), nullable=False)
+    checkpoint = Column('checkpoint_id', ForeignKey('checkpoints.id'), nullable=False)
+    time = Column('time', DATETIME, nullable=False)
+    event = Column('event', ForeignKey('rider_events.id'))
+    rider_details = relationship('Riders')
+    # a rider arrives at a checkpoint once; checkpoint listings are range reads in arrival order
+    __table_args__ = (
+        UniqueConstraint('rider_id', 'checkpoint_id', name='uq_checkpoint_arrivals_rider_checkpoint'),
+        Index('ix_checkpoint_arrivals_checkpoint_time', 'checkpoint_id', 'time', 'id'),
+    )
 
 
 class Locations(Base, ):
@@ -158,7 +225,10 @@ class RiderNotes(Base, ):
     datetime = Column('datetime', DATETIME)
     notes = Column('notes', String)
     user = Column(Integer, ForeignKey('users.id'))
-    event = Column(Integer, ForeignKey('rider_events.id'))
+    event = Column(Integer, ForeignKey('rider_events.id'), index=True)
+    __table_args__ = (
+        Index('ix_rider_notes_rider_datetime', 'rider', 'datetime'),
+    )
 
 
 class TrackerNotes(Base, ):
@@ -166,8 +236,12 @@ class TrackerNotes(Base, ):
     id = Column('id', Integer, primary_key=True)
     tracker = Column(Integer, ForeignKey('trackers.id'))
     datetime = Column('datetime', DATETIME)
+    notes = Column('notes', String)
     user = Column(Integer, ForeignKey('users.id'))
-    event = Column(Integer, ForeignKey('tracker_events.id'))
+    event = Column(Integer, ForeignKey('tracker_events.id'), index=True)
+    __table_args__ = (
+        Index('ix_tracker_notes_tracker_datetime', 'tracker', 'datetime'),
+    )
 
 
 class RiderEvents(Base, ):
@@ -179,6 +253,10 @@ class RiderEvents(Base, ):
     notes = relationship('RiderNotes')
     balance_change = Column('balance_change', Float)
     rider = Column(Integer, ForeignKey('riders.id'))
+    # a rider's timeline is a range read in time order
+    __table_args__ = (
+        Index('ix_rider_events_rider_datetime_id', 'rider', 'datetime', 'id'),
+    )
 
 
 class TrackerEvents(Base, ):
@@ -189,9 +267,24 @@ class TrackerEvents(Base, ):
     event_type = Column('event_type', Enum(TrackerEventCategories))
     notes = relationship('TrackerNotes')
     tracker = Column(Integer, ForeignKey('trackers.id'))
+    # a tracker's timeline is a range read in time order
+    __table_args__ = (
+        Index('ix_tracker_events_tracker_datetime_id', 'tracker', 'datetime', 'id'),
+    )
 
 
 class Users(Base, ):
     __tablename__ = 'users'
     id = Column('id', Integer, primary_key=True)
 
+
+class ReplicaHeartbeat(Base, ):
+    """One row whose time the primary keeps updating, its copy on a replica tells how far behind it is."""
+    __tablename__ = 'replica_heartbeat'
+    id = Column('id', Integer, primary_key=True)
+    # seconds since the epoch
+    at = Column('at', Float, nullable=False)
+
+
+if db_interactions.in_memory:
+    Base.metadata.create_all(db_interactions.engine)
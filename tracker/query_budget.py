@@ -0,0 +1,119 @@
+"""
+Per endpoint budgets of SQL statements, to catch handlers that start sending a statement per
+row (N+1) where they sent a fixed number.
+
+Each budgeted endpoint declares the most statements one request may send. In 'raise' mode,
+used by the tests, a request over its budget raises QueryBudgetExceeded once it has been
+handled; in 'warn' mode, the default when the app runs in debug, it is logged. Both name the
+statements sent. QueryCounter counts the statements of any block of code.
+"""
+import logging
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'warn', 'raise')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request sent more statements than its endpoint's budget."""
+
+    def __init__(self, endpoint, budget, statements):
+        self.endpoint = endpoint
+        self.budget = budget
+        self.statements = statements
+        super(QueryBudgetExceeded, self).__init__(describe(endpoint, budget, statements))
+
+
+def describe(endpoint, budget, statements):
+    """Return a report of statements sent by a request to endpoint, listing each of them."""
+    lines = ['%s sent %d statements, its budget is %d:' % (endpoint, len(statements), budget)]
+    lines += ['  %d. %s' % (number, ' '.join(statement.split())) for number, statement in enumerate(statements, 1)]
+    return '\n'.join(lines)
+
+
+class QueryCounter(object):
+    """
+    Context manager recording the statements an engine sends within its block.
+
+    :param engine: engine whose statements are recorded.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+
+class QueryBudget(object):
+    """
+    Check the statements each request sends against the budget of its endpoint.
+
+    Requests for more than max_limit rows are not checked: the related rows of bigger pages
+    may be loaded in more than one IN batch of keys, so their statements grow with the page.
+
+    :param budgets: dict of endpoint name to the most statements a request may send. Endpoints
+        not in budgets, or with a budget of None, are not checked.
+    :param mode: one of MODES, or None for 'warn' when the app is in debug and 'off' otherwise.
+    :param max_limit: largest limit query arg of requests checked.
+    """
+
+    def __init__(self, budgets, mode=None, max_limit=25):
+        self.budgets = budgets
+        self.mode = mode
+        self.max_limit = max_limit
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        # streamed responses send statements until they end, teardown runs after
+        app.teardown_request(self._end_request)
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def uninstall(self, engine):
+        event.remove(engine, 'before_cursor_execute', self._record)
+
+    def _mode(self):
+        if self.mode is not None:
+            return self.mode
+        return 'warn' if current_app.debug else 'off'
+
+    def _start_request(self):
+        if self._mode() == 'off' or self.budgets.get(request.endpoint) is None:
+            return
+        if request.args.get('limit', 0, type=int) > self.max_limit:
+            return
+        g.query_budget_statements = []
+
+    @staticmethod
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            statements = g.get('query_budget_statements')
+            if statements is not None:
+                statements.append(statement)
+
+    def _end_request(self, exception=None):
+        statements = g.pop('query_budget_statements', None)
+        if statements is None:
+            return
+        budget = self.budgets[request.endpoint]
+        if len(statements) <= budget:
+            return
+        if self._mode() == 'raise' and exception is None:
+            raise QueryBudgetExceeded(request.endpoint, budget, statements)
+        logger.warning(describe(request.endpoint, budget, statements))
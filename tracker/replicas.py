@@ -0,0 +1,156 @@
+"""
+Route read-only sessions to replica dbs that are recent enough, keeping writes on the primary.
+
+The primary's replica_heartbeat row is updated every heartbeat interval and replicated with the
+rest of the db, so the time on a replica's copy tells how far behind the primary it is. A
+replica serves a read when it is behind by less than max_lag seconds and, when the client has
+written, its heartbeat is newer than the client's last write, so each client reads its own writes.
+Otherwise, or when a replica can't be reached, the read falls back to the primary.
+
+Writes made by other clients, and by background writers, are only bounded by max_lag.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+
+from tracker import db_interactions as db
+from tracker.models import ReplicaHeartbeat
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_ID = 1
+
+
+class ReplicaRouter(object):
+    """
+    Choose the engine of read-only sessions among replicas, falling back to the primary.
+
+    :param primary: engine of the primary db, where heartbeats are written.
+    :param replicas: list of engines of replica dbs.
+    :param max_lag: seconds a replica may be behind the primary and still serve reads.
+    :param check_interval: seconds a replica's heartbeat is cached before it is read again.
+    :param heartbeat_interval: seconds between heartbeats written by the thread of start().
+    :param last_write: function returning the time of the current client's last commit on the
+        primary, or None if it has not written. Replicas must have a heartbeat after it.
+    """
+
+    def __init__(self, primary, replicas, max_lag=5.0, check_interval=1.0, heartbeat_interval=1.0,
+                 last_write=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.last_write = last_write
+        self._lock = threading.Lock()
+        # replica index to (time checked, heartbeat time or None)
+        self._heartbeats = {}
+        self._next = itertools.cycle(range(len(self.replicas)))
+        self._thread = None
+        self.stats = {'replica_reads': 0, 'primary_reads': 0, 'lagging': 0, 'errors': 0, 'heartbeats': 0}
+
+    def beat(self):
+        """Write the current time to the primary's heartbeat row."""
+        table = ReplicaHeartbeat.__table__
+        with self.primary.connect() as conn:
+            now = time.time()
+            if not conn.execute(table.update().where(table.c.id == HEARTBEAT_ID).values(at=now)).rowcount:
+                conn.execute(table.insert().values(id=HEARTBEAT_ID, at=now))
+        self.stats['heartbeats'] += 1
+
+    def start(self):
+        """Start a daemon thread writing a heartbeat every heartbeat_interval seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='replica-heartbeat', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.beat()
+            except Exception:
+                logger.exception('Replica heartbeat failed')
+            time.sleep(self.heartbeat_interval)
+
+    def heartbeat(self, index):
+        """
+        Return the heartbeat time on a replica, read at most every check_interval seconds.
+
+        :param index: index of the replica in replicas.
+        :return: seconds since the epoch, or None if it has no heartbeat or can't be reached.
+        """
+        now = time.time()
+        checked = self._heartbeats.get(index)
+        if checked is not None and now - checked[0] < self.check_interval:
+            return checked[1]
+        try:
+            # a raw connection, so checks are not counted as statements of the request
+            connection = self.replicas[index].raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SELECT at FROM replica_heartbeat WHERE id = %d' % HEARTBEAT_ID)
+                row = cursor.fetchone()
+            finally:
+                connection.close()
+            at = row[0] if row else None
+        except Exception:
+            logger.exception('Replica %d heartbeat could not be read', index)
+            with self._lock:
+                self.stats['errors'] += 1
+            at = None
+        self._heartbeats[index] = (now, at)
+        return at
+
+    def engine(self):
+        """Return the engine a read-only session should use: the next fresh replica, or the primary."""
+        last_write = (self.last_write() if self.last_write is not None else None) or 0.0
+        lagging = 0
+        for _ in range(len(self.replicas)):
+            index = next(self._next)
+            at = self.heartbeat(index)
+            if at is not None and at >= last_write and time.time() - at <= self.max_lag:
+                with self._lock:
+                    self.stats['replica_reads'] += 1
+                return self.replicas[index]
+            lagging += 1
+        with self._lock:
+            self.stats['lagging'] += lagging
+            self.stats['primary_reads'] += 1
+        return self.primary
+
+    def info(self):
+        """Return the read counts and the lag of each replica at its last check."""
+        now = time.time()
+        lags = {}
+        for index in range(len(self.replicas)):
+            at = self._heartbeats.get(index, (None, None))[1]
+            lags['lag_seconds_%d' % index] = None if at is None else round(now - at, 3)
+        return dict(self.stats, replicas=len(self.replicas), max_lag=self.max_lag, **lags)
+
+
+def set_up_replicas(primary, last_write=None):
+    """
+    Return a router to the replicas given by the DB_REPLICA_URIS env variable, comma separated uris
+    following DB_TYPE like DB_URI, or None if it is not set.
+
+    DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL and DB_HEARTBEAT_INTERVAL set the seconds of the
+    router's max_lag, check_interval and heartbeat_interval.
+
+    :param primary: engine of the primary db.
+    :param last_write: function returning the time of the current client's last write, see ReplicaRouter.
+    :return: ReplicaRouter or None.
+    """
+    db_type = os.environ.get('DB_TYPE')
+    replica_uris = os.environ.get('DB_REPLICA_URIS')
+    if db_type is None or not replica_uris:
+        return None
+    return ReplicaRouter(
+        primary,
+        [db.make_engine(db_type + uri.strip()) for uri in replica_uris.split(',')],
+        max_lag=float(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+        check_interval=float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1)),
+        heartbeat_interval=float(os.environ.get('DB_HEARTBEAT_INTERVAL', 1)),
+        last_write=last_write,
+    )
@@ -0,0 +1,326 @@
+"""
+Cache of serialized read responses, invalidated by tags when the entities they render change.
+
+Views wrapped with ResponseCache.cached are keyed by path and sorted query args. While a view
+renders it names the entities it used with cache_tags, e.g. 'riders' for the collection and
+'rider:1' for one rider; writes name the entities they change with changed(). The
+store is a backend: MemoryBackend for one process, SqliteBackend for processes sharing a file.
+"""
+import functools
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import current_app, g, request
+
+
+def cache_tags(*tags):
+    """Name entities the response being rendered depends on, a no-op outside cached views."""
+    tags_ = g.get('cache_tags')
+    if tags_ is not None:
+        tags_.update(tags)
+
+
+def changed(*tags):
+    """
+    Name entities the current request writes, invalidated once its view has returned.
+
+    Views commit before returning, so the invalidation follows the commit: a render that read
+    the old rows started before it, sees a new generation and is not stored.
+    """
+    g.setdefault('changed_tags', set()).update(tags)
+
+
+def _pack(status, etag, mimetype, body):
+    meta = json.dumps([status, etag, mimetype]).encode()
+    return meta + b'\n' + body
+
+
+def _unpack(value):
+    meta, body = value.split(b'\n', 1)
+    status, etag, mimetype = json.loads(meta.decode())
+    return status, etag, mimetype, body
+
+
+class MemoryBackend(object):
+    """
+    In-process LRU store capped at max_bytes of cached values.
+
+    :param max_bytes: total size of values kept before the least recently used are evicted.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl, tags, generation):
+        with self._lock:
+            # something was invalidated while the value was rendered, it may be stale
+            if generation != self._generation or len(value) > self.max_bytes:
+                return False
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, tags)
+            self._bytes += len(value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+            return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry[1])
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries = OrderedDict()
+            self._tags = {}
+            self._bytes = 0
+
+    def info(self):
+        return dict(self.stats, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+class SqliteBackend(object):
+    """
+    LRU store in a sqlite file, shared by every process on the host that opens the same path.
+
+    Stands in for a shared cache server. Hit and miss counts are per process, eviction and
+    invalidation counts and sizes are shared.
+
+    :param path: sqlite file path.
+    :param max_bytes: total size of values kept before the least recently used are evicted.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0}
+        with self._connection() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL, size INTEGER);
+                CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used);
+                CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key));
+                CREATE INDEX IF NOT EXISTS ix_tags_key ON tags (key);
+                CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+                INSERT OR IGNORE INTO counters VALUES
+                    ('generation', 0), ('evictions', 0), ('invalidations', 0);
+            ''')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            self._local.connection = connection
+        return connection
+
+    def _counter(self, connection, name):
+        return connection.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()[0]
+
+    def generation(self):
+        return self._counter(self._connection(), 'generation')
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] < now:
+                self._remove(connection, [key])
+                self.stats['expired'] += 1
+                row = None
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            connection.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+        self.stats['hits'] += 1
+        return bytes(row[0])
+
+    def set(self, key, value, ttl, tags, generation):
+        if len(value) > self.max_bytes:
+            return False
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # take the write lock before checking the generation
+            connection.execute('BEGIN IMMEDIATE')
+            if self._counter(connection, 'generation') != generation:
+                return False
+            self._remove(connection, [key])
+            connection.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                               (key, value, now + ttl, now, len(value)))
+            connection.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)', [(tag, key) for tag in tags])
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            evicted = []
+            for old_key, size in connection.execute('SELECT key, size FROM entries ORDER BY used'):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(old_key)
+                total -= size
+            self._remove(connection, evicted)
+            connection.execute("UPDATE counters SET value = value + ? WHERE name = 'evictions'", (len(evicted),))
+        return True
+
+    def _remove(self, connection, keys):
+        params = [(key,) for key in keys]
+        connection.executemany('DELETE FROM entries WHERE key = ?', params)
+        connection.executemany('DELETE FROM tags WHERE key = ?', params)
+
+    def invalidate(self, tags):
+        with self._connection() as connection:
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'generation'")
+            keys = set()
+            for tag in tags:
+                keys.update(key for key, in connection.execute('SELECT key FROM tags WHERE tag = ?', (tag,)))
+            self._remove(connection, keys)
+            connection.execute("UPDATE counters SET value = value + ? WHERE name = 'invalidations'", (len(keys),))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'generation'")
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM tags')
+
+    def info(self):
+        connection = self._connection()
+        entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return dict(
+            self.stats,
+            evictions=self._counter(connection, 'evictions'),
+            invalidations=self._counter(connection, 'invalidations'),
+            entries=entries,
+            bytes=size,
+            max_bytes=self.max_bytes,
+        )
+
+
+def make_backend(spec, max_bytes):
+    """
+    Return the backend named by spec: 'memory', or 'sqlite:<path>' for a store shared by processes.
+
+    :param spec: backend spec, e.g. from the RESPONSE_CACHE_BACKEND env variable.
+    :param max_bytes: memory cap of the backend.
+    """
+    if spec == 'memory':
+        return MemoryBackend(max_bytes)
+    if spec.startswith('sqlite:'):
+        return SqliteBackend(spec[len('sqlite:'):], max_bytes)
+    raise ValueError('Unknown response cache backend %s, use memory or sqlite:<path>' % spec)
+
+
+class ResponseCache(object):
+    """
+    Serve repeated GETs from a backend until their TTL passes or their tags are invalidated.
+
+    :param backend: MemoryBackend, SqliteBackend or an object with the same methods.
+    :param ttl: seconds a response is served from the cache at most.
+    """
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = True
+
+    @staticmethod
+    def key():
+        return request.path + '?' + urlencode(sorted(request.args.items(multi=True)))
+
+    def cached(self, view):
+        """Decorate a view so its 200 responses are cached with the tags it named."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return view(*args, **kwargs)
+            key = self.key()
+            value = self.backend.get(key)
+            if value is not None:
+                return self._response(*_unpack(value))
+            generation = self.backend.generation()
+            g.cache_tags = set()
+            response = view(*args, **kwargs)
+            tags = g.pop('cache_tags')
+            if response.status_code == 200 and tags and not response.is_streamed:
+                etag = response.get_etag()[0]
+                self.backend.set(
+                    key,
+                    _pack(200, etag, response.mimetype, response.get_data()),
+                    self.ttl,
+                    sorted(tags),
+                    generation
+                )
+            return response
+        return wrapper
+
+    @staticmethod
+    def _response(status, etag, mimetype, body):
+        if etag is not None and request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(response=body, status=status, mimetype=mimetype)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+    def invalidate(self, tags):
+        """Drop cached responses with any of tags now."""
+        self.backend.invalidate(set(tags))
+
+    def init_app(self, app):
+        """Invalidate the tags named with changed() after each request's view has returned."""
+        app.after_request(self._invalidate_changed)
+
+    def _invalidate_changed(self, response):
+        tags = g.pop('changed_tags', None)
+        if tags:
+            self.invalidate(tags)
+        return response
+
+    def clear(self):
+        self.backend.clear()
+
+    def info(self):
+        return dict(self.backend.info(), ttl=self.ttl, enabled=self.enabled)
@@ -0,0 +1,147 @@
+"""
+Rider search by name, cap number and email, backed by the db's own text index.
+
+On sqlite riders are indexed by an FTS5 table kept current by triggers, so every write to
+riders (ORM, bulk or import) is picked up in the same transaction. On postgresql a pg_trgm
+GIN index over the searched columns serves substring matches. Other dbs fall back to prefix
+LIKE matches on each column.
+"""
+import re
+
+from sqlalchemy import and_, case, event, func, inspect, literal, literal_column, or_, text
+
+from tracker.models import Riders
+
+# searched columns with their bm25 weights, a cap number match counts most
+COLUMNS = (('cap_number', 10.0), ('last_name', 5.0), ('first_name', 2.0), ('email', 1.0))
+_TERMS = re.compile(r'\w[\w@.+-]*', re.UNICODE)
+
+_names = ', '.join(name for name, _ in COLUMNS)
+_new = ', '.join('new.' + name for name, _ in COLUMNS)
+_old = ', '.join('old.' + name for name, _ in COLUMNS)
+SQLITE_DDL = (
+    # prefix indexes make short prefix queries, e.g. a partial surname, index lookups
+    "CREATE VIRTUAL TABLE IF NOT EXISTS rider_search USING fts5("
+    "%s, content='riders', content_rowid='id', tokenize='unicode61', prefix='1 2 3')" % _names,
+    "CREATE TRIGGER IF NOT EXISTS rider_search_insert AFTER INSERT ON riders BEGIN "
+    "INSERT INTO rider_search(rowid, %s) VALUES (new.id, %s); END" % (_names, _new),
+    "CREATE TRIGGER IF NOT EXISTS rider_search_delete AFTER DELETE ON riders BEGIN "
+    "INSERT INTO rider_search(rider_search, rowid, %s) VALUES ('delete', old.id, %s); END" % (_names, _old),
+    "CREATE TRIGGER IF NOT EXISTS rider_search_update AFTER UPDATE OF %s ON riders BEGIN "
+    "INSERT INTO rider_search(rider_search, rowid, %s) VALUES ('delete', old.id, %s); "
+    "INSERT INTO rider_search(rowid, %s) VALUES (new.id, %s); END" % (_names, _names, _old, _names, _new),
+)
+SQLITE_DROP = (
+    'DROP TRIGGER IF EXISTS rider_search_insert',
+    'DROP TRIGGER IF EXISTS rider_search_delete',
+    'DROP TRIGGER IF EXISTS rider_search_update',
+    'DROP TABLE IF EXISTS rider_search',
+)
+_DOCUMENT_SQL = "lower(%s)" % " || ' ' || ".join("coalesce(%s, '')" % name for name, _ in COLUMNS)
+POSTGRESQL_DDL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_riders_search_trgm ON riders USING gin ((%s) gin_trgm_ops)' % _DOCUMENT_SQL,
+)
+POSTGRESQL_DROP = (
+    'DROP INDEX IF EXISTS ix_riders_search_trgm',
+)
+
+
+def create(connectable):
+    """
+    Build the search index for the db's dialect if it does not exist yet, indexing existing riders.
+
+    :param connectable: engine or connection.
+    """
+    if 'riders' not in inspect(connectable).get_table_names():
+        return
+    dialect = connectable.dialect.name
+    if dialect == 'sqlite':
+        exists = connectable.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rider_search'")
+        ).first() is not None
+        for statement in SQLITE_DDL:
+            connectable.execute(text(statement))
+        if not exists:
+            connectable.execute(text("INSERT INTO rider_search(rider_search) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        for statement in POSTGRESQL_DDL:
+            connectable.execute(text(statement))
+
+
+def drop(connectable):
+    """Drop the search index, e.g. before riders is dropped."""
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRESQL_DROP}.get(connectable.dialect.name, ())
+    for statement in statements:
+        connectable.execute(text(statement))
+
+
+def install(engine):
+    """
+    Build the search index on engine's db whenever riders is created there, and drop it with riders.
+
+    Nothing is built now: an existing db gets its index from tracker.migrate, which needs the
+    privileges of schema changes the app does not. Other engines, e.g. scratch dbs, are left alone.
+    """
+    def _created(target, connection, **kw):
+        if connection.engine is engine:
+            create(connection)
+
+    def _dropping(target, connection, **kw):
+        if connection.engine is engine:
+            drop(connection)
+
+    event.listen(Riders.__table__, 'after_create', _created)
+    event.listen(Riders.__table__, 'before_drop', _dropping)
+
+
+def terms(query):
+    """Split a search string into terms, dropping punctuation the index does not store."""
+    return _TERMS.findall(query)
+
+
+def search(session, query, limit, offset=0):
+    """
+    Return ids of riders matching every term of query as a prefix, best matches first.
+
+    An exact cap number match ranks first, then on sqlite the bm25 rank weighted by COLUMNS,
+    on postgresql trigram similarity; ties are in id order.
+
+    :param session: db session.
+    :param query: search string, e.g. a partial surname, a cap number or an email.
+    :param limit: maximum number of ids to return.
+    :param offset: number of better ranked matches to skip.
+    :return: list of rider ids.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    exact = ' '.join(words)
+    dialect = session.bind.dialect.name
+    if dialect == 'sqlite':
+        match = ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+        rows = session.execute(text(
+            'SELECT riders.id FROM rider_search JOIN riders ON riders.id = rider_search.rowid '
+            'WHERE rider_search MATCH :match '
+            'ORDER BY riders.cap_number = :exact DESC, bm25(rider_search, %s), riders.id '
+            'LIMIT :limit OFFSET :offset' % ', '.join(str(weight) for _, weight in COLUMNS)
+        ), {'match': match, 'exact': exact, 'limit': limit, 'offset': offset})
+        return [id_ for id_, in rows]
+    if dialect == 'postgresql':
+        document = literal_column(_DOCUMENT_SQL)
+        criteria = [document.op('LIKE')('%' + word.lower().replace('%', r'\%').replace('_', r'\_') + '%')
+                    for word in words]
+        rank = func.similarity(document, literal(exact.lower()))
+    else:
+        criteria = [
+            or_(*[getattr(Riders, name).ilike(word.replace('%', r'\%').replace('_', r'\_') + '%', escape='\\')
+                  for name, _ in COLUMNS])
+            for word in words
+        ]
+        rank = literal(0)
+    rows = session.query(Riders.id).filter(and_(*criteria)).order_by(
+        case([(Riders.cap_number == exact, 0)], else_=1),
+        rank.desc(),
+        Riders.id,
+    ).limit(limit).offset(offset)
+    return [id_ for id_, in rows]
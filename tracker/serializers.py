@@ -1,6 +1,53 @@
-from marshmallow import fields, Schema, RAISE
+import enum
+
+from datetime import datetime, timezone
+
+from marshmallow import fields, Schema, RAISE, validate
 from marshmallow_sqlalchemy import ModelSchema
-from tracker.models import TrackerLocations, Trackers, Riders, Locations, RiderNotes, RiderEvents
+from sqlalchemy.orm import selectinload, joinedload
+from tracker.models import (
+    CheckpointArrivals,
+    Checkpoints,
+    LatestPositions,
+    TrackerEvents,
+    TrackerLocations,
+    Trackers,
+    Riders,
+    Locations,
+    RiderNotes,
+    RiderEvents,
+    RiderAssignment,
+    RiderCategories,
+    WorkingStatus,
+    LoanStatus
+)
+
+
+class EnumName(fields.String):
+    """String field that renders enum members by name, as they are stored in the db."""
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if isinstance(value, enum.Enum):
+            value = value.name
+        return super(EnumName, self)._serialize(value, attr, obj, **kwargs)
+
+
+def loading_profile(schema):
+    """
+    Return the loader options that eagerly fetch every relationship a schema renders.
+
+    Each serializer declares its profile as Meta.loading_profile, so list and detail queries
+    load nested rows in a fixed number of batched queries rather than one lazy load per row.
+    Options for relationships an instance excludes are left out.
+
+    :param schema: serializer instance or class.
+    :return: tuple of sqlalchemy loader options.
+    """
+    profile = getattr(schema.Meta, 'loading_profile', ())
+    exclude = getattr(schema, 'exclude', None)
+    if exclude:
+        profile = tuple(option for option in profile if option.path[0].key not in exclude)
+    return profile
 
 
 class RiderNotesSerializer(ModelSchema):
@@ -13,8 +60,23 @@ class RiderNotesSerializer(ModelSchema):
 
 
 class RiderEventsSerializer(ModelSchema):
+    event_type = EnumName()
+
     class Meta:
         model = RiderEvents
+        loading_profile = (
+            selectinload(RiderEvents.notes),
+        )
+
+
+class TrackerEventsSerializer(ModelSchema):
+    event_type = EnumName()
+
+    class Meta:
+        model = TrackerEvents
+        loading_profile = (
+            selectinload(TrackerEvents.notes),
+        )
 
 
 class RidersInTrackers(ModelSchema):
@@ -35,10 +97,10 @@ class RidersInTrackers(ModelSchema):
 
 class TrackerSerializer(ModelSchema):
     esnNumber = fields.String(attribute='esn_number')
-    workingStatus = fields.String(attribute='working_status')
+    workingStatus = EnumName(attribute='working_status')
     lastTestDate = fields.Date(attribute='last_test_date')
     warrantyExpiry = fields.Date(attribute='warranty_expiry')
-    loanStatus = fields.String(attribute='loan_status')
+    loanStatus = EnumName(attribute='loan_status')
     purchaseDate = fields.Date(attribute='purchase_date')
     rider = fields.Nested(RidersInTrackers, default=None)
 
@@ -52,12 +114,17 @@ class TrackerSerializer(ModelSchema):
                   'purchaseDate',
                   'rider',
                   'warrantyExpiry')
+        # joined, the rider's secondary join nests inside the outer join and sqlite builds it
+        # in full for every query; a separate IN query stays on the indexes
+        loading_profile = (
+            selectinload(Trackers.rider),
+        )
 
 
 class TrackerInRiders(ModelSchema):
 
     esnNumber = fields.String(attribute='tracker.esn_number')
-    workingStatus = fields.String(attribute='tracker.working_status')
+    workingStatus = EnumName(attribute='tracker.working_status')
     id = fields.Integer(attribute='tracker.id')
 
     class Meta:
@@ -72,6 +139,7 @@ class RiderSerializer(ModelSchema):
     firstName = fields.String(attribute='first_name')
     lastName = fields.String(attribute='last_name')
     capNumber = fields.String(attribute='cap_number')
+    category = EnumName()
     notes = fields.Nested(RiderNotesSerializer, many=True)
     events = fields.Nested(RiderEventsSerializer, many=True)
     trackers_assigned = fields.Nested(TrackerInRiders, many=True)
@@ -90,6 +158,11 @@ class RiderSerializer(ModelSchema):
             'capNumber'
 
         )
+        loading_profile = (
+            selectinload(Riders.notes),
+            selectinload(Riders.events).selectinload(RiderEvents.notes),
+            selectinload(Riders.trackers_assigned).joinedload(RiderAssignment.tracker),
+        )
 
 
 class RiderChangeTrackerState(ModelSchema):
@@ -104,14 +177,217 @@ class RiderChangeTrackerState(ModelSchema):
             'id',
             'depositBalance',
         )
+        # riders are rendered one or a desk batch at a time with a few trackers each, joined in one query
+        loading_profile = (
+            joinedload(Riders.trackers_assigned).joinedload(RiderAssignment.tracker),
+        )
+
+
+class RiderImportSerializer(Schema):
+    """Validates one uploaded rider, loading it as column values for the riders table."""
+    first_name = fields.String(data_key='firstName', required=True)
+    last_name = fields.String(data_key='lastName', required=True)
+    email = fields.Email(data_key='email')
+    cap_number = fields.String(data_key='capNumber', required=True)
+    category = fields.String(
+        data_key='category',
+        validate=validate.OneOf([category.name for category in RiderCategories])
+    )
+    balance = fields.Float(data_key='depositBalance')
+
+    class Meta:
+        unknown = RAISE
+
+
+class RiderPatch(Schema):
+    """
+    Validates a JSON merge patch of a rider, loading the fields it sends as column values.
+
+    Fields left out of the patch are left unchanged and not validated, null clears a field.
+    """
+    first_name = fields.String(data_key='firstName', allow_none=True)
+    last_name = fields.String(data_key='lastName', allow_none=True)
+    email = fields.Email(data_key='email', allow_none=True)
+    cap_number = fields.String(data_key='capNumber', allow_none=True)
+    category = fields.String(
+        data_key='category',
+        allow_none=True,
+        validate=validate.OneOf([category.name for category in RiderCategories])
+    )
+
+    class Meta:
+        unknown = RAISE
+
+
+class TrackerPatch(Schema):
+    """Validates a JSON merge patch of a tracker, as RiderPatch does for riders."""
+    esn_number = fields.String(data_key='esnNumber', allow_none=True)
+    working_status = fields.String(
+        data_key='workingStatus',
+        allow_none=True,
+        validate=validate.OneOf([status.name for status in WorkingStatus])
+    )
+    loan_status = fields.String(
+        data_key='loanStatus',
+        allow_none=True,
+        validate=validate.OneOf([status.name for status in LoanStatus])
+    )
+    last_test_date = fields.Date(data_key='lastTestDate', allow_none=True)
+    purchase_date = fields.Date(data_key='purchaseDate', allow_none=True)
+    warranty_expiry = fields.Date(data_key='warrantyExpiry', allow_none=True)
+
+    class Meta:
+        unknown = RAISE
+
+
+class TrackerAssignmentChange(Schema):
+    """Validates one requested change of tracker assignment."""
+    rider_id = fields.Integer(data_key='riderId', required=True)
+    tracker_id = fields.Integer(data_key='trackerId', required=True)
+    deposit_amount = fields.Float(data_key='depositAmount', missing=0)
+    notes = fields.String(data_key='notes', allow_none=True, missing=None)
+
+    class Meta:
+        unknown = RAISE
+
+
+class UtcDateTime(fields.DateTime):
+    """Datetime field that reads ISO 8601 with any utc offset, or Z, and loads it as naive UTC."""
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            if value.endswith('Z'):
+                value = value[:-1] + '+00:00'
+            loaded = datetime.fromisoformat(value)
+        except (AttributeError, TypeError, ValueError):
+            self.fail('invalid', obj_type=self.OBJ_TYPE)
+        if loaded.tzinfo is not None:
+            loaded = loaded.astimezone(timezone.utc).replace(tzinfo=None)
+        return loaded
+
+
+class PositionFix(Schema):
+    """Validates one position fix reported by a tracker."""
+    esn = fields.String(required=True)
+    latitude = fields.Float(required=True, validate=validate.Range(-90, 90))
+    longitude = fields.Float(required=True, validate=validate.Range(-180, 180))
+    time = UtcDateTime(required=True)
+
+    class Meta:
+        unknown = RAISE
+
+
+class LatestPositionSerializer(ModelSchema):
+    trackerId = fields.Integer(attribute='tracker')
+    riderId = fields.Integer(attribute='rider')
+
+    class Meta:
+        model = LatestPositions
+        fields = (
+            'trackerId',
+            'riderId',
+            'time',
+            'latitude',
+            'longitude',
+        )
+
+
+class CheckpointSerializer(ModelSchema):
+
+    class Meta:
+        model = Checkpoints
+        fields = (
+            'id',
+            'name',
+            'arrivals',
+        )
+
+
+class CheckpointSeenSerializer(ModelSchema):
+    checkPoint = fields.Integer(attribute='checkpoint')
+    timeSeen = fields.DateTime(attribute='time')
+
+    class Meta:
+        model = CheckpointArrivals
+        fields = (
+            'checkPoint',
+            'timeSeen',
+        )
+
+
+class RiderAtCheckpointSerializer(ModelSchema):
+    id = fields.Integer(attribute='rider')
+    firstName = fields.String(attribute='rider_details.first_name')
+    lastName = fields.String(attribute='rider_details.last_name')
+    capNumber = fields.String(attribute='rider_details.cap_number')
+    timeSeen = fields.DateTime(attribute='time')
+
+    class Meta:
+        model = CheckpointArrivals
+        fields = (
+            'id',
+            'firstName',
+            'lastName',
+            'capNumber',
+            'timeSeen',
+        )
+        loading_profile = (
+            joinedload(CheckpointArrivals.rider_details),
+        )
+
+
+class CheckpointLoad(Schema):
+    """Validates a new checkpoint."""
+    name = fields.String(required=True)
+
+    class Meta:
+        unknown = RAISE
+
+
+class CheckpointArrivalLoad(Schema):
+    """Validates an arrival, time defaults to when the request is handled."""
+    time = UtcDateTime(missing=None)
+
+    class Meta:
+        unknown = RAISE
+
+
+class EventRangeLoad(Schema):
+    """Validates the time range of an event timeline, since is inclusive and until exclusive."""
+    since = UtcDateTime(missing=None)
+    until = UtcDateTime(missing=None)
 
 
 single_rider = RiderSerializer()
+# detail serializers leaving out the rider's history, keyed by the nested fields left out
+single_rider_without = {
+    frozenset(): single_rider,
+    frozenset(['events']): RiderSerializer(exclude=('events',)),
+    frozenset(['notes']): RiderSerializer(exclude=('notes',)),
+    frozenset(['events', 'notes']): RiderSerializer(exclude=('events', 'notes')),
+}
+many_riders_without_history = RiderSerializer(many=True, exclude=('events', 'notes'))
 many_riders = RiderSerializer(many=True)
 rider_change_tracker_state = RiderChangeTrackerState()
+rider_import = RiderImportSerializer()
+rider_patch = RiderPatch()
+tracker_assignment_change = TrackerAssignmentChange()
+position_fix = PositionFix()
+many_latest_positions = LatestPositionSerializer(many=True)
+
+single_checkpoint = CheckpointSerializer()
+many_checkpoints = CheckpointSerializer(many=True)
+many_checkpoints_seen = CheckpointSeenSerializer(many=True)
+many_riders_at_checkpoint = RiderAtCheckpointSerializer(many=True)
+checkpoint_load = CheckpointLoad()
+checkpoint_arrival_load = CheckpointArrivalLoad()
+event_range_load = EventRangeLoad()
+many_rider_events = RiderEventsSerializer(many=True)
+many_tracker_events = TrackerEventsSerializer(many=True)
 
 single_tracker = TrackerSerializer()
 many_trackers = TrackerSerializer(many=True)
+tracker_patch = TrackerPatch()
 
 
 
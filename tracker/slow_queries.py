@@ -0,0 +1,175 @@
+"""
+Slow-query log: statement timings aggregated by fingerprint.
+
+A fingerprint is a statement with its literals, bound parameters, IN lists and multi row
+VALUES collapsed, so every execution of the same query shape shares one entry whatever its
+values. Each entry keeps the count, total and max time of its executions and the endpoints
+that sent them. Executions over the threshold are also logged, and the latest of them are
+kept as samples with their bound parameters and endpoint.
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from tracker.metrics import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_PARAMS = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+|\$\d+')
+_NUMBERS = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.IGNORECASE)
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ROWS = re.compile(r'(VALUES\s*\([^()]*\))(?:\s*,\s*\([^()]*\))+', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+# longest rendering of a sample's parameters kept
+MAX_PARAMETERS_LENGTH = 1000
+
+
+def fingerprint(statement):
+    """
+    Return statement with its values replaced by ?, e.g. for grouping executions of one query.
+
+    :param statement: sql as sent to the db.
+    :return: normalized sql.
+    """
+    statement = _COMMENTS.sub(' ', statement)
+    statement = _STRINGS.sub('?', statement)
+    statement = _PARAMS.sub('?', statement)
+    statement = _NUMBERS.sub('?', statement)
+    statement = _SPACE.sub(' ', statement).strip()
+    statement = _IN_LISTS.sub('(?, ...)', statement)
+    return _ROWS.sub(r'\1, ...', statement)
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return BACKGROUND
+
+
+def _parameters(parameters, executemany):
+    if executemany:
+        text = '%r (%d rows)' % (list(parameters[:10]), len(parameters))
+    else:
+        text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + '...'
+    return text
+
+
+class SlowQueryLog(object):
+    """
+    Time the statements of an engine by fingerprint, logging those slower than threshold.
+
+    :param threshold: seconds after which a statement is slow, logged and kept as a sample.
+    :param samples: slow executions kept per fingerprint, the latest ones.
+    :param max_fingerprints: fingerprints aggregated at most, new ones are not added after.
+    """
+
+    def __init__(self, threshold=0.1, samples=5, max_fingerprints=1000):
+        self.threshold = threshold
+        self.samples = samples
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._entries = {}
+        # statements seen, sent as the same strings each time, mapped to their fingerprints
+        self._fingerprints = {}
+        self.stats = {'statements': 0, 'slow': 0, 'dropped': 0}
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def uninstall(self, engine):
+        event.remove(engine, 'before_cursor_execute', self._before_execute)
+        event.remove(engine, 'after_cursor_execute', self._after_execute)
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['slow_query_started'] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('slow_query_started', time.perf_counter())
+        self.record(statement, elapsed, parameters, executemany)
+
+    def record(self, statement, elapsed, parameters=None, executemany=False):
+        """
+        Add one execution of statement that took elapsed seconds.
+
+        :param statement: sql as sent to the db.
+        :param elapsed: seconds the execution took.
+        :param parameters: bound parameters, only rendered if the execution was slow.
+        :param executemany: whether parameters is a list of parameter sets.
+        """
+        fingerprint_ = self._fingerprints.get(statement)
+        if fingerprint_ is None:
+            fingerprint_ = fingerprint(statement)
+            if len(self._fingerprints) < self.max_fingerprints * 10:
+                self._fingerprints[statement] = fingerprint_
+        endpoint = _endpoint()
+        slow = elapsed >= self.threshold
+        with self._lock:
+            self.stats['statements'] += 1
+            entry = self._entries.get(fingerprint_)
+            if entry is None:
+                if len(self._entries) >= self.max_fingerprints:
+                    self.stats['dropped'] += 1
+                    return
+                entry = self._entries[fingerprint_] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0, 'slow': 0,
+                    'endpoints': {}, 'samples': deque(maxlen=self.samples),
+                }
+            entry['count'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['endpoints'][endpoint] = entry['endpoints'].get(endpoint, 0) + 1
+            if slow:
+                self.stats['slow'] += 1
+                entry['slow'] += 1
+        if slow:
+            rendered = _parameters(parameters, executemany)
+            with self._lock:
+                entry['samples'].append({
+                    'ms': round(elapsed * 1000, 3),
+                    'endpoint': endpoint,
+                    'parameters': rendered,
+                    'at': datetime.utcnow().isoformat(),
+                })
+            logger.warning('Slow query %.1fms from %s: %s parameters %s',
+                           elapsed * 1000, endpoint, _SPACE.sub(' ', statement).strip(), rendered)
+
+    def report(self, limit=20):
+        """
+        Return the fingerprints that took the most time in total, slowest first.
+
+        :param limit: number of fingerprints to return.
+        :return: json serializable dict.
+        """
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda item: item[1]['total'], reverse=True)[:limit]
+            fingerprints = [
+                {
+                    'fingerprint': fingerprint_,
+                    'count': entry['count'],
+                    'total_ms': round(entry['total'] * 1000, 3),
+                    'mean_ms': round(entry['total'] * 1000 / entry['count'], 3),
+                    'max_ms': round(entry['max'] * 1000, 3),
+                    'slow': entry['slow'],
+                    'endpoints': dict(entry['endpoints']),
+                    'samples': list(entry['samples']),
+                }
+                for fingerprint_, entry in entries
+            ]
+            return dict(self.stats, threshold_ms=self.threshold * 1000, fingerprints=fingerprints)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.stats = {'statements': 0, 'slow': 0, 'dropped': 0}
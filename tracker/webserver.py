@@ -1,331 +1,1356 @@
 #!/usr/bin/env python
+import atexit
+import codecs
+import csv
+import itertools
+import os
+import time
+import zlib
 from datetime import datetime
 
 import connexion
-from flask import request, json, Flask
+from flask import request, json, Flask, g, has_request_context, session, stream_with_context, url_for
+from sqlalchemy import event, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from marshmallow import ValidationError
 
 from tracker import db_interactions as db
-from tracker.models import Riders, Trackers, TrackerEvents, TrackerNotes, RiderEvents, RiderNotes
+from tracker.models import (
+    CheckpointArrivals,
+    Checkpoints,
+    LatestPositions,
+    Riders,
+    Trackers,
+    TrackerEvents,
+    TrackerNotes,
+    RiderEvents,
+    RiderNotes,
+    RiderAssignment
+)
 from tracker import serializers as sl
+from tracker import compiled_serializers as cs
+from tracker import export
+from tracker import ingest
+from tracker import metrics as mt
+from tracker import query_budget as qb
+from tracker import replicas
+from tracker.esn_index import EsnIndex
+from tracker import response_cache as rc
+from tracker import rider_search
+from tracker import slow_queries as sq
 
 app = Flask(__name__)
+# signs the session cookie, set SECRET_KEY when several processes serve the same clients
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
+# flush buffered positions from a background thread, as well as when the buffer fills
+app.config['POSITION_BACKGROUND_FLUSH'] = os.environ.get('POSITION_BACKGROUND_FLUSH', '1') == '1'
+
+position_writer = ingest.PositionWriter(
+    batch_size=int(os.environ.get('POSITION_BATCH_SIZE', 500)),
+    max_delay=float(os.environ.get('POSITION_MAX_DELAY', 1.0)),
+    max_attempts=int(os.environ.get('POSITION_MAX_ATTEMPTS', 3)),
+)
+atexit.register(position_writer.flush)
+
+# resolves ESNs of incoming fixes and desk lookups without a query per request
+esn_index = EsnIndex()
+esn_index.install()
+
+# serialized read responses, invalidated when the riders and trackers they render change
+response_cache = rc.ResponseCache(
+    rc.make_backend(
+        os.environ.get('RESPONSE_CACHE_BACKEND', 'memory'),
+        int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    ),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 60)),
+)
+response_cache.enabled = os.environ.get('RESPONSE_CACHE', '1') == '1'
+response_cache.init_app(app)
+
+
+
+def _mark_request_session():
+    # only requests of this app get a request session, the teardown below releases it
+    g.db_request = True
+
+
+def _request_session():
+    """Return the session of the current request, made on its first use."""
+    if not has_request_context() or not g.get('db_request'):
+        return None
+    session = g.get('db_session')
+    if session is None:
+        session = g.db_session = db.Session(bind=db.engine)
+    return session
+
+
+def _release_request_session(exception=None):
+    session = g.pop('db_session', None)
+    if session is not None:
+        session.close()
+
+
+# every session_scope of a request shares one session, closed when the request ends
+app.before_request(_mark_request_session)
+app.teardown_request(_release_request_session)
+db.use_request_sessions(_request_session)
+
+# the WAL of a sqlite file is checkpointed in the background, rather than by the commit filling it
+wal_checkpointer = None
+if db.engine_pragmas(db.engine).get('journal_mode', '').upper() == 'WAL':
+    wal_checkpointer = db.WalCheckpointer(
+        db.engine,
+        interval=float(os.environ.get('SQLITE_CHECKPOINT_INTERVAL', 10)),
+        truncate_pages=int(os.environ.get('SQLITE_CHECKPOINT_TRUNCATE_PAGES', 10000)),
+    )
+    wal_checkpointer.start()
+
+# latency, sql statement counts and db time per endpoint, served on /metrics
+metrics = mt.Metrics()
+metrics.init_app(app)
+metrics.install(db.engine)
+metrics.gauges('response_cache', 'Response cache counts and size.', response_cache.info)
+metrics.gauges('position_writer', 'Buffered, written, repeated, retried and dropped position fixes.',
+               lambda: position_writer.stats)
+metrics.gauges('esn_index', 'ESN index lookups and entries.', lambda: dict(esn_index.stats, entries=len(esn_index)))
+metrics.gauges('db_pool', 'Db connection pool checkouts, waits and connections in use.', db.pool_stats)
+metrics.gauges('db_busy', 'Writes retried because sqlite was busy, and writes that failed after retries.',
+               lambda: db.busy_stats)
+if wal_checkpointer is not None:
+    metrics.gauges('sqlite_wal', 'WAL checkpoints and pages.', lambda: wal_checkpointer.stats)
+
+# statement timings by fingerprint, statements slower than the threshold are logged with their parameters
+slow_queries = sq.SlowQueryLog(threshold=float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.1)))
+slow_queries.install(db.engine)
+
+# riders are searched through the db's text index, built by tracker.migrate and with the riders table
+rider_search.install(db.engine)
+
+# api sort keys allowed on list endpoints, mapped to model attributes
+RIDER_SORT_KEYS = {
+    'id': 'id',
+    'capNumber': 'cap_number',
+    'lastName': 'last_name',
+}
+TRACKER_SORT_KEYS = {
+    'id': 'id',
+    'lastTestDate': 'last_test_date',
+}
+
+# most sql statements one request to each endpoint may send, for pages of up to 25 rows.
+# Endpoints that write or read in batches of rows send a statement per batch and are not
+# budgeted: POST /positions, /riders/import and /export.
+QUERY_BUDGETS = {
+    'get_riders': 5,
+    'search_riders': 3,
+    # conditional GETs check versions first
+    'get_rider': 6,
+    'get_rider_events': 3,
+    'post_riders': 1,
+    # the update, then the rider loaded as GET loads it
+    'patch_rider': 6,
+    'get_trackers': 3,
+    'get_tracker': 3,
+    'get_tracker_events': 3,
+    'post_tracker': 1,
+    # the update, the tracker loaded as GET loads it, and its ESN reloaded when the patch changes it
+    'patch_tracker': 4,
+    # the rider and tracker checked, then assignment, tracker, events, notes and balance, read back
+    # unless postgres returns it; the rider checked is rendered and the tracker's ESN entry set
+    'tracker_assignment_add': 10,
+    'tracker_assignment_remove': 10,
+    # and the events of changes without notes, inserted apart from those the notes refer to
+    'tracker_assignment_add_batch': 12,
+    'get_latest_positions': 1,
+    'get_checkpoints': 1,
+    'post_checkpoint': 2,
+    'get_checkpoint_riders': 2,
+    'post_checkpoint_arrival': 11,
+    'get_cache_stats': 0,
+    'get_metrics': 0,
+    'get_slow_queries': 0,
+    'get_db_stats': 0,
+    'tracker_possession_post': 0,
+    'tracker_possession_delete': 0,
+}
+# requests over budget are logged in debug, QUERY_BUDGET=raise makes them fail
+query_budget = qb.QueryBudget(QUERY_BUDGETS, mode=os.environ.get('QUERY_BUDGET'))
+query_budget.init_app(app)
+query_budget.install(db.engine)
+
+# key in the signed session cookie holding the time of a client's last write, so its reads wait for
+# replicas to catch up. The cookie is set by the server only, clients cannot send a time of their own.
+LAST_WRITE_KEY = 'last_write'
+
+
+def _client_last_write():
+    """Return the time of the current client's last write, made in this request or in an earlier one."""
+    if not has_request_context():
+        return None
+    if 'db_last_write' in g:
+        return g.db_last_write
+    last_write = session.get(LAST_WRITE_KEY)
+    if not isinstance(last_write, float):
+        return None
+    # a cookie signed with a key from another host could be ahead of this clock
+    return min(last_write, time.time())
+
+
+def _request_committed(conn):
+    # commits outside requests, e.g. replica heartbeats and background position flushes, are no client's
+    if has_request_context():
+        g.db_last_write = time.time()
+
+
+def _send_last_write(response):
+    last_write = g.get('db_last_write')
+    if last_write is not None:
+        session[LAST_WRITE_KEY] = last_write
+    return response
+
+
+event.listen(db.engine, 'commit', _request_committed)
+app.after_request(_send_last_write)
+
+# pages and details of riders and trackers are read from replicas when DB_REPLICA_URIS is set
+replica_router = replicas.set_up_replicas(db.engine, last_write=_client_last_write)
+if replica_router is not None:
+    replica_router.start()
+    db.use_replicas(replica_router)
+    for replica in replica_router.replicas:
+        metrics.install(replica)
+        slow_queries.install(replica)
+        query_budget.install(replica)
+    metrics.gauges('db_replicas', 'Reads served by replicas and the primary, and replica lags.', replica_router.info)
+
+
+def _rider_tags(rider):
+    """Cache tags of a rendered rider, the rider and the trackers rendered with it."""
+    return ['rider:%s' % rider.id] + [
+        'tracker:%s' % assignment.tracker.id
+        for assignment in rider.trackers_assigned if assignment.tracker is not None
+    ]
+
+
+def _tracker_tags(tracker):
+    """Cache tags of a rendered tracker, the tracker and the rider rendered with it."""
+    tags = ['tracker:%s' % tracker.id]
+    if tracker.rider is not None:
+        tags.append('rider:%s' % tracker.rider.id)
+    return tags
+
+
+def _next_page_url(cursor, **parsed):
+    """
+    Return the url of the page after the current request's, with every query arg kept but the cursor.
+
+    :param cursor: cursor of the next page.
+    :param parsed: query args as the request parsed them, repeated even where it left them out, e.g. limit.
+    """
+    args = request.args.to_dict(flat=False)
+    args.update(parsed, cursor=cursor)
+    return url_for(request.endpoint, **dict(request.view_args, **args))
+
+
+def _get_resource_page(model, key, sort_keys, serializer, item_serializer, tags):
+    """
+    Return a page of resources with an opaque cursor to the next page.
+
+    Query args are limit, sort (one of sort_keys), cursor (from a previous page) and start
+    (lowest id to return). With stream=1 the page is streamed, see _stream_page.
+    """
+    limit = request.args.get('limit', 25, type=int)
+    start = request.args.get('start', type=int)
+    cursor = request.args.get('cursor')
+    sort = request.args.get('sort', 'id')
+    if sort not in sort_keys or limit < 1:
+        return app.response_class(status=400, response='Invalid sort or limit')
+    if request.args.get('stream') in ('1', 'true'):
+        return _stream_page(model, key, limit, sort, sort_keys[sort], cursor, start, item_serializer)
+    with db.session_scope(read_only=True) as session:
+        try:
+            data, next_cursor = db.get_page(
+                session,
+                model,
+                limit,
+                sort=sort_keys[sort],
+                cursor=cursor,
+                start=start,
+                options=sl.loading_profile(serializer),
+            )
+        except ValueError:
+            return app.response_class(status=400, response='Invalid cursor')
+        if not data and cursor is None:
+            # if request starts later than the last id
+            if start is not None and db.has_rows(session, model):
+                return app.response_class(status=416)
+            return app.response_class(status=204)
+        rc.cache_tags(key, *[tag for row in data for tag in tags(row)])
+        next_url = None
+        if next_cursor is not None:
+            next_url = _next_page_url(next_cursor, limit=limit, sort=sort)
+        body = b''.join((
+            b'{"', key.encode(), b'": ', cs.dumps(serializer, data),
+            b', "next": ', json.dumps(next_url).encode(), b'}',
+        ))
+        return app.response_class(
+            response=body,
+            status=200,
+            mimetype='application/json'
+        )
+
+
+# rows fetched per round trip, and bytes buffered per chunk, when streaming a page
+STREAM_BATCH_SIZE = 500
+STREAM_CHUNK_BYTES = 16 * 1024
+
+
+def _stream_page(model, key, limit, sort, attribute, cursor, start, item_serializer):
+    """
+    Stream a page as it is read, with the same body as the buffered response.
+
+    Rows are fetched STREAM_BATCH_SIZE at a time with yield_per and rendered one by one, so
+    memory use does not grow with limit. The body is gzipped if the client accepts it.
+    Streamed responses are not cached.
+    """
+    session = db.Session(bind=db.engine)
+    try:
+        query = db.page_query(
+            session,
+            model,
+            limit,
+            sort=attribute,
+            cursor=cursor,
+            start=start,
+            options=sl.loading_profile(item_serializer),
+        )
+        rows = iter(query.yield_per(STREAM_BATCH_SIZE))
+        first = next(rows, None)
+    except ValueError:
+        session.close()
+        return app.response_class(status=400, response='Invalid cursor')
+    except Exception:
+        session.close()
+        raise
+    if first is None:
+        try:
+            if cursor is None:
+                # if request starts later than the last id
+                if start is not None and db.has_rows(session, model):
+                    return app.response_class(status=416)
+                return app.response_class(status=204)
+        finally:
+            session.close()
+
+    def generate():
+        try:
+            chunk = [b'{"', key.encode(), b'": [']
+            size = 0
+            count = 0
+            last = None
+            for row in itertools.chain([first] if first is not None else [], rows):
+                if count == limit:
+                    # the extra row shows there is a next page
+                    next_url = _next_page_url(db.page_cursor(last, attribute), limit=limit, sort=sort)
+                    break
+                item = cs.dumps(item_serializer, row)
+                chunk.append(b', ' + item if count else item)
+                size += len(item)
+                count += 1
+                last = row
+                if size >= STREAM_CHUNK_BYTES:
+                    yield b''.join(chunk)
+                    chunk = []
+                    size = 0
+            else:
+                next_url = None
+            chunk.append(b'], "next": ' + json.dumps(next_url).encode() + b'}')
+            yield b''.join(chunk)
+        finally:
+            session.close()
+
+    return _stream_response(generate(), 'application/json')
+
+
+def _stream_response(chunks, mimetype):
+    """Return a 200 streaming chunks, gzipped if the client accepts it."""
+    body = stream_with_context(chunks)
+    response = app.response_class(response=body, status=200, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings:
+        response.response = _gzip_chunks(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _gzip_chunks(chunks):
+    """Gzip an iterable of byte chunks, yielding each compressed chunk as it is produced."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 @app.route('/riders', methods=['POST'])
+@db.retry_busy
 def post_riders():
-    post_data = request.get_json()
-    with db.session_scope() as session:
-        data = db.create(session, Riders, **post_data)
-        return app.response_class(response=sl.single_rider.dumps(data).data,
-                                  status=201,
-                                  mimetype='application/json')
+    """Create a rider from a json object with the fields of an imported rider, returning it as GET does."""
+    post_data = request.get_json(silent=True)
+    if not isinstance(post_data, dict):
+        return app.response_class(status=400, response='Expected a json object')
+    try:
+        values = sl.rider_import.load(post_data)
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    with db.session_scope(commit=True) as session:
+        data = db.create(session, Riders, **values)
+        session.flush()
+        # a new rider has no history or trackers, so rendering it loads nothing
+        for relation in ('events', 'notes', 'trackers_assigned'):
+            set_committed_value(data, relation, [])
+        rc.changed('riders')
+        # rendered before the commit expires the instance
+        body = json.dumps(sl.single_rider.dump(data))
+    return app.response_class(response=body, status=201, mimetype='application/json')
+
+
+# rows inserted per executemany during a bulk import
+IMPORT_BATCH_SIZE = 500
+
+
+def _uploaded_riders():
+    """
+    Yield (row number, rider dict) for each rider in the request body.
+
+    Csv (text/csv) and newline delimited json (application/x-ndjson) bodies are read line by
+    line from the request stream, so large uploads are never held in memory. A json array
+    (application/json) is parsed whole. Rows that cannot be parsed are yielded as a
+    ValidationError instead of a dict.
+    """
+    mimetype = request.mimetype
+    if mimetype == 'text/csv':
+        charset = request.mimetype_params.get('charset', 'utf-8')
+        reader = csv.DictReader(codecs.iterdecode(request.stream, charset))
+        for row_number, row in enumerate(reader, 1):
+            # cells past the header are gathered under the key None
+            if None in row:
+                yield row_number, ValidationError('Too many columns')
+                continue
+            # empty cells are treated as missing values
+            yield row_number, {key: value for key, value in row.items() if value not in ('', None)}
+    elif mimetype == 'application/x-ndjson':
+        row_number = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                yield row_number, json.loads(line)
+            except ValueError:
+                yield row_number, ValidationError('Invalid json')
+    else:
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            raise ValueError('Expected a json array of riders')
+        for row_number, row in enumerate(rows, 1):
+            yield row_number, row
+
+
+@app.route('/riders/import', methods=['POST'])
+def import_riders():
+    """
+    Validate and insert many riders in one transaction.
+
+    Every row is validated before insert; invalid rows are reported with their row number and
+    do not stop the rest of the batch.
+    """
+    if request.mimetype not in ('application/json', 'text/csv', 'application/x-ndjson'):
+        return app.response_class(status=415, response='Expected json, ndjson or csv')
+    created = 0
+    errors = []
+    batch = []
+    try:
+        with db.session_scope(commit=True) as session:
+            rc.changed('riders')
+            for row_number, row in _uploaded_riders():
+                try:
+                    if isinstance(row, ValidationError):
+                        raise row
+                    batch.append(sl.rider_import.load(row))
+                except ValidationError as e:
+                    errors.append({'row': row_number, 'errors': e.messages})
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    created += db.bulk_insert(session, Riders, batch)
+                    batch = []
+            created += db.bulk_insert(session, Riders, batch)
+    except (ValueError, csv.Error) as e:
+        # unreadable body, nothing is committed
+        return app.response_class(status=400, response=str(e))
+    return app.response_class(
+        response=json.dumps({'created': created, 'errors': errors}),
+        status=200,
+        mimetype='application/json'
+    )
 
 
 @app.route('/riders', methods=['GET'])
+@response_cache.cached
 def get_riders():
-    start = request.args.get('start', 1, type=int)
+    return _get_resource_page(
+        Riders, 'riders', RIDER_SORT_KEYS, sl.many_riders, sl.single_rider, _rider_tags
+    )
+
+
+def _version_tag(version, related):
+    """
+    Return a strong etag from a row's version and the (id, version) of rows it renders nested.
+
+    :param version: version of the row.
+    :param related: iterable of (id, version) of nested rows whose changes show in the response.
+    """
+    return '-'.join([str(version)] + ['%s.%s' % pair for pair in sorted(related)])
+
+
+def _rider_etag(session, rider_id):
+    """Return the etag of a rider from its version and its trackers' versions, or None if not found."""
+    rows = session.query(
+        Riders.version,
+        Trackers.id,
+        Trackers.version
+    ).outerjoin(
+        RiderAssignment,
+        RiderAssignment.rider == Riders.id
+    ).outerjoin(
+        Trackers,
+        Trackers.rider_assigned == RiderAssignment.id
+    ).filter(Riders.id == rider_id).all()
+    if not rows:
+        return None
+    return _version_tag(rows[0][0], [(tracker_id, version) for _, tracker_id, version in rows if tracker_id])
+
+
+def _tracker_etag(session, tracker_id):
+    """Return the etag of a tracker from its version and its rider's version, or None if not found."""
+    row = session.query(
+        Trackers.version,
+        Riders.id,
+        Riders.version
+    ).outerjoin(
+        RiderAssignment,
+        Trackers.rider_assigned == RiderAssignment.id
+    ).outerjoin(
+        Riders,
+        RiderAssignment.rider == Riders.id
+    ).filter(Trackers.id == tracker_id).first()
+    if row is None:
+        return None
+    return _version_tag(row[0], [row[1:]] if row[1] is not None else [])
+
+
+def _not_modified(session, etag_lookup, id_):
+    """
+    Return a 304 response if the request's If-None-Match matches the current etag, else None.
+
+    Only the narrow version lookup runs, nothing is loaded or serialized.
+    """
+    if not request.if_none_match:
+        return None
+    etag = etag_lookup(session, id_)
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/riders/search', methods=['GET'])
+@response_cache.cached
+def search_riders():
+    """
+    Return riders matching every word of q as a prefix of their names, cap number or email.
+
+    Best matches come first, a page at a time, without the riders' history. Query args are q,
+    limit and cursor.
+    """
+    query = request.args.get('q', '')
     limit = request.args.get('limit', 25, type=int)
-    end = start + limit
+    cursor = request.args.get('cursor')
+    if not rider_search.terms(query) or limit < 1:
+        return app.response_class(status=400, response='Invalid q or limit')
+    offset = 0
+    if cursor is not None:
+        try:
+            offset = db.decode_cursor(cursor, 'rank', Riders.id)[0]
+            if offset is None or offset < 0:
+                raise ValueError('Invalid search offset')
+        except ValueError:
+            return app.response_class(status=400, response='Invalid cursor')
     with db.session_scope() as session:
-        data, last_rider = db.get_resources(session, start, end, Riders)
-        # if data is empty
-        if last_rider is None:
-            # todo put messages in response codes
-            return app.response_class(status=204)
-        # if request starts later than the last rider id
-        if start > last_rider.id:
-            # todo ensure that id is stored as an integer?
-            # return some sort of 4xx status
-            return app.response_class(status=416)
-        else:
-            return app.response_class(response=sl.many_riders.dumps(data),
-                                      status=200,
-                                      mimetype='application/json')
+        ids = rider_search.search(session, query, limit + 1, offset)
+        riders = db.get_by_ids(
+            session, Riders, ids[:limit], options=sl.loading_profile(sl.many_riders_without_history)
+        )
+        data = [riders[id_] for id_ in ids[:limit] if id_ in riders]
+        rc.cache_tags('riders', *[tag for rider in data for tag in _rider_tags(rider)])
+        next_url = None
+        if len(ids) > limit:
+            next_url = _next_page_url(db.encode_cursor('rank', offset + limit, ids[limit - 1]), limit=limit)
+        body = b''.join((
+            b'{"riders": ', cs.dumps(sl.many_riders_without_history, data),
+            b', "next": ', json.dumps(next_url).encode(), b'}',
+        ))
+        return app.response_class(response=body, status=200, mimetype='application/json')
 
 
 @app.route('/riders/<int:id>', methods=['GET'])
+@response_cache.cached
 def get_rider(id):
-    with db.session_scope() as session:
-        data = db.get(session, Riders, **request.view_args)
+    """
+    Return a rider with its trackers, notes and events.
+
+    exclude=events,notes leaves the rider's history out, so the response does not grow as
+    the race goes on; /riders/<id>/events pages through it instead.
+    """
+    exclude = frozenset(field for field in request.args.get('exclude', '').split(',') if field)
+    serializer = sl.single_rider_without.get(exclude)
+    if serializer is None:
+        return app.response_class(status=400, response='Only events and notes can be excluded')
+    with db.session_scope(read_only=True) as session:
+        not_modified = _not_modified(session, _rider_etag, id)
+        if not_modified is not None:
+            return not_modified
+        data = db.get(session, Riders, options=sl.loading_profile(serializer), **request.view_args)
         if data:
-            return app.response_class(response=sl.single_rider.dumps(data),
-                                      mimetype='application/json')
+            rider = data[0]
+            rc.cache_tags(*_rider_tags(rider))
+            response = app.response_class(response=cs.dumps(serializer, rider),
+                                          mimetype='application/json')
+            # the etag is built from the rows just rendered, so it never claims a newer state
+            response.set_etag(_version_tag(rider.version, [
+                (assignment.tracker.id, assignment.tracker.version)
+                for assignment in rider.trackers_assigned if assignment.tracker is not None
+            ]))
+            return response
         else:
             return app.response_class(status=204)
 
 
-# todo use json-merge-patch application type here
+def _get_events(model, owner_model, owner, owner_id, serializer, tag):
+    """
+    Return a page of an owner's events in time order, a range read of the (owner, datetime) index.
+
+    Query args are limit, cursor, since (inclusive), until (exclusive) and type, which can be
+    given more than once.
+    """
+    limit = request.args.get('limit', 25, type=int)
+    cursor = request.args.get('cursor')
+    types = request.args.getlist('type')
+    if limit < 1:
+        return app.response_class(status=400, response='Invalid limit')
+    try:
+        time_range = sl.event_range_load.load(
+            {key: request.args[key] for key in ('since', 'until') if key in request.args}
+        )
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    event_types = model.event_type.type.enum_class
+    if any(event_type not in event_types.__members__ for event_type in types):
+        return app.response_class(status=400, response='Invalid type')
+    filters = [owner == owner_id]
+    if time_range['since'] is not None:
+        filters.append(model.datetime >= time_range['since'])
+    if time_range['until'] is not None:
+        filters.append(model.datetime < time_range['until'])
+    if types:
+        filters.append(model.event_type.in_([event_types[event_type] for event_type in types]))
+    with db.session_scope() as session:
+        if session.query(owner_model.id).filter(owner_model.id == owner_id).first() is None:
+            return app.response_class(status=404, response='Not found')
+        try:
+            data, next_cursor = db.get_page(
+                session,
+                model,
+                limit,
+                sort='datetime',
+                cursor=cursor,
+                options=sl.loading_profile(serializer),
+                filters=filters,
+            )
+        except ValueError:
+            return app.response_class(status=400, response='Invalid cursor')
+        rc.cache_tags(tag)
+        next_url = None
+        if next_cursor is not None:
+            next_url = _next_page_url(next_cursor, limit=limit)
+        body = b''.join((
+            b'{"events": ', cs.dumps(serializer, data),
+            b', "next": ', json.dumps(next_url).encode(), b'}',
+        ))
+        return app.response_class(response=body, status=200, mimetype='application/json')
+
+
+@app.route('/riders/<int:id>/events', methods=['GET'])
+@response_cache.cached
+def get_rider_events(id):
+    return _get_events(RiderEvents, Riders, RiderEvents.rider, id, sl.many_rider_events, 'rider:%d' % id)
+
+
 @app.route('/riders/<int:id>', methods=['PATCH'])
+@db.retry_busy
 def patch_rider(id):
-    data_to_update = request.get_json()
-    with db.session_scope() as session:
-        data = db.update(session, Riders, data_to_update, **request.view_args)
-        if data:
-            # todo use serialization here
-            return app.response_class(response=json.dumps(data),
-                                      status=200,
-                                      mimetype='application/json')
-        else:
-            return app.response_class(status=204)
+    """Apply a JSON merge patch to a rider, returning the rider as GET returns it."""
+    return _patch(Riders, id, sl.rider_patch, sl.single_rider, ('riders', 'rider:%d' % id))
 
 
 @app.route('/trackers', methods=['POST'])
+@db.retry_busy
 def post_tracker():
     post_data = request.get_json()
     with db.session_scope() as session:
         data = db.create(session, Trackers, **post_data)
+        rc.changed('trackers')
         return app.response_class(response=sl.single_tracker.dumps(data),
                                   status=201,
                                   mimetype='application/json')
 
 
 @app.route('/trackers', methods=['GET'])
+@response_cache.cached
 def get_trackers():
-    start = request.args.get('start', 1, type=int)
-    limit = request.args.get('limit', 25, type=int)
-    end = start + limit
+    if 'esn' in request.args:
+        return _get_trackers_by_esn(request.args.getlist('esn'))
+    return _get_resource_page(
+        Trackers, 'trackers', TRACKER_SORT_KEYS, sl.many_trackers, sl.single_tracker, _tracker_tags
+    )
+
+
+def _get_trackers_by_esn(esns):
+    """Return the trackers with the given ESNs, resolved through the ESN index."""
     with db.session_scope() as session:
-        data, last_tracker = db.get_resources(session, start, end, Trackers)
-        # if data is empty
-        if last_tracker is None:
-            # todo put messages in response codes
+        tracker_ids = [tracker_id for tracker_id, _ in esn_index.lookup(session, esns).values()]
+        if not tracker_ids:
             return app.response_class(status=204)
-        # if request starts later than the last rider id
-        if start > last_tracker.id:
-            # todo ensure that id is stored as an integer?
-            # return some sort of 4xx status
-            return app.response_class(status=416)
-        else:
-            return app.response_class(response=sl.many_trackers.dumps(data),
-                                      status=200,
-                                      mimetype='application/json')
+        trackers = db.get_by_ids(
+            session,
+            Trackers,
+            tracker_ids,
+            options=sl.loading_profile(sl.many_trackers)
+        )
+        data = [trackers[tracker_id] for tracker_id in sorted(trackers)]
+        rc.cache_tags('trackers', *[tag for tracker in data for tag in _tracker_tags(tracker)])
+        return app.response_class(
+            response=b'{"trackers": ' + cs.dumps(sl.many_trackers, data) + b', "next": null}',
+            status=200,
+            mimetype='application/json'
+        )
 
 
 @app.route('/trackers/<int:id>', methods=['GET'])
+@response_cache.cached
 def get_tracker(id):
-    with db.session_scope() as session:
-        data = db.get(session, Trackers, **request.view_args)
+    with db.session_scope(read_only=True) as session:
+        not_modified = _not_modified(session, _tracker_etag, id)
+        if not_modified is not None:
+            return not_modified
+        data = db.get(session, Trackers, options=sl.loading_profile(sl.single_tracker), **request.view_args)
         if data:
-            return app.response_class(response=sl.single_tracker.dumps(data),
-                                      mimetype='application/json')
+            tracker = data[0]
+            rc.cache_tags(*_tracker_tags(tracker))
+            response = app.response_class(response=cs.dumps(sl.single_tracker, tracker),
+                                          mimetype='application/json')
+            response.set_etag(_version_tag(
+                tracker.version,
+                [(tracker.rider.id, tracker.rider.version)] if tracker.rider is not None else []
+            ))
+            return response
         else:
             return app.response_class(status=204)
 
 
-# todo use json-merge-patch application type here
+@app.route('/trackers/<int:id>/events', methods=['GET'])
+@response_cache.cached
+def get_tracker_events(id):
+    return _get_events(
+        TrackerEvents, Trackers, TrackerEvents.tracker, id, sl.many_tracker_events, 'tracker:%d' % id
+    )
+
+
 @app.route('/trackers/<int:id>', methods=['PATCH'])
+@db.retry_busy
 def patch_tracker(id):
-    data_to_update = request.get_json()
-    with db.session_scope() as session:
-        data = db.update(session, Trackers, data_to_update, **request.view_args)
-        if data:
-            return app.response_class(response=sl.single_tracker.dumps(data),
-                                      status=200,
-                                      mimetype='application/json')
-        else:
+    """Apply a JSON merge patch to a tracker, returning the tracker as GET returns it."""
+    return _patch(Trackers, id, sl.tracker_patch, sl.single_tracker, ('trackers', 'tracker:%d' % id))
+
+
+MERGE_PATCH = 'application/merge-patch+json'
+
+
+def _patch(model, id_, schema, serializer, tags):
+    """
+    Apply the JSON merge patch (RFC 7396) in the request body to the row of model with id_.
+
+    Only the fields sent are validated and set, null clears a field. The row is written with one
+    UPDATE, then loaded and rendered as GET loads and renders it. Plain json bodies are accepted
+    as merge patches too.
+
+    :param model: db model to update.
+    :param id_: id of the row.
+    :param schema: schema loading the patch as column values, e.g. sl.rider_patch.
+    :param serializer: serializer rendering the updated row, its loading profile loads it.
+    :param tags: response cache tags invalidated by the change.
+    """
+    if request.mimetype not in (MERGE_PATCH, 'application/json'):
+        return app.response_class(status=415, response='Expected %s' % MERGE_PATCH)
+    patch = request.get_json(silent=True)
+    if not isinstance(patch, dict):
+        return app.response_class(status=400, response='Expected a json object')
+    try:
+        values = schema.load(patch)
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    with db.session_scope(commit=True) as session:
+        instance = db.patch(session, model, id_, values, options=sl.loading_profile(serializer))
+        if instance is None:
             return app.response_class(status=204)
+        if 'esn_number' in values:
+            esn_index.changed(session, [id_])
+        rc.changed(*tags)
+        # rendered before the commit expires the instance
+        body = cs.dumps(serializer, instance)
+    return app.response_class(response=body, status=200, mimetype='application/json')
 
 
-def _check_rider_tracker_status(session, rider_id, tracker_id):
-    tracker = db.get(session, Trackers, **{'id': tracker_id})
-    rider = db.get(session, Riders, **{'id': rider_id})
-    if not tracker:
-        return app.response_class(status=404, response='Tracker not found')
-    elif not rider:
-        return app.response_class(status=404, response='Rider not found')
-    else:
-        return tracker, rider
+# tracker event, rider event and sign of the deposit for adding (True) or removing an assignment
+ASSIGNMENT_CHANGES = {
+    True: ('add_tracker_assignment', 'payment_out', -1),
+    False: ('remove_tracker_assignment', 'payment_in', 1),
+}
 
 
-def _create_event(
-        session,
-        model,
-        user_id,
-        datetime,
-        event_type,
-        tracker_id,
-        **kwargs
-):
-    return db.create_(
-        session,
-        model(
-            user_id=user_id,
-            datetime=datetime,
-            event_type=event_type,
-            tracker=tracker_id,
-            **kwargs,
-        ),
-    )
+def _check_assignment_changes(session, changes, assign):
+    """
+    Check that each requested change can be made, loading the riders and trackers it changes.
 
+    Riders are loaded with one IN query, with the loading profile of the response rendering them
+    once changed, and trackers with another, along with the rider each is assigned to.
 
-def _create_notes(session, model, datetime, id_to_link_notes_to, user_id, notes, event_id):
-    return db.create_(
+    :return: tuple of (list with, per change, None if it can be made or a (status, message) tuple
+        if not, dict of rider id to rider, dict of tracker id to tracker).
+    """
+    riders = db.get_by_ids(
         session,
-        model(
-            tracker=id_to_link_notes_to,
-            datetime=datetime,
-            user=user_id,
-            event=event_id,
-            notes=notes
-        ),
+        Riders,
+        {change['rider_id'] for change in changes},
+        options=sl.loading_profile(sl.rider_change_tracker_state)
     )
+    assigned_riders = {}
+    trackers = {}
+    for tracker, assigned_rider in session.query(
+        Trackers,
+        RiderAssignment.rider
+    ).outerjoin(
+        RiderAssignment,
+        Trackers.rider_assigned == RiderAssignment.id
+    ).filter(Trackers.id.in_({change['tracker_id'] for change in changes})):
+        trackers[tracker.id] = tracker
+        assigned_riders[tracker.id] = assigned_rider
+    errors = []
+    seen_trackers = set()
+    for change in changes:
+        tracker = trackers.get(change['tracker_id'])
+        if change['rider_id'] not in riders:
+            errors.append((404, 'Rider not found'))
+        elif tracker is None:
+            errors.append((404, 'Tracker not found'))
+        elif change['tracker_id'] in seen_trackers:
+            errors.append((409, 'Tracker changed more than once in one request'))
+        elif assign and tracker.rider_assigned is not None:
+            errors.append((409, 'Tracker already assigned'))
+        elif not assign and assigned_riders[tracker.id] != change['rider_id']:
+            errors.append((409, 'Tracker not assigned to rider'))
+        else:
+            seen_trackers.add(change['tracker_id'])
+            change['assignment_id'] = tracker.rider_assigned
+            errors.append(None)
+    return errors, riders, trackers
 
 
-@app.route('/riders/<int:rider_id>/trackers/<int:tracker_id>/addTrackerAssignment',
-           methods=['POST'])
-def tracker_assignment_add(rider_id, tracker_id):
-    now = datetime.now()
-    request_payload = request.get_json()
-    with db.session_scope() as session:
-        tracker, rider = _check_rider_tracker_status(session, rider_id, tracker_id)
-        db.update(
-            session,
-            Trackers,
-            {
-                'rider_assigned': rider_id
-            },
-            **{
-                'id': tracker_id,
-            },
-        )
-        created_tracker_event = _create_event(
-            session,
-            TrackerEvents,
-            None,
-            now,
-            'add_tracker_assignment',
-            tracker_id
-        )
-        _create_notes(
-            session,
-            TrackerNotes,
-            now,
-            tracker_id,
-            None,
-            request_payload['notes'],
-            created_tracker_event.id
-        )
-        session.flush()
-        created_rider_event = _create_event(
-            session,
-            RiderEvents,
-            None,
-            now,
-            'payment_out',
-            rider_id,
-            **{
-                'balance_change': request_payload['depositAmount']
-            }
-        )
-        session.flush()
-        _create_notes(
+def _show_assignment_changes(session, changes, assignment_ids, riders, trackers, balances):
+    """
+    Set the changes written in bulk on the riders and trackers loaded to check them, so they
+    render as a reload would without one.
+
+    :param changes: changes made, as checked by _check_assignment_changes.
+    :param assignment_ids: per change, id of the assignment added, or None for removals.
+    :param riders: dict of rider id to rider, loaded by _check_assignment_changes.
+    :param trackers: dict of tracker id to tracker, loaded by _check_assignment_changes.
+    :param balances: dict of rider id to the rider's new balance.
+    """
+    for change, assignment_id in zip(changes, assignment_ids):
+        rider = riders[change['rider_id']]
+        tracker = trackers[change['tracker_id']]
+        assignments = [
+            assignment for assignment in rider.trackers_assigned if assignment.id != change['assignment_id']
+        ]
+        if assignment_id is None:
+            for assignment in rider.trackers_assigned:
+                if assignment.id == change['assignment_id']:
+                    session.expunge(assignment)
+        else:
+            assignment = RiderAssignment(id=assignment_id, rider=rider.id)
+            make_transient_to_detached(assignment)
+            # a retry of the request may have left an instance with the same id in the session
+            assignment = session.merge(assignment, load=False)
+            set_committed_value(assignment, 'tracker', tracker)
+            assignments.append(assignment)
+        set_committed_value(rider, 'trackers_assigned', assignments)
+        set_committed_value(tracker, 'rider_assigned', assignment_id)
+        session.expire(tracker, ['version'])
+    for rider_id, balance in balances.items():
+        set_committed_value(riders[rider_id], 'balance', balance)
+        session.expire(riders[rider_id], ['version'])
+
+
+def _change_tracker_assignments(session, changes, assign):
+    """
+    Assign trackers to riders, or remove assignments, in bulk within the session's transaction.
+
+    Assignment rows, tracker and rider events, notes and deposit balances are each written
+    with one bulk statement, whatever the number of changes.
+
+    :param session: db session.
+    :param changes: list of changes loaded with sl.tracker_assignment_change.
+    :param assign: True to assign trackers, False to remove assignments.
+    :return: tuple of (list with, per change, None if it was made or a (status, message) tuple if
+        not, dict of rider id to the riders changed, loaded to render as sl.rider_change_tracker_state).
+    """
+    if not changes:
+        return [], {}
+    now = datetime.utcnow()
+    tracker_event, rider_event, sign = ASSIGNMENT_CHANGES[assign]
+    errors, riders, trackers = _check_assignment_changes(session, changes, assign)
+    accepted = [change for change, error in zip(changes, errors) if error is None]
+    if not accepted:
+        return errors, {}
+    if assign:
+        assignment_ids = db.bulk_insert_returning_ids(
             session,
-            RiderNotes,
-            now,
-            rider_id,
-            None,
-            request_payload['notes'],
-            created_rider_event.id
+            RiderAssignment,
+            [{'rider': change['rider_id']} for change in accepted]
         )
-        db.update(
-            session,
-            Riders,
-            {
-                'deposit_balance': rider.balance - request_payload['depositAmount']
-            },
-            **{
-                'id': rider_id
-            }
+    else:
+        assignment_ids = [None] * len(accepted)
+    db.bulk_update(
+        session,
+        Trackers,
+        [
+            {'id': change['tracker_id'], 'rider_assigned': assignment_id}
+            for change, assignment_id in zip(accepted, assignment_ids)
+        ]
+    )
+    if not assign:
+        db.bulk_delete(session, RiderAssignment, [change['assignment_id'] for change in accepted])
+    esn_index.assigned(session, {
+        change['tracker_id']: (trackers[change['tracker_id']].esn_number, change['rider_id'] if assign else None)
+        for change in accepted
+    })
+    rc.changed(*[
+        tag for change in accepted
+        for tag in ('rider:%d' % change['rider_id'], 'tracker:%d' % change['tracker_id'])
+    ])
+    tracker_events = [
+        {'user_id': None, 'datetime': now, 'event_type': tracker_event, 'tracker': change['tracker_id']}
+        for change in accepted
+    ]
+    rider_events = [
+        {
+            'user_id': None,
+            'datetime': now,
+            'event_type': rider_event,
+            'rider': change['rider_id'],
+            'balance_change': sign * change['deposit_amount'],
+        }
+        for change in accepted
+    ]
+    # only the events of changes with notes need their ids back, for the notes to refer to
+    noted = [index for index, change in enumerate(accepted) if change['notes']]
+    unnoted = [index for index, change in enumerate(accepted) if not change['notes']]
+    db.bulk_insert(session, TrackerEvents, [tracker_events[index] for index in unnoted])
+    db.bulk_insert(session, RiderEvents, [rider_events[index] for index in unnoted])
+    tracker_event_ids = db.bulk_insert_returning_ids(session, TrackerEvents, [tracker_events[index] for index in noted])
+    rider_event_ids = db.bulk_insert_returning_ids(session, RiderEvents, [rider_events[index] for index in noted])
+    db.bulk_insert(
+        session,
+        TrackerNotes,
+        [
+            {'tracker': accepted[index]['tracker_id'], 'datetime': now, 'user': None, 'event': event_id,
+             'notes': accepted[index]['notes']}
+            for index, event_id in zip(noted, tracker_event_ids)
+        ]
+    )
+    db.bulk_insert(
+        session,
+        RiderNotes,
+        [
+            {'rider': accepted[index]['rider_id'], 'datetime': now, 'user': None, 'event': event_id,
+             'notes': accepted[index]['notes']}
+            for index, event_id in zip(noted, rider_event_ids)
+        ]
+    )
+    balances = db.bulk_increment(
+        session,
+        Riders,
+        'balance',
+        [(change['rider_id'], sign * change['deposit_amount']) for change in accepted]
+    )
+    _show_assignment_changes(session, accepted, assignment_ids, riders, trackers, balances)
+    return errors, {change['rider_id']: riders[change['rider_id']] for change in accepted}
+
+
+def _change_tracker_assignment(rider_id, tracker_id, assign):
+    request_payload = request.get_json(silent=True) or {}
+    if not isinstance(request_payload, dict):
+        return app.response_class(status=400, response='Expected a json object')
+    try:
+        change = sl.tracker_assignment_change.load(
+            dict(request_payload, riderId=rider_id, trackerId=tracker_id)
         )
-        try:
-            session.commit()
-        except:
-            # todo put in logging!!!
-            print('There has been an exception here!')
-            session.rollback()
-            raise
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    with db.session_scope(commit=True) as session:
+        (error,), riders = _change_tracker_assignments(session, [change], assign)
+        if error is not None:
+            return app.response_class(status=error[0], response=error[1])
         return app.response_class(
             status=200,
-            response=sl.rider_change_tracker_state.dumps(rider)
+            response=cs.dumps(sl.rider_change_tracker_state, riders[rider_id]),
+            mimetype='application/json'
         )
 
+
+@app.route('/riders/<int:rider_id>/trackers/<int:tracker_id>/addTrackerAssignment',
+           methods=['POST'])
+@db.retry_busy
+def tracker_assignment_add(rider_id, tracker_id):
+    return _change_tracker_assignment(rider_id, tracker_id, assign=True)
+
+
 @app.route('/riders/<int:rider_id>/trackers/<int:tracker_id>/removeTrackerAssignment',
            methods=['POST'])
+@db.retry_busy
 def tracker_assignment_remove(rider_id, tracker_id):
-    now = datetime.now()
-    request_payload = request.get_json()
-    with db.session_scope() as session:
-        tracker, rider = _check_rider_tracker_status(session, rider_id, tracker_id)
-        db.update(
-            session,
-            Trackers,
-            {
-                'rider_assigned': None
-            },
-            **{
-                'id': tracker_id,
-            },
+    return _change_tracker_assignment(rider_id, tracker_id, assign=False)
+
+
+@app.route('/riders/trackers/addTrackerAssignment', methods=['POST'])
+@db.retry_busy
+def tracker_assignment_add_batch():
+    """
+    Assign many trackers in one transaction, e.g. at the registration desk.
+
+    The body is a json array of {riderId, trackerId, depositAmount, notes}. Each result is the
+    rider's tracker state after the whole batch, or an error for changes that were not made.
+    """
+    request_payload = request.get_json(silent=True)
+    if not isinstance(request_payload, list):
+        return app.response_class(status=400, response='Expected a json array of assignments')
+    errors = [None] * len(request_payload)
+    changes = []
+    for index, item in enumerate(request_payload):
+        try:
+            changes.append((index, sl.tracker_assignment_change.load(item)))
+        except ValidationError as e:
+            errors[index] = (400, e.messages)
+    with db.session_scope(commit=True) as session:
+        change_errors, riders = _change_tracker_assignments(
+            session, [change for _, change in changes], assign=True
         )
-        created_tracker_event = _create_event(
-            session,
-            TrackerEvents,
-            None,
-            now,
-            'remove_tracker_assignment',
-            tracker_id
+        made = {}
+        for (index, change), error in zip(changes, change_errors):
+            errors[index] = error
+            if error is None:
+                made[index] = change['rider_id']
+        results = [
+            cs.dumps(sl.rider_change_tracker_state, riders[made[index]]) if index in made
+            else json.dumps({'status': error[0], 'error': error[1]}).encode()
+            for index, error in enumerate(errors)
+        ]
+        return app.response_class(
+            status=200,
+            response=b'{"results": [' + b', '.join(results) + b']}',
+            mimetype='application/json'
         )
-        _create_notes(
-            session,
-            TrackerNotes,
-            now,
-            tracker_id,
-            None,
-            request_payload['notes'],
-            created_tracker_event.id
+
+
+@app.route('/positions', methods=['POST'])
+def post_positions():
+    """
+    Accept a json array of position fixes {esn, latitude, longitude, time}.
+
+    Fixes are matched to trackers and their currently assigned rider by ESN, then buffered and
+    written in groups, so the response (202) reports fixes accepted for writing rather than
+    written. Invalid fixes, unknown ESNs and fixes repeating one still buffered are rejected with
+    their index. Accepted fixes already in the db are skipped when written, and groups that fail
+    to write are retried then dropped; both are counted in the position_writer metrics.
+    """
+    request_payload = request.get_json(silent=True)
+    if not isinstance(request_payload, list):
+        return app.response_class(status=400, response='Expected a json array of positions')
+    errors = []
+    fixes = []
+    for index, item in enumerate(request_payload):
+        try:
+            fixes.append((index, sl.position_fix.load(item)))
+        except ValidationError as e:
+            errors.append({'index': index, 'errors': e.messages})
+    with db.session_scope() as session:
+        trackers = esn_index.lookup(session, {fix['esn'] for _, fix in fixes})
+    rows = ingest.position_rows(fixes, trackers)
+    known = {index for index, _ in rows}
+    for index, fix in fixes:
+        if index not in known:
+            errors.append({'index': index, 'errors': {'esn': ['Unknown ESN']}})
+    if app.config['POSITION_BACKGROUND_FLUSH']:
+        position_writer.start()
+    added = position_writer.add([row for _, row in rows])
+    for (index, _), was_added in zip(rows, added):
+        if not was_added:
+            errors.append({'index': index, 'errors': {'time': ['Repeated fix']}})
+    errors.sort(key=lambda error: error['index'])
+    return app.response_class(
+        response=json.dumps({
+            'accepted': len(request_payload) - len(errors),
+            'rejected': len(errors),
+            'errors': errors,
+        }),
+        status=202,
+        mimetype='application/json'
+    )
+
+
+@app.route('/positions/latest', methods=['GET'])
+def get_latest_positions():
+    """
+    Return the newest fix of every tracker, or of the trackers of the riders given as rider args.
+
+    Served from latest_positions, so the cost depends on the number of trackers, not fixes.
+    """
+    riders = request.args.getlist('rider', type=int)
+    with db.session_scope() as session:
+        query = session.query(LatestPositions).order_by(LatestPositions.tracker)
+        if riders:
+            query = query.filter(LatestPositions.rider.in_(riders))
+        body = cs.dumps(sl.many_latest_positions, query.all())
+        return app.response_class(
+            response=b'{"positions": ' + body + b'}',
+            status=200,
+            mimetype='application/json'
         )
-        session.flush()
-        created_rider_event = _create_event(
-            session,
-            RiderEvents,
-            None,
-            now,
-            'payment_in',
-            rider_id,
-            **{
-                'balance_change': request_payload['depositAmount']
-            }
+
+
+@app.route('/races', methods=['GET'])
+def get_checkpoints():
+    """Return every checkpoint with the number of riders through it."""
+    with db.session_scope() as session:
+        checkpoints = session.query(Checkpoints).order_by(Checkpoints.id).all()
+        return app.response_class(
+            response=b'{"checkpoints": ' + cs.dumps(sl.many_checkpoints, checkpoints) + b'}',
+            status=200,
+            mimetype='application/json'
         )
+
+
+@app.route('/races/<int:checkpoint_id>', methods=['POST'])
+@db.retry_busy
+def post_checkpoint(checkpoint_id):
+    try:
+        checkpoint = sl.checkpoint_load.load(request.get_json(silent=True) or {})
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    with db.session_scope(commit=True) as session:
+        if session.query(Checkpoints.id).filter(or_(
+            Checkpoints.id == checkpoint_id,
+            Checkpoints.name == checkpoint['name']
+        )).first() is not None:
+            return app.response_class(status=409, response='Checkpoint already exists')
+        data = db.create_(session, Checkpoints(id=checkpoint_id, arrivals=0, **checkpoint))
         session.flush()
-        _create_notes(
-            session,
-            RiderNotes,
-            now,
-            rider_id,
-            None,
-            request_payload['notes'],
-            created_rider_event.id
-        )
-        db.update(
-            session,
-            Riders,
-            {
-                'deposit_balance': rider.balance + request_payload['depositAmount']
-            },
-            **{
-                'id': rider_id
-            }
-        )
+        return app.response_class(response=cs.dumps(sl.single_checkpoint, data),
+                                  status=201,
+                                  mimetype='application/json')
+
+
+@app.route('/races/<int:checkpoint_id>', methods=['GET'])
+def get_checkpoint_riders(checkpoint_id):
+    """
+    Return the riders through a checkpoint in arrival order, a page at a time.
+
+    Each page is a range read of the (checkpoint, time) index. Query args are limit and cursor.
+    """
+    limit = request.args.get('limit', 25, type=int)
+    cursor = request.args.get('cursor')
+    if limit < 1:
+        return app.response_class(status=400, response='Invalid limit')
+    with db.session_scope() as session:
+        checkpoint = session.query(Checkpoints).get(checkpoint_id)
+        if checkpoint is None:
+            return app.response_class(status=404, response='Checkpoint not found')
         try:
-            session.commit()
-        except:
-            # todo put in logging!!!
-            print('There has been an exception here!')
-            session.rollback()
-            raise
-        return app.response_class(
-            status=200,
-            response=sl.rider_change_tracker_state.dumps(rider)
+            data, next_cursor = db.get_page(
+                session,
+                CheckpointArrivals,
+                limit,
+                sort='time',
+                cursor=cursor,
+                options=sl.loading_profile(sl.many_riders_at_checkpoint),
+                filters=(CheckpointArrivals.checkpoint == checkpoint_id,),
+            )
+        except ValueError:
+            return app.response_class(status=400, response='Invalid cursor')
+        next_url = None
+        if next_cursor is not None:
+            next_url = _next_page_url(next_cursor, limit=limit)
+        body = b''.join((
+            b'{"checkpoint": ', cs.dumps(sl.single_checkpoint, checkpoint),
+            b', "riders": ', cs.dumps(sl.many_riders_at_checkpoint, data),
+            b', "next": ', json.dumps(next_url).encode(), b'}',
+        ))
+        return app.response_class(response=body, status=200, mimetype='application/json')
+
+
+@app.route('/riders/<int:rider_id>/<int:checkpoint_id>/arrival', methods=['POST'])
+@db.retry_busy
+def post_checkpoint_arrival(rider_id, checkpoint_id):
+    """
+    Record a rider arriving at a checkpoint, with an arrive_checkpoint rider event.
+
+    The body may give the arrival time, otherwise it is the time the request is handled. Returns
+    every checkpoint the rider has been seen at, in arrival order.
+    """
+    try:
+        arrival = sl.checkpoint_arrival_load.load(request.get_json(silent=True) or {})
+    except ValidationError as e:
+        return app.response_class(status=400, response=json.dumps(e.messages), mimetype='application/json')
+    time = arrival['time'] or datetime.utcnow()
+    try:
+        return _record_checkpoint_arrival(rider_id, checkpoint_id, time)
+    except IntegrityError:
+        # a concurrent request recorded the same arrival first
+        return app.response_class(status=409, response='Rider already arrived at checkpoint')
+
+
+def _record_checkpoint_arrival(rider_id, checkpoint_id, time):
+    with db.session_scope(commit=True) as session:
+        if session.query(Riders.id).filter(Riders.id == rider_id).first() is None:
+            return app.response_class(status=404, response='Rider not found')
+        if session.query(Checkpoints.id).filter(Checkpoints.id == checkpoint_id).first() is None:
+            return app.response_class(status=404, response='Checkpoint not found')
+        if session.query(CheckpointArrivals.id).filter(
+            CheckpointArrivals.rider == rider_id,
+            CheckpointArrivals.checkpoint == checkpoint_id
+        ).first() is not None:
+            return app.response_class(status=409, response='Rider already arrived at checkpoint')
+        event_id, = db.bulk_insert_returning_ids(session, RiderEvents, [
+            {'user_id': None, 'datetime': time, 'event_type': 'arrive_checkpoint', 'rider': rider_id}
+        ])
+        db.bulk_insert(session, CheckpointArrivals, [
+            {'rider_id': rider_id, 'checkpoint_id': checkpoint_id, 'time': time, 'event': event_id}
+        ])
+        db.bulk_increment(session, Checkpoints, 'arrivals', [(checkpoint_id, 1)], returning=False)
+        # the new event shows in the rider's details
+        db.bulk_increment(session, Riders, 'version', [(rider_id, 1)], returning=False)
+        rc.changed('rider:%d' % rider_id)
+        seen = session.query(CheckpointArrivals).filter(
+            CheckpointArrivals.rider == rider_id
+        ).order_by(CheckpointArrivals.time).all()
+        return app.response_class(response=cs.dumps(sl.many_checkpoints_seen, seen),
+                                  status=200,
+                                  mimetype='application/json')
+
+
+@app.route('/export/<dataset>', methods=['GET'])
+def get_export(dataset):
+    """
+    Stream a whole table as NDJSON (default) or CSV, chosen with the format query arg.
+
+    The body is gzipped if the client accepts it.
+    """
+    format_ = request.args.get('format', 'ndjson')
+    if dataset not in export.DATASETS:
+        return app.response_class(status=404, response='Unknown dataset')
+    if format_ not in export.FORMATS:
+        return app.response_class(status=400, response='Invalid format')
+    session = db.Session(bind=db.engine)
+
+    def generate():
+        try:
+            for chunk in export.export(session, dataset, format_):
+                yield chunk
+        finally:
+            session.close()
+
+    response = _stream_response(generate(), export.FORMATS[format_])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (dataset, format_)
+    return response
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Return response cache hit, miss, eviction and invalidation counts and its size."""
+    return app.response_class(
+        response=json.dumps(response_cache.info()),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return request, db and component metrics in the Prometheus text format."""
+    return app.response_class(response=metrics.render(), status=200, mimetype=mt.MIMETYPE)
+
+
+@app.route('/queries/slow', methods=['GET'])
+def get_slow_queries():
+    """
+    Return the query fingerprints that took the most db time, with their slowest executions.
+
+    Query arg limit is the number of fingerprints returned.
+    """
+    limit = request.args.get('limit', 20, type=int)
+    if limit < 1:
+        return app.response_class(status=400, response='Invalid limit')
+    return app.response_class(
+        response=json.dumps(slow_queries.report(limit)),
+        status=200,
+        mimetype='application/json'
+    )
+
+
+@app.route('/db/stats', methods=['GET'])
+def get_db_stats():
+    """
+    Return db connection pool checkout, checkin and wait counts and the connections in use, writes
+    retried on a busy sqlite db and its WAL checkpoints.
+    """
+    stats = dict(db.pool_stats(), busy=db.busy_stats)
+    if wal_checkpointer is not None:
+        stats['wal'] = wal_checkpointer.stats
+    if replica_router is not None:
+        stats['replicas'] = dict(
+            replica_router.info(), pools=[db.pool_stats(replica) for replica in replica_router.replicas]
         )
+    return app.response_class(
+        response=json.dumps(stats),
+        status=200,
+        mimetype='application/json'
+    )
+
+
 @app.route('/riders/<int:rider_id>/trackers/<int:tracker_id>/trackerPossession',
            methods=['POST'])
 def tracker_possession_post(rider_id, tracker_id):